@@ -1,17 +1,43 @@
 import os
 import time
 import openai
-from flask import Flask, render_template, request, jsonify, send_file
+import httpx
+from flask import Flask, render_template, request, jsonify, send_file, Response
 from dotenv import load_dotenv
 from docx import Document
 from docx.shared import Pt, Inches, RGBColor
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_PARAGRAPH_ALIGNMENT
-from docx.oxml.ns import qn
+from docx.enum.style import WD_STYLE_TYPE
+from docx.oxml import parse_xml
+from docx.oxml.ns import qn, nsdecls
+from xml.sax.saxutils import escape
 import io
 from fpdf import FPDF
 import re
 import logging
 import json
+import heapq
+import random
+import itertools
+import email.utils
+import hashlib
+import sqlite3
+import uuid
+import threading
+import asyncio
+import contextlib
+import weakref
+import queue
+import csv
+import argparse
+import multiprocessing
+import tempfile
+import zipfile
+import urllib.parse
+import shutil
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -22,31 +48,799 @@ load_dotenv()
 # Initialize Flask app
 app = Flask(__name__)
 
-# Initialize OpenAI clients for multiple agents
-class StoryAgents:
+# Metrics
+class Metrics:
+    """Minimal thread-safe registry of counters and histograms in Prometheus text format"""
+
     def __init__(self):
-        self.plot_architect = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        self.narrative_developer = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        self.dialogue_enhancer = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        self.continuity_expert = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.lock = threading.Lock()
+        self.definitions = {}
+        self.values = {}
 
-    def generate_initial_plot_outline(self, title, description, num_chapters):
-        """Generate a comprehensive plot outline for the entire story"""
-        response = self.plot_architect.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": """You are a master storyteller and plot architect. 
+    def counter(self, name, help_text):
+        self.definitions[name] = ("counter", help_text, None)
+        self.values[name] = {}
+
+    def histogram(self, name, help_text, buckets):
+        self.definitions[name] = ("histogram", help_text, tuple(sorted(buckets)))
+        self.values[name] = {}
+
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = self._labels(labels)
+        with self.lock:
+            series = self.values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = {"buckets": [0] * len(buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    state["buckets"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.definitions.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(self.values[name].items()):
+                    if kind == "counter":
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+                        continue
+                    for bound, count in zip(buckets, value["buckets"]):
+                        lines.append(f"{name}_bucket{self._format_labels(labels, [('le', repr(float(bound)))])} {count}")
+                    lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {value['sum']}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.histogram("llm_request_duration_seconds", "Wall time of completion requests including retries and streaming",
+                  (0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300))
+metrics.counter("llm_requests_total", "Completion requests by stage, model and finish reason")
+metrics.counter("llm_tokens_total", "Tokens reported by the API by stage, model and kind (prompt, cached_prompt, completion)")
+metrics.counter("llm_retries_total", "Retried completion requests by stage")
+metrics.counter("llm_cache_hits_total", "Completions served from the completion cache by stage")
+metrics.counter("llm_cost_usd_total", "Estimated spend by model")
+metrics.histogram("export_render_seconds", "Time spent rendering an export in a worker process",
+                  (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+metrics.histogram("export_queue_seconds", "Time an export waited for a render process",
+                  (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30))
+metrics.counter("export_cache_hits_total", "Exports served from the artifact cache by format")
+metrics.histogram("story_generation_seconds", "Wall time of story jobs by mode and outcome",
+                  (10, 30, 60, 120, 300, 600, 1200, 3600))
+
+# USD per 1K prompt and completion tokens, optionally followed by the price of cached prompt tokens;
+# override with MODEL_PRICES='{"model": [prompt, completion, cached_prompt]}'
+MODEL_PRICES = {"gpt-3.5-turbo": (0.0005, 0.0015)}
+MODEL_PRICES.update(json.loads(os.getenv("MODEL_PRICES", "{}")))
+
+def completion_cost(model, prompt_tokens, completion_tokens, cached_tokens=0):
+    prices = MODEL_PRICES.get(model, (0, 0))
+    prompt_price, completion_price = prices[0], prices[1]
+    cached_price = prices[2] if len(prices) > 2 else prompt_price
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1000
+
+def merge_usage(total, extra):
+    """Add one usage breakdown to another, including the nested per-stage entries"""
+    merged = dict(total)
+    for key, value in extra.items():
+        if isinstance(value, dict):
+            merged[key] = merge_usage(merged.get(key, {}), value)
+        else:
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+# OpenAI client settings
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+# Any OpenAI-compatible endpoint, e.g. a proxy or the benchmark stub server
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+# Retries are handled by the request scheduler, which also honours Retry-After
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "0"))
+# Async clients get a larger pool since one event loop drives many stories at once
+OPENAI_ASYNC_POOL_SIZE = int(os.getenv("OPENAI_ASYNC_POOL_SIZE", "200"))
+
+# Rate-limit-aware request scheduling
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+SCHEDULER_MAX_RETRIES = int(os.getenv("SCHEDULER_MAX_RETRIES", "6"))
+SCHEDULER_BACKOFF_BASE = float(os.getenv("SCHEDULER_BACKOFF_BASE", "1"))
+SCHEDULER_BACKOFF_MAX = float(os.getenv("SCHEDULER_BACKOFF_MAX", "60"))
+# How often coroutines waiting on the rate limiter check whether it is their turn
+SCHEDULER_ASYNC_POLL = float(os.getenv("SCHEDULER_ASYNC_POLL", "0.05"))
+PRIORITIES = ("interactive", "batch")
+
+class TokenBucket:
+    """Continuously refilling bucket; callers must hold the scheduler lock"""
+
+    def __init__(self, capacity, per_second, now=None):
+        self.capacity = capacity
+        self.rate = per_second
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # A request larger than the whole bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        # May go negative when actual usage turns out higher than estimated
+        self.tokens -= amount
+
+class RetryableError(Exception):
+    """Wraps an API failure that is worth retrying, with the server's suggested delay"""
+
+    def __init__(self, error, retry_after=None):
+        super().__init__(str(error))
+        self.error = error
+        self.retry_after = retry_after
+
+def retry_after_seconds(error):
+    """Read Retry-After (or retry-after-ms) from an API error response"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def classify_api_error(error):
+    """Return a RetryableError for 429s, 5xx and connection problems, else None"""
+    if isinstance(error, openai.APIConnectionError):
+        return RetryableError(error)
+    if isinstance(error, openai.APIStatusError) and (error.status_code == 429 or error.status_code >= 500):
+        return RetryableError(error, retry_after_seconds(error))
+    return None
+
+class RequestScheduler:
+    """Admission control for the completion requests sent to one endpoint
+
+    Requests wait for both a requests-per-minute and a tokens-per-minute
+    bucket, using a prompt-size based token estimate that is corrected with
+    the real usage afterwards. Waiting requests are served strictly by
+    priority, interactive before batch, then in arrival order. 429s, 5xx
+    responses and connection errors are retried with jittered exponential
+    backoff, or after Retry-After when the server sends one; a 429 also
+    pauses all other requests for that long so a burst does not pile on.
+    clock, sleep and jitter can be replaced to drive the scheduler in tests.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM_LIMIT, tpm=OPENAI_TPM_LIMIT, max_retries=SCHEDULER_MAX_RETRIES,
+                 backoff_base=SCHEDULER_BACKOFF_BASE, backoff_max=SCHEDULER_BACKOFF_MAX,
+                 clock=time.monotonic, sleep=time.sleep, jitter=random.uniform):
+        self.clock = clock
+        self.sleep = sleep
+        self.jitter = jitter
+        self.requests = TokenBucket(rpm, rpm / 60, clock())
+        self.tokens = TokenBucket(tpm, tpm / 60, clock())
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.paused_until = 0
+        self.waiters = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def _admit(self, ticket, estimated_tokens):
+        """Take capacity for ticket if it is next in line (caller holds the lock)
+
+        Returns 0 once admitted, otherwise how long to wait before trying
+        again, or None when another request is ahead.
+        """
+        if self.waiters[0] != ticket:
+            return None
+        now = self.clock()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        timeout = max(self.paused_until - now, self.requests.wait_time(1),
+                      self.tokens.wait_time(estimated_tokens))
+        if timeout > 0:
+            return timeout
+        self.requests.take(1)
+        self.tokens.take(estimated_tokens)
+        return 0
+
+    def _leave(self, ticket):
+        with self.condition:
+            self.waiters.remove(ticket)
+            heapq.heapify(self.waiters)
+            self.condition.notify_all()
+
+    def _log_wait(self, requested_at, priority):
+        waited = self.clock() - requested_at
+        if waited > 1:
+            logging.info(f"Rate limiter held a {priority} request for {waited:.1f}s")
+
+    def acquire(self, estimated_tokens, priority="interactive"):
+        ticket = (PRIORITIES.index(priority), next(self.counter))
+        requested_at = self.clock()
+        with self.condition:
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    timeout = self._admit(ticket, estimated_tokens)
+                    if timeout == 0:
+                        break
+                    self.condition.wait(timeout)
+            finally:
+                self._leave(ticket)
+        self._log_wait(requested_at, priority)
+
+    async def acquire_async(self, estimated_tokens, priority="interactive"):
+        """acquire for coroutines: polls the buckets instead of blocking the event loop thread"""
+        ticket = (PRIORITIES.index(priority), next(self.counter))
+        requested_at = self.clock()
+        with self.condition:
+            heapq.heappush(self.waiters, ticket)
+        try:
+            while True:
+                with self.condition:
+                    timeout = self._admit(ticket, estimated_tokens)
+                if timeout == 0:
+                    break
+                await asyncio.sleep(min(timeout or SCHEDULER_ASYNC_POLL, SCHEDULER_ASYNC_POLL))
+        finally:
+            self._leave(ticket)
+        self._log_wait(requested_at, priority)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real usage of a request is known"""
+        with self.condition:
+            self.tokens.take(actual_tokens - estimated_tokens)
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        with self.condition:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    def _retry_delay(self, error, attempt, estimated_tokens, stage, on_retry):
+        """Seconds to wait before retrying a failed request, or None to give up"""
+        retryable = classify_api_error(error)
+        if retryable is None or attempt >= self.max_retries:
+            return None
+        # Nothing was generated, so hand the estimated tokens back
+        self.settle(estimated_tokens, 0)
+        backoff = self.jitter(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        delay = retryable.retry_after if retryable.retry_after is not None else backoff
+        if isinstance(error, openai.RateLimitError):
+            self.pause(delay)
+        metrics.inc("llm_retries_total", stage=stage)
+        if on_retry:
+            on_retry()
+        logging.warning(f"Request for stage '{stage}' failed ({str(error)}), "
+                        f"retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    def execute(self, request_fn, estimated_tokens, priority="interactive", stage=None, on_retry=None):
+        """Run request_fn under the rate limits, retrying transient API failures"""
+        attempt = 0
+        while True:
+            self.acquire(estimated_tokens, priority)
+            try:
+                return request_fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, estimated_tokens, stage, on_retry)
+                if delay is None:
+                    raise
+                attempt += 1
+                self.sleep(delay)
+
+    async def execute_async(self, request_fn, estimated_tokens, priority="interactive", stage=None, on_retry=None):
+        """execute for coroutines; request_fn returns an awaitable"""
+        attempt = 0
+        while True:
+            await self.acquire_async(estimated_tokens, priority)
+            try:
+                return await request_fn()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt, estimated_tokens, stage, on_retry)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+request_scheduler = RequestScheduler()
+
+# Model backends and per-stage routing
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+# Named backends besides "default" (which uses the OPENAI_* settings), e.g.
+# MODEL_BACKENDS='{"fast": {"model": "gpt-4o-mini", "timeout": 30, "max_concurrency": 8}}'
+MODEL_BACKENDS = json.loads(os.getenv("MODEL_BACKENDS", "{}"))
+# Stage to backend name, e.g. MODEL_ROUTES='{"title": "fast", "blurb": "fast", "summary": "fast"}'
+MODEL_ROUTES = json.loads(os.getenv("MODEL_ROUTES", "{}"))
+MODEL_STAGES = ("outline", "act_outline", "act_beats", "chapter", "title", "blurb",
+                "continuity_review", "revision", "summary")
+MODEL_BACKEND_SETTINGS = ("model", "base_url", "api_key_env", "timeout", "max_concurrency", "rpm", "tpm")
+
+class ModelBackend:
+    """One model behind one OpenAI-compatible endpoint, with its own timeout and concurrency limit
+
+    The sync client is thread-safe, so every agent and worker thread shares
+    one HTTP connection pool and its keep-alive connections and TLS sessions.
+    It is created lazily and rebuilt after a fork, since pooled connections
+    must not be shared between processes. Async connections belong to the
+    event loop that opened them, so each loop gets its own async client.
+    max_concurrency caps the requests in flight on this backend, separately
+    for worker threads and for each event loop.
+    """
+
+    def __init__(self, name, model, base_url=None, api_key_env="OPENAI_API_KEY", timeout=OPENAI_TIMEOUT,
+                 max_concurrency=None, scheduler=None):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key_env = api_key_env
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.scheduler = scheduler or request_scheduler
+        self.slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        self._client = None
+        self._client_pid = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_slots = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def _client_options(self, pool_size):
+        return dict(
+            api_key=os.getenv(self.api_key_env),
+            base_url=self.base_url,
+            timeout=httpx.Timeout(self.timeout, connect=OPENAI_CONNECT_TIMEOUT),
+            max_retries=OPENAI_MAX_RETRIES
+        ), httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=OPENAI_KEEPALIVE_SECONDS
+        )
+
+    def client(self):
+        """Return the process-wide client of this backend"""
+        if self._client is not None and self._client_pid == os.getpid():
+            return self._client
+        with self.lock:
+            if self._client is None or self._client_pid != os.getpid():
+                options, limits = self._client_options(self.max_concurrency or OPENAI_POOL_SIZE)
+                self._client = openai.OpenAI(**options, http_client=openai.DefaultHttpxClient(limits=limits))
+                self._client_pid = os.getpid()
+        return self._client
+
+    def async_client(self):
+        """Return the AsyncOpenAI client of the running event loop"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            options, limits = self._client_options(self.max_concurrency or OPENAI_ASYNC_POOL_SIZE)
+            client = openai.AsyncOpenAI(**options, http_client=openai.DefaultAsyncHttpxClient(limits=limits))
+            self._async_clients[loop] = client
+        return client
+
+    def slot(self):
+        """Context manager holding one of the backend's request slots for a worker thread"""
+        return self.slots if self.slots is not None else contextlib.nullcontext()
+
+    def async_slot(self):
+        """Async context manager holding one of the backend's request slots on the running loop"""
+        if not self.max_concurrency:
+            return contextlib.nullcontext()
+        loop = asyncio.get_running_loop()
+        slots = self._async_slots.get(loop)
+        if slots is None:
+            slots = self._async_slots[loop] = asyncio.Semaphore(self.max_concurrency)
+        return slots
+
+class ModelRouter:
+    """Picks the model backend for each generation stage
+
+    Stages that are not routed use the "default" backend. Backends on the
+    same endpoint share one rate limiter, since provider limits apply to the
+    account rather than the model; the default endpoint uses
+    request_scheduler, other endpoints get one with the rpm and tpm of the
+    first backend configured for them.
+    """
+
+    def __init__(self, backends=None, routes=None):
+        configs = {"default": {}}
+        configs.update(backends or {})
+        schedulers = {OPENAI_BASE_URL: request_scheduler}
+        self.backends = {}
+        for name, config in configs.items():
+            unknown = set(config) - set(MODEL_BACKEND_SETTINGS)
+            if unknown:
+                raise ValueError(f"Unknown settings for model backend '{name}': {', '.join(sorted(unknown))}")
+            base_url = config.get("base_url", OPENAI_BASE_URL)
+            if base_url not in schedulers:
+                schedulers[base_url] = RequestScheduler(rpm=int(config.get("rpm", OPENAI_RPM_LIMIT)),
+                                                        tpm=int(config.get("tpm", OPENAI_TPM_LIMIT)))
+            self.backends[name] = ModelBackend(
+                name,
+                config.get("model", OPENAI_MODEL),
+                base_url=base_url,
+                api_key_env=config.get("api_key_env", "OPENAI_API_KEY"),
+                timeout=float(config.get("timeout", OPENAI_TIMEOUT)),
+                # Settings may come from the environment as strings, like the rpm and timeout above
+                max_concurrency=int(config["max_concurrency"]) if config.get("max_concurrency") is not None else None,
+                scheduler=schedulers[base_url]
+            )
+        self.routes = dict(routes or {})
+        for stage, name in self.routes.items():
+            if name not in self.backends:
+                raise ValueError(f"Stage '{stage}' is routed to unknown model backend '{name}'")
+            if stage not in MODEL_STAGES:
+                logging.warning(f"MODEL_ROUTES names unknown stage '{stage}', known stages: {', '.join(MODEL_STAGES)}")
+
+    def for_stage(self, stage):
+        return self.backends[self.routes.get(stage, "default")]
+
+model_router = ModelRouter(MODEL_BACKENDS, MODEL_ROUTES)
+
+# On-disk cache of completions
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "1") == "1"
+COMPLETION_CACHE_PATH = os.getenv("COMPLETION_CACHE_PATH", os.path.join(CACHE_DIR, "completions.sqlite3"))
+COMPLETION_CACHE_MAX_BYTES = int(os.getenv("COMPLETION_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+class CompletionCache:
+    """Content-addressed SQLite cache for chat completions
+
+    Entries are keyed by a hash of everything that determines the output
+    (model, messages, sampling parameters and the optional seed). When the
+    stored text grows past max_bytes the least recently used entries are
+    evicted. The total size is kept as a running sum in completion_stats,
+    updated in the same transaction as every insert and eviction, so a put
+    never has to scan the table. A fresh connection is opened per operation,
+    so the cache can be shared by threads and by several worker processes.
+    """
+
+    def __init__(self, path=COMPLETION_CACHE_PATH, max_bytes=COMPLETION_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS completions (
+                key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS completion_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total_size INTEGER NOT NULL
+            )""")
+            # Caches created before the running total existed are summed up once
+            conn.execute("INSERT OR IGNORE INTO completion_stats "
+                         "SELECT 0, COALESCE(SUM(size), 0) FROM completions")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def total_size(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT total_size FROM completion_stats WHERE id = 0").fetchone()[0]
+
+    @staticmethod
+    def make_key(**params):
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT content FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, content):
+        now = time.time()
+        size = len(content.encode('utf-8'))
+        with self._connect() as conn:
+            # Take the write lock first so the replaced size and the running total are read consistently
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+            conn.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                         (key, content, size, now, now))
+            conn.execute("UPDATE completion_stats SET total_size = total_size + ? WHERE id = 0",
+                         (size - (row[0] if row else 0),))
+            total = conn.execute("SELECT total_size FROM completion_stats WHERE id = 0").fetchone()[0]
+            if total > self.max_bytes:
+                self._evict(conn, total)
+
+    def _evict(self, conn, total):
+        """Drop least recently used entries until the cache is back under 90% of its limit"""
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY last_access"):
+            if total <= target:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM completions WHERE key = ?", evicted)
+        conn.execute("UPDATE completion_stats SET total_size = ? WHERE id = 0", (total,))
+        logging.info(f"Completion cache evicted {len(evicted)} entries")
+
+completion_cache = CompletionCache() if COMPLETION_CACHE_ENABLED else None
+
+# Prompt layout
+STORY_SYSTEM_PROMPT = """You are part of a writing team creating one book: a plot architect, a novelist 
+and a continuity editor. Each request gives your role and your task. Stay consistent with the plot 
+outline and the book bible whenever they are provided."""
+
+def book_bible(title, description):
+    """Facts about the book that stay fixed for the whole run"""
+    return f"Working Title: {title}\nPremise: {description}"
+
+def story_bible(story):
+    """The bible a story was generated with; the working title is kept as original_title"""
+    return book_bible(story.get("original_title", story["title"]), story["description"])
+
+def build_messages(role, task, outline=None, bible=None, context=None):
+    """Lay out an agent prompt so calls for one book share the longest possible prefix
+
+    Providers cache prompt prefixes automatically, so the text that is
+    identical across calls comes first and always in the same order: the
+    shared system text, the plot outline, the book bible, then the agent's
+    role. Only then follow the changing story context and the task itself.
+    """
+    stable = [STORY_SYSTEM_PROMPT]
+    if outline:
+        stable.append(f"Plot Outline:\n{outline}")
+    if bible:
+        stable.append(f"Book Bible:\n{bible}")
+    request = [f"Role:\n{role}"]
+    if context is not None:
+        request.append(f"Previous Story Context:\n{context}")
+    request.append(task)
+    return [
+        {"role": "system", "content": "\n\n".join(stable)},
+        {"role": "user", "content": "\n\n".join(request)}
+    ]
+
+# Story agents differ only in their role prompts; each stage is sent to the backend it is routed to
+class StoryAgents:
+    def __init__(self, use_cache=True, seed=None, priority="interactive", bible=None, router=None):
+        self.router = router or model_router
+        # seed is part of the cache key, so a new seed asks for a fresh take on identical inputs
+        self.cache = completion_cache if use_cache else None
+        self.seed = seed
+        self.priority = priority
+        # Shared by every prompt of the book, see build_messages
+        self.bible = bible
+        # Token, cost and latency totals for this story, overall and per stage
+        self.usage = {}
+        self.usage_lock = threading.Lock()
+
+    def _record_usage(self, stage, model, seconds=0.0, cache_hit=False, retries=0, finish_reason=None,
+                      prompt_tokens=0, completion_tokens=0, cached_tokens=0):
+        cost = completion_cost(model, prompt_tokens, completion_tokens, cached_tokens)
+        # cached_tokens is the part of prompt_tokens the provider served from its prompt cache
+        entry = {"calls": 1, "cache_hits": int(cache_hit), "retries": retries,
+                 "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens,
+                 "completion_tokens": completion_tokens, "cost_usd": cost, "seconds": seconds}
+        with self.usage_lock:
+            self.usage = merge_usage(self.usage, dict(entry, stages={stage: entry}))
+
+        if cache_hit:
+            metrics.inc("llm_cache_hits_total", stage=stage)
+            return
+        metrics.observe("llm_request_duration_seconds", seconds, stage=stage, model=model)
+        metrics.inc("llm_requests_total", stage=stage, model=model, finish_reason=finish_reason or "unknown")
+        metrics.inc("llm_tokens_total", prompt_tokens, stage=stage, model=model, kind="prompt")
+        metrics.inc("llm_tokens_total", cached_tokens, stage=stage, model=model, kind="cached_prompt")
+        metrics.inc("llm_tokens_total", completion_tokens, stage=stage, model=model, kind="completion")
+        metrics.inc("llm_cost_usd_total", cost, model=model)
+
+    def _cache_key(self, messages, temperature, max_tokens, model):
+        if self.cache is None:
+            return None
+        return CompletionCache.make_key(model=model, messages=messages, temperature=temperature,
+                                        max_tokens=max_tokens, seed=self.seed)
+
+    def _cache_hit(self, stage, model, content, on_token):
+        logging.info(f"Completion cache hit for stage '{stage}'")
+        self._record_usage(stage, model, cache_hit=True)
+        if on_token is not None:
+            on_token(content)
+
+    def _cached(self, stage, messages, temperature, max_tokens, model, on_token):
+        """Return (cache key, cached text); the text is None on a miss"""
+        key = self._cache_key(messages, temperature, max_tokens, model)
+        content = self.cache.get(key) if key is not None else None
+        if content is not None:
+            self._cache_hit(stage, model, content, on_token)
+        return key, content
+
+    async def _acached(self, stage, messages, temperature, max_tokens, model, on_token):
+        """Coroutine version of _cached; the SQLite lookup runs in a worker thread"""
+        key = self._cache_key(messages, temperature, max_tokens, model)
+        content = await asyncio.to_thread(self.cache.get, key) if key is not None else None
+        if content is not None:
+            self._cache_hit(stage, model, content, on_token)
+        return key, content
+
+    def _request_params(self, messages, temperature, max_tokens, model, stream):
+        params = {"model": model, "messages": messages, "temperature": temperature,
+                  "max_tokens": max_tokens, "stream": stream}
+        if self.seed is not None:
+            params["seed"] = self.seed
+        if stream:
+            params["stream_options"] = {"include_usage": True}
+        return params
+
+    def _settle(self, stage, backend, max_tokens, estimated_tokens, started, retries,
+                content, usage, finish_reason):
+        """Book the finished request against the rate limits and usage totals"""
+        cached_tokens = 0
+        if usage:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached_tokens = getattr(details, "cached_tokens", None) or 0
+        else:
+            prompt_tokens = estimated_tokens - max_tokens
+            completion_tokens = estimate_tokens(content or "")
+        backend.scheduler.settle(estimated_tokens, prompt_tokens + completion_tokens)
+        self._record_usage(stage, backend.model, seconds=time.perf_counter() - started, retries=retries,
+                           finish_reason=finish_reason, prompt_tokens=prompt_tokens,
+                           completion_tokens=completion_tokens, cached_tokens=cached_tokens)
+        if finish_reason == "length":
+            logging.warning(f"Stage '{stage}' hit max_tokens={max_tokens}, output is truncated")
+        return content
+
+    def _complete(self, stage, messages, temperature, max_tokens, on_token=None):
+        """Run one chat completion and return its text
+
+        Every agent call goes through here and is sent to the model backend
+        the stage is routed to. Results are served from the completion cache
+        when possible. With on_token the response is streamed and each text
+        delta is passed on as it arrives (a cached result is delivered as a
+        single delta).
+        """
+        backend = self.router.for_stage(stage)
+        model = backend.model
+        key, content = self._cached(stage, messages, temperature, max_tokens, model, on_token)
+        if content is not None:
+            return content
+
+        params = self._request_params(messages, temperature, max_tokens, model, stream=on_token is not None)
+        estimated_tokens = sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+        retries = []
+        started = time.perf_counter()
+        client = backend.client()
+        usage = None
+        finish_reason = None
+        # The slot is held until a streamed response has been read to the end
+        with backend.slot():
+            # Only the request itself is retried; a stream that fails midway has already emitted text
+            response = backend.scheduler.execute(
+                lambda: client.chat.completions.create(**params),
+                estimated_tokens, self.priority, stage,
+                on_retry=lambda: retries.append(1)
+            )
+
+            if on_token is not None:
+                deltas = []
+                for chunk in response:
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        deltas.append(delta)
+                        on_token(delta)
+                content = ''.join(deltas)
+            else:
+                usage = response.usage
+                finish_reason = response.choices[0].finish_reason
+                content = response.choices[0].message.content
+
+        content = self._settle(stage, backend, max_tokens, estimated_tokens, started, len(retries),
+                               content, usage, finish_reason)
+        if key is not None and content:
+            self.cache.put(key, content)
+        return content
+
+    async def _acomplete(self, stage, messages, temperature, max_tokens, on_token=None):
+        """Coroutine version of _complete"""
+        backend = self.router.for_stage(stage)
+        model = backend.model
+        key, content = await self._acached(stage, messages, temperature, max_tokens, model, on_token)
+        if content is not None:
+            return content
+
+        params = self._request_params(messages, temperature, max_tokens, model, stream=on_token is not None)
+        estimated_tokens = sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+        retries = []
+        started = time.perf_counter()
+        client = backend.async_client()
+        usage = None
+        finish_reason = None
+        async with backend.async_slot():
+            response = await backend.scheduler.execute_async(
+                lambda: client.chat.completions.create(**params),
+                estimated_tokens, self.priority, stage,
+                on_retry=lambda: retries.append(1)
+            )
+
+            if on_token is not None:
+                deltas = []
+                async for chunk in response:
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        deltas.append(delta)
+                        on_token(delta)
+                content = ''.join(deltas)
+            else:
+                usage = response.usage
+                finish_reason = response.choices[0].finish_reason
+                content = response.choices[0].message.content
+
+        content = self._settle(stage, backend, max_tokens, estimated_tokens, started, len(retries),
+                               content, usage, finish_reason)
+        if key is not None and content:
+            await asyncio.to_thread(self.cache.put, key, content)
+        return content
+
+    def _outline_request(self, title, description, num_chapters):
+        return dict(
+            stage="outline",
+            messages=build_messages(
+                role="""You are a master storyteller and plot architect. 
                     Create a comprehensive story structure that ensures narrative cohesion, 
-                    character development, and engaging plot progression."""
-                },
-                {
-                    "role": "user", 
-                    "content": f"""Develop a detailed plot outline for a story with the following parameters:
-                    - Title: {title}
-                    - Description: {description}
-                    - Number of Chapters: {num_chapters}
+                    character development, and engaging plot progression.""",
+                bible=self.bible or book_bible(title, description),
+                task=f"""Develop a detailed plot outline for this story in {num_chapters} chapters.
 
                     For each chapter, provide:
                     1. Key plot points
@@ -60,34 +854,109 @@ class StoryAgents:
                     - Consistent character motivations
                     - Gradual plot escalation
                     - Meaningful character transformations"""
-                }
-            ],
+            ),
             temperature=0.7,
             max_tokens=2000
         )
-        return response.choices[0].message.content
 
-    def generate_chapter(self, previous_chapters, plot_outline, chapter_number):
-        """Generate a chapter with context from previous chapters"""
-        context = "\n\n".join([chapter['content'] for chapter in previous_chapters]) if previous_chapters else ""
-        
-        response = self.narrative_developer.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": """You are an expert novelist specializing in crafting compelling narrative chapters. 
-                    Ensure narrative flow, character depth, and engaging storytelling."""
-                },
-                {
-                    "role": "user", 
-                    "content": f"""Generate Chapter {chapter_number}
-
-                    Previous Story Context:
-                    {context}
-
-                    Plot Outline for Context:
-                    {plot_outline}
+    def generate_initial_plot_outline(self, title, description, num_chapters):
+        """Generate a comprehensive plot outline for the entire story"""
+        return self._complete(**self._outline_request(title, description, num_chapters))
+
+    def _acts_request(self, title, description, num_chapters, ranges):
+        act_lines = "\n".join(f"Act {number}: chapters {first}-{last}"
+                               for number, (first, last) in enumerate(ranges, 1))
+        return dict(
+            stage="act_outline",
+            messages=build_messages(
+                role="""You are a master storyteller and plot architect. 
+                    Plan long novels act by act, so every act has its own arc while the book builds to one ending.""",
+                bible=self.bible or book_bible(title, description),
+                task=f"""Plan the acts of this story as a {num_chapters}-chapter novel.
+
+                    The book has {len(ranges)} acts:
+                    {act_lines}
+
+                    For each act give a short title and a summary of under {ACT_SUMMARY_WORDS} words covering 
+                    its main events, character arcs and how it ends.
+                    Respond with only a JSON array of {len(ranges)} objects with "title" and "summary" keys, in act order."""
+            ),
+            temperature=0.7,
+            max_tokens=min(4000, 300 * len(ranges))
+        )
+
+    @staticmethod
+    def _parse_acts(content, ranges):
+        planned = parse_json_reply(content)
+        if not isinstance(planned, list):
+            logging.warning("Act outline was not a JSON array, planning acts from their position only")
+            planned = []
+        acts = []
+        for number, (first, last) in enumerate(ranges, 1):
+            plan = planned[number - 1] if number <= len(planned) and isinstance(planned[number - 1], dict) else {}
+            acts.append({
+                "number": number,
+                "title": clean_heading(str(plan.get("title") or f"Act {number}")),
+                "summary": str(plan.get("summary") or "").strip(),
+                "first_chapter": first,
+                "last_chapter": last,
+                # Chapter beats are planned when the act is reached
+                "beats": None
+            })
+        return acts
+
+    def generate_act_outline(self, title, description, num_chapters):
+        """Plan a long book as acts; their chapter beats are planned later with generate_act_beats"""
+        ranges = plan_act_ranges(num_chapters)
+        return self._parse_acts(self._complete(**self._acts_request(title, description, num_chapters, ranges)),
+                                ranges)
+
+    def _beats_request(self, story, act, context):
+        count = act["last_chapter"] - act["first_chapter"] + 1
+        return dict(
+            stage="act_beats",
+            messages=build_messages(
+                role="""You are a master storyteller and plot architect. 
+                    Break the acts of a novel down into chapter-by-chapter beats.""",
+                outline=story['plot_outline'],
+                bible=self.bible or book_bible(story['title'], story['description']),
+                context=context or "The story has not started yet.",
+                task=f"""Write the beats for Act {act['number']}: {act['title']}, chapters {act['first_chapter']}-{act['last_chapter']}.
+                    Give each chapter one or two sentences with its key events. Follow this act's summary, 
+                    pick up from the story so far and leave the events of later acts for later.
+                    Respond with only a JSON array of {count} strings, one per chapter in order."""
+            ),
+            temperature=0.7,
+            max_tokens=min(4000, 150 * count + 100)
+        )
+
+    @staticmethod
+    def _parse_beats(content, act):
+        beats = parse_json_reply(content)
+        if not isinstance(beats, list):
+            logging.warning(f"Beats for act {act['number']} were not a JSON array, using the act summary")
+            beats = []
+        beats = [str(beat).strip() for beat in beats if str(beat).strip()]
+        count = act["last_chapter"] - act["first_chapter"] + 1
+        # Chapters without a beat of their own follow the act summary
+        fallback = f"Continue Act {act['number']} ({act['title']}) as its summary describes."
+        return (beats + [fallback] * count)[:count]
+
+    def generate_act_beats(self, story, act, context):
+        """Plan one beat per chapter of an act, given the act plan and the bounded story so far"""
+        return self._parse_beats(self._complete(**self._beats_request(story, act, context)), act)
+
+    def _chapter_request(self, context, plot_outline, chapter_number, plan=None):
+        plan_text = f"\n\n                    Plan for This Chapter:\n{plan}" if plan else ""
+        return dict(
+            stage="chapter",
+            messages=build_messages(
+                role="""You are an expert novelist specializing in crafting compelling narrative chapters. 
+                    Ensure narrative flow, character depth, and engaging storytelling.""",
+                outline=plot_outline,
+                bible=self.bible,
+                context=context,
+                task=f"""Generate Chapter {chapter_number}{plan_text}
 
                     Chapter Generation Guidelines:
                     1. Create a unique, intriguing chapter title
@@ -95,165 +964,1156 @@ class StoryAgents:
                     3. Advance the plot meaningfully
                     4. Develop characters
                     5. Maintain consistent tone and style"""
-                }
-            ],
+            ),
             temperature=0.8,
             max_tokens=2000
         )
-        
-        chapter_content = response.choices[0].message.content
-        
-        # Extract chapter title (assumed to be first line)
-        chapter_lines = chapter_content.strip().split('\n')
-        chapter_title = chapter_lines[0].strip()
 
-        # Clean up chapter title - remove any formatting and "Chapter X:" prefixes
-        chapter_title = re.sub(r'\*\*|\*|\"\"|\"|#', '', chapter_title)
-        chapter_title = re.sub(r'^Chapter\s+\d+\s*:?\s*', '', chapter_title).strip()
-        
-        # Remove title from content
-        chapter_body = '\n'.join(chapter_lines[1:]).strip()
+    @staticmethod
+    def _parse_chapter(content, chapter_number):
+        # Extract chapter title (assumed to be first line)
+        chapter_lines = content.strip().split('\n')
+        chapter_title = clean_heading(chapter_lines[0])
 
-        # Clean up any remaining markdown formatting in the chapter body
-        chapter_body = re.sub(r'\*\*|\*|#', '', chapter_body).strip()
+        # Parse the rest once into typed paragraphs for the exporters
+        blocks = parse_chapter_text('\n'.join(chapter_lines[1:]))
         
         return {
             "number": chapter_number,
             "title": chapter_title,
-            "content": chapter_body
+            "content": blocks_to_text(blocks),
+            "blocks": blocks
         }
 
-def generate_story(title, description, num_chapters):
-    """Enhanced story generation with multi-agent approach"""
-    agents = StoryAgents()
-    
-    # Generate comprehensive plot outline
-    plot_outline = agents.generate_initial_plot_outline(title, description, num_chapters)
-    
-    # Initialize story structure
-    story = {
-        "title": title,
-        "description": description,
-        "plot_outline": plot_outline,
-        "chapters": []
-    }
-    
-    # Generate title and subtitle
-    title_response = agents.plot_architect.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Create professional, engaging book titles and subtitles."},
-            {"role": "user", "content": f"Generate a compelling book title and subtitle for a story about: {description}"}
-        ],
-        temperature=0.7,
-        max_tokens=100
-    )
+    def generate_chapter(self, context, plot_outline, chapter_number, on_token=None, plan=None):
+        """Generate a chapter with context from previous chapters
 
-    improved_title = title_response.choices[0].message.content.strip().strip('"')
-    # Clean up any remaining formatting markers
-    improved_title = re.sub(r'\*\*|\*|#|Title:\s*', '', improved_title)
-    # Only use the improved title if it's valid and not too long
-    if improved_title and len(improved_title) <= 100:
-        story["original_title"] = title
-        title = improved_title
-    
-    # Blurb generation
-    blurb_response = agents.plot_architect.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "Create engaging book blurbs that capture the essence of the story."},
-            {"role": "user", "content": f"Write a compelling 200-word book blurb for a story titled '{title}' about: {description}"}
-        ],
-        temperature=0.7,
-        max_tokens=300
+        context is the bounded story-so-far text built by ChapterContext and
+        plan the chapter's own part of the outline, if it has one.
+        When on_token is given the completion is streamed and every text delta
+        is passed to on_token as it arrives.
+        """
+        content = self._complete(**self._chapter_request(context, plot_outline, chapter_number, plan),
+                                 on_token=on_token)
+        return self._parse_chapter(content, chapter_number)
+
+    def _title_request(self, description):
+        return dict(
+            stage="title",
+            messages=build_messages(
+                role="Create professional, engaging book titles and subtitles.",
+                bible=self.bible,
+                task=f"Generate a compelling book title and subtitle for a story about: {description}"
+            ),
+            temperature=0.7,
+            max_tokens=100
+        )
+
+    @staticmethod
+    def _parse_title(content):
+        improved_title = content.strip().strip('"')
+        # Clean up any remaining formatting markers
+        return re.sub(r'\*\*|\*|#|Title:\s*', '', improved_title)
+
+    def generate_title(self, description):
+        """Generate an improved book title and subtitle"""
+        return self._parse_title(self._complete(**self._title_request(description)))
+
+    def _blurb_request(self, title, description):
+        return dict(
+            stage="blurb",
+            messages=build_messages(
+                role="Create engaging book blurbs that capture the essence of the story.",
+                bible=self.bible,
+                task=f"Write a compelling 200-word book blurb for a story titled '{title}' about: {description}"
+            ),
+            temperature=0.7,
+            max_tokens=300
+        )
+
+    @staticmethod
+    def _parse_blurb(content):
+        blurb = content.strip()
+        # Clean up any markdown formatting
+        return re.sub(r'\*\*|\*|#', '', blurb)
+
+    def generate_blurb(self, title, description):
+        """Generate the back-cover blurb"""
+        return self._parse_blurb(self._complete(**self._blurb_request(title, description)))
+
+    def _continuity_request(self, plot_outline, chapters):
+        summaries = "\n".join(
+            f"Chapter {chapter['number']} ({chapter['title']}): {chapter['summary']}" for chapter in chapters
+        )
+        return dict(
+            stage="continuity_review",
+            messages=build_messages(
+                role="""You are a meticulous continuity editor. You compare chapter summaries 
+                    against the plot outline and each other, and report only real inconsistencies.""",
+                outline=plot_outline,
+                bible=self.bible,
+                context=f"Chapter Summaries:\n{summaries}",
+                task="""These chapters were drafted independently from the same outline.
+
+                    List continuity problems: contradictory facts, names, timelines, repeated or 
+                    skipped plot events, and characters who know things they should not yet know.
+                    Respond with only a JSON object mapping chapter numbers to a list of concrete 
+                    fixes for that chapter. Leave out chapters that need no changes."""
+            ),
+            temperature=0.2,
+            max_tokens=800
+        )
+
+    @staticmethod
+    def _parse_continuity(content):
+        notes = parse_json_reply(content)
+        if notes is None:
+            logging.warning("Continuity review did not return valid JSON, skipping revisions")
+            return {}
+        if not isinstance(notes, dict):
+            return {}
+        return {int(number): fixes for number, fixes in notes.items()
+                if str(number).strip().isdigit() and fixes}
+
+    def review_continuity(self, plot_outline, chapters):
+        """Find cross-chapter inconsistencies in drafts written in parallel
+
+        Works from the chapter summaries only, so it is a single cheap call.
+        Returns a dict mapping chapter numbers to lists of fixes.
+        """
+        return self._parse_continuity(self._complete(**self._continuity_request(plot_outline, chapters)))
+
+    def _revision_request(self, chapter, fixes):
+        fix_list = "\n".join(f"- {fix}" for fix in fixes)
+        return dict(
+            stage="revision",
+            messages=build_messages(
+                role="""You are a continuity editor. Make the smallest edits needed to fix 
+                    the listed problems and keep everything else word for word.""",
+                bible=self.bible,
+                task=f"""Revise Chapter {chapter['number']}: {chapter['title']}
+
+                    Fixes required:
+                    {fix_list}
+
+                    Chapter text:
+                    {chapter['content']}
+
+                    Return only the revised chapter text, without the chapter title."""
+            ),
+            temperature=0.4,
+            max_tokens=2000
+        )
+
+    @staticmethod
+    def _parse_revision(chapter, fixes, content):
+        blocks = parse_chapter_text(content)
+        if not blocks:
+            return chapter
+        return dict(chapter, content=blocks_to_text(blocks), blocks=blocks, continuity_fixes=list(fixes))
+
+    def revise_chapter(self, chapter, fixes):
+        """Apply continuity fixes to a drafted chapter with minimal changes"""
+        if isinstance(fixes, str):
+            fixes = [fixes]
+        return self._parse_revision(chapter, fixes, self._complete(**self._revision_request(chapter, fixes)))
+
+    def _summary_request(self, chapter):
+        return dict(
+            stage="summary",
+            messages=build_messages(
+                role="""You keep track of story continuity. Summarize chapters tightly, 
+                    keeping plot events, character states, locations and unresolved threads.""",
+                bible=self.bible,
+                task=f"""Summarize Chapter {chapter['number']}: {chapter['title']} in under {CHAPTER_SUMMARY_WORDS} words.
+
+                    {chapter['content']}"""
+            ),
+            temperature=0.3,
+            max_tokens=250
+        )
+
+    def summarize_chapter(self, chapter):
+        """Condense a finished chapter into a short summary for later context"""
+        return self._complete(**self._summary_request(chapter)).strip()
+
+    # Coroutine versions of the agent calls, for use on an event loop
+    async def agenerate_initial_plot_outline(self, title, description, num_chapters):
+        return await self._acomplete(**self._outline_request(title, description, num_chapters))
+
+    async def agenerate_act_outline(self, title, description, num_chapters):
+        ranges = plan_act_ranges(num_chapters)
+        return self._parse_acts(await self._acomplete(**self._acts_request(title, description, num_chapters, ranges)),
+                                ranges)
+
+    async def agenerate_act_beats(self, story, act, context):
+        return self._parse_beats(await self._acomplete(**self._beats_request(story, act, context)), act)
+
+    async def agenerate_chapter(self, context, plot_outline, chapter_number, on_token=None, plan=None):
+        content = await self._acomplete(**self._chapter_request(context, plot_outline, chapter_number, plan),
+                                        on_token=on_token)
+        return self._parse_chapter(content, chapter_number)
+
+    async def agenerate_title(self, description):
+        return self._parse_title(await self._acomplete(**self._title_request(description)))
+
+    async def agenerate_blurb(self, title, description):
+        return self._parse_blurb(await self._acomplete(**self._blurb_request(title, description)))
+
+    async def areview_continuity(self, plot_outline, chapters):
+        return self._parse_continuity(await self._acomplete(**self._continuity_request(plot_outline, chapters)))
+
+    async def arevise_chapter(self, chapter, fixes):
+        if isinstance(fixes, str):
+            fixes = [fixes]
+        return self._parse_revision(chapter, fixes, await self._acomplete(**self._revision_request(chapter, fixes)))
+
+    async def asummarize_chapter(self, chapter):
+        return (await self._acomplete(**self._summary_request(chapter))).strip()
+
+# Rolling chapter context
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_TAIL_CHAPTERS = int(os.getenv("CONTEXT_TAIL_CHAPTERS", "1"))
+CONTEXT_TAIL_TOKENS = int(os.getenv("CONTEXT_TAIL_TOKENS", "600"))
+CHAPTER_SUMMARY_WORDS = int(os.getenv("CHAPTER_SUMMARY_WORDS", "120"))
+
+def estimate_tokens(text):
+    """Cheap token estimate (roughly four characters per token for English prose)"""
+    return len(text) // 4 + 1
+
+def chapter_tail(content, max_tokens):
+    """Return the closing part of a chapter, starting on a paragraph boundary when possible"""
+    if max_tokens <= 0:
+        return ""
+    max_chars = max_tokens * 4
+    if len(content) <= max_chars:
+        return content
+    tail = content[-max_chars:]
+    paragraph_start = tail.find('\n\n')
+    if 0 <= paragraph_start < len(tail) // 2:
+        tail = tail[paragraph_start:]
+    return tail.strip()
+
+class ChapterContext:
+    """Bounded story-so-far context for chapter prompts
+
+    The most recent chapters are included as verbatim tails so the prose
+    flows on naturally, older chapters only as their stored summaries. The
+    whole context is kept under a token budget so chapter prompts stay the
+    same size however long the book gets. Summaries are produced once per
+    chapter, in the background while the next chapter is written, and
+    stored on the chapter record as chapter['summary']. The record is only
+    updated from the thread that owns the context, so it is never modified
+    while another thread serializes it.
+    """
+
+    def __init__(self, agents, token_budget=CONTEXT_TOKEN_BUDGET,
+                 tail_chapters=CONTEXT_TAIL_CHAPTERS, tail_tokens=CONTEXT_TAIL_TOKENS):
+        self.agents = agents
+        self.token_budget = token_budget
+        self.tail_chapters = tail_chapters
+        self.tail_tokens = tail_tokens
+        self.chapters = []
+        self.pending_summaries = {}
+        # Chapter numbers the last built context drew on, kept as chapter['context_chapters']
+        self.last_sources = []
+        self.executor = self._make_executor()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(wait=exc_type is None)
+        return False
+
+    def add_chapter(self, chapter):
+        self.chapters.append(chapter)
+        if not chapter.get("summary"):
+            self.pending_summaries[chapter["number"]] = self._start_summary(chapter)
+
+    def _make_executor(self):
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix="chapter-summary")
+
+    def _start_summary(self, chapter):
+        return self.executor.submit(self.agents.summarize_chapter, chapter)
+
+    def _wait_for_summary(self, chapter):
+        future = self.pending_summaries.pop(chapter["number"], None)
+        if future is not None:
+            chapter["summary"] = future.result()
+        return chapter["summary"]
+
+    def build(self):
+        """Assemble the context text for the next chapter"""
+        self.last_sources = []
+        if not self.chapters:
+            return ""
+
+        tail_count = min(self.tail_chapters, len(self.chapters))
+        recent = self.chapters[len(self.chapters) - tail_count:] if tail_count else []
+        older = self.chapters[:len(self.chapters) - tail_count]
+
+        # Headings and the separators between sections are paid for out of the budget as well
+        remaining = self.token_budget
+        tails = []
+        for chapter in reversed(recent):
+            heading = f"End of Chapter {chapter['number']} ({chapter['title']}):\n"
+            tail = chapter_tail(chapter["content"], min(self.tail_tokens, remaining - estimate_tokens(heading) - 2))
+            if not tail:
+                break
+            tails.insert(0, heading + tail)
+            self.last_sources.append(chapter['number'])
+            remaining -= estimate_tokens(tails[0]) + 1
+
+        # Newest summaries are most relevant, so drop the oldest ones first
+        summaries = []
+        summaries_heading = "Summary of earlier chapters:\n"
+        for chapter in reversed(older):
+            summary = f"Chapter {chapter['number']} ({chapter['title']}): {self._wait_for_summary(chapter)}"
+            cost = estimate_tokens(summary) + 1
+            if not summaries:
+                cost += estimate_tokens(summaries_heading)
+            if cost > remaining:
+                break
+            summaries.insert(0, summary)
+            self.last_sources.append(chapter['number'])
+            remaining -= cost
+
+        self.last_sources.sort()
+        sections = []
+        if summaries:
+            sections.append(summaries_heading + "\n".join(summaries))
+        sections.extend(tails)
+        return "\n\n".join(sections)
+
+    def close(self, wait=True):
+        """Finish outstanding summaries so every chapter record carries one"""
+        if wait:
+            for chapter in self.chapters:
+                self._wait_for_summary(chapter)
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+class AsyncChapterContext(ChapterContext):
+    """ChapterContext for coroutines: summaries run as tasks on the event loop
+
+    Use abuild() and "async with"; build() only reads summaries that
+    abuild() has already awaited.
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose(wait=exc_type is None)
+        return False
+
+    def _make_executor(self):
+        # Summaries are tasks on the event loop, so no thread pool is needed
+        return None
+
+    def _start_summary(self, chapter):
+        return asyncio.ensure_future(self.agents.asummarize_chapter(chapter))
+
+    async def _await_summaries(self, chapters):
+        for chapter in chapters:
+            task = self.pending_summaries.pop(chapter["number"], None)
+            if task is not None:
+                chapter["summary"] = await task
+
+    async def abuild(self):
+        """Assemble the context text for the next chapter"""
+        await self._await_summaries(self.chapters[:max(len(self.chapters) - self.tail_chapters, 0)])
+        return self.build()
+
+    async def aclose(self, wait=True):
+        """Finish outstanding summaries so every chapter record carries one"""
+        if wait:
+            await self._await_summaries(self.chapters)
+        for task in self.pending_summaries.values():
+            task.cancel()
+        self.pending_summaries.clear()
+
+# Hierarchical outlines for long books
+FLAT_OUTLINE_MAX_CHAPTERS = int(os.getenv("FLAT_OUTLINE_MAX_CHAPTERS", "10"))
+OUTLINE_ACT_CHAPTERS = int(os.getenv("OUTLINE_ACT_CHAPTERS", "12"))
+ACT_SUMMARY_WORDS = int(os.getenv("ACT_SUMMARY_WORDS", "120"))
+
+def parse_json_reply(content):
+    """Decode a JSON reply, tolerating a markdown code fence; None when it is not JSON"""
+    content = re.sub(r'^```(?:json)?\s*|\s*```$', '', content.strip())
+    try:
+        return json.loads(content)
+    except ValueError:
+        return None
+
+def uses_act_outline(num_chapters):
+    """Books longer than one outline response can cover are planned act by act"""
+    return num_chapters > FLAT_OUTLINE_MAX_CHAPTERS
+
+def plan_act_ranges(num_chapters, act_chapters=OUTLINE_ACT_CHAPTERS):
+    """Split the chapters into evenly sized acts of at most act_chapters; returns (first, last) pairs"""
+    count = -(-num_chapters // act_chapters)
+    size, extra = divmod(num_chapters, count)
+    ranges = []
+    first = 1
+    for number in range(count):
+        last = first + size + (1 if number < extra else 0) - 1
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+def format_act_outline(acts):
+    """Readable act plan, stored as the story's plot_outline"""
+    return "\n\n".join(
+        f"Act {act['number']}: {act['title']} (Chapters {act['first_chapter']}-{act['last_chapter']})\n{act['summary']}"
+        for act in acts
     )
 
-    blurb = blurb_response.choices[0].message.content.strip()
-    # Clean up any markdown formatting
-    blurb = re.sub(r'\*\*|\*|#', '', blurb)
-    
-    # Parse responses
-    story['title'] = title
-    story['blurb'] = blurb
-    
-    # Generate chapters iteratively
-    previous_chapters = []
-    for chapter_num in range(1, num_chapters + 1):
-        chapter = agents.generate_chapter(previous_chapters, plot_outline, chapter_num)
-        story['chapters'].append(chapter)
-        previous_chapters.append(chapter)
-    
-    return story
+def act_for_chapter(story, chapter_number):
+    for act in story.get("acts") or ():
+        if act["first_chapter"] <= chapter_number <= act["last_chapter"]:
+            return act
+    return None
+
+def chapter_outline(story):
+    """The outline every chapter prompt of the book shares: all of it for short books, none for long ones"""
+    return None if story.get("acts") else story["plot_outline"]
+
+def chapter_plan(story, chapter_number):
+    """A chapter's own part of the plan, for books planned in acts (None otherwise)
+
+    It names the current act, this chapter's beat and the next one. Chapter
+    prompts of such books get this instead of the whole act plan, so they
+    stay the same size however long the book is.
+    """
+    act = act_for_chapter(story, chapter_number)
+    if act is None:
+        return None
+    beats = act.get("beats") or []
+    index = chapter_number - act["first_chapter"]
+    lines = [f"Act {act['number']} of {len(story['acts'])}: {act['title']} "
+             f"(Chapters {act['first_chapter']}-{act['last_chapter']})",
+             act["summary"],
+             f"This chapter (Chapter {chapter_number} of {story['num_chapters']}): "
+             f"{beats[index] if index < len(beats) else 'Continue the act as its summary describes.'}"]
+    if chapter_number == story["num_chapters"]:
+        lines.append("This is the final chapter; bring the story to its ending.")
+    elif index + 1 < len(beats):
+        lines.append(f"Next chapter, do not cover it yet: {beats[index + 1]}")
+    else:
+        following = act_for_chapter(story, chapter_number + 1)
+        lines.append(f"This chapter closes the act; the next one opens Act {following['number']}: "
+                     f"{following['title']}.")
+    return "\n".join(line for line in lines if line)
 
-def create_pdf(story):
+def run_stages(stages, on_complete=None, max_workers=None):
+    """Run a small dependency graph of generation stages on a thread pool
+
+    stages maps a stage name to (func, dependencies); func is called with the
+    results of its dependencies as keyword arguments once they are all done,
+    so independent stages overlap. on_complete(stage, result) runs on the
+    calling thread as each stage finishes. Returns a dict of all results.
+    """
+    results = {}
+    timings = {}
+    started = time.perf_counter()
+    pending = dict(stages)
+    running = {}
+
+    def timed(name, func, kwargs):
+        stage_start = time.perf_counter()
+        try:
+            return func(**kwargs)
+        finally:
+            timings[name] = (stage_start - started, time.perf_counter() - stage_start)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(stages), thread_name_prefix="story-stage")
     try:
-        class StoryPDF(FPDF):
-            def __init__(self):
-                super().__init__()
-                self.set_auto_page_break(auto=True, margin=20)
-                self.set_margins(25, 25, 25)
-                self.set_title(story["title"])
-                self.chapter_start = False
-                self.page_num_offset = 3  # Cover, blurb, TOC pages
-                self.set_font('Times', '')  # For regular text
-                self.set_font('Times', 'B')  # For bold text
-                self.set_font('Times', 'I')  # For italic text
-                
-            def header(self):
-                if self.page_no() > self.page_num_offset:
-                    if not self.chapter_start:
-                        self.set_font('Times', 'I', 10)
-                        self.set_y(10)
-                        # Alternate header placement
-                        if self.page_no() % 2 == 0:  # Even page
-                            self.cell(0, 10, story["title"], 0, 0, 'L')
-                        else:  # Odd page
-                            self.cell(0, 10, "AI Story Generator", 0, 0, 'R')
-                    self.chapter_start = False
-            
-            def footer(self):
-                if self.page_no() > self.page_num_offset:
-                    self.set_y(-15)
-                    self.set_font('Times', 'I', 10)
-                    # Centered page numbers
-                    self.cell(0, 10, str(self.page_no() - self.page_num_offset), 0, 0, 'C')
-        
-        # Initialize PDF
-        pdf = StoryPDF()
-        
-        # Clean title function
-        def clean_title(title):
-            cleaned = re.sub(r'\*\*|\*|#', '', title)
-            cleaned = re.sub(r'^Title:\s*', '', cleaned)
-            cleaned = re.sub(r'^Chapter\s*\d+\s*:?\s*', '', cleaned)
-            return cleaned.strip()
-        
-        # Sanitize text for PDF
-        def sanitize_for_pdf(text):
-            replacements = {
-                '\u2014': '-',  # em dash
-                '\u2013': '-',  # en dash
-                '\u2018': "'",  # left single quote
-                '\u2019': "'",  # right single quote
-                '\u201C': '"',  # left double quote
-                '\u201D': '"',  # right double quote
-                '\u2026': '...', # ellipsis
-                '\u00A0': ' '   # non-breaking space
-            }
-            
-            for char, replacement in replacements.items():
-                text = text.replace(char, replacement)
-                
-            return text
-        
-        # Cover Page
-        pdf.add_page()
-        pdf.set_fill_color(240, 240, 245)
-        pdf.rect(0, 60, 210, 100, 'F')
-        pdf.ln(80)
-        pdf.set_font('Times', 'B', 26)
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    kwargs = {dep: results[dep] for dep in deps}
+                    running[executor.submit(timed, name, func, kwargs)] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Unresolvable stage dependencies: {sorted(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                offset, duration = timings[name]
+                logging.info(f"Stage '{name}' took {duration:.2f}s (started at +{offset:.2f}s)")
+                if on_complete:
+                    on_complete(name, results[name])
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    logging.info(f"Stages {', '.join(stages)} finished in {time.perf_counter() - started:.2f}s")
+    return results
+
+GENERATION_MODES = ("sequential", "parallel")
+PARALLEL_CHAPTER_WORKERS = int(os.getenv("PARALLEL_CHAPTER_WORKERS", "5"))
+PARALLEL_DRAFT_CONTEXT = """Chapters of this book are being drafted at the same time. 
+                    Follow the plot outline's beats for this chapter closely, pick up where the 
+                    previous chapter's beats leave off and do not resolve events planned for later chapters."""
+
+def store_chapter(story, chapter):
+    """Add or replace a chapter, keeping story['chapters'] in chapter order"""
+    chapters = [existing for existing in story['chapters'] if existing['number'] != chapter['number']]
+    chapters.append(chapter)
+    story['chapters'] = sorted(chapters, key=lambda existing: existing['number'])
+
+def record_continuity_notes(story, notes):
+    logging.info(f"Continuity review flagged chapters {sorted(notes)}")
+    # JSON object keys are strings, keep them that way so checkpoints round-trip
+    story["continuity_notes"] = {str(number): fixes for number, fixes in notes.items()}
+
+def flagged_chapters(story):
+    """Chapters the continuity review asked to fix that have not been revised yet"""
+    notes = story["continuity_notes"]
+    return [chapter for chapter in story['chapters']
+            if str(chapter['number']) in notes and "continuity_fixes" not in chapter]
+
+def mark_revision_sources(story, revised):
+    # The fixes came from comparing this chapter with all the others
+    revised["context_chapters"] = [other['number'] for other in story['chapters']
+                                   if other['number'] != revised['number']]
+    return revised
+
+def generate_chapters_sequential(agents, story, checkpoint, on_token=None):
+    """Write chapters in order, each one seeing the bounded story-so-far
+
+    Chapters already present in the story (when resuming) are kept and only
+    feed the context. In books planned in acts, each act's chapter beats are
+    planned when its first chapter is reached.
+    """
+    with ChapterContext(agents) as context:
+        for chapter in story['chapters']:
+            context.add_chapter(chapter)
+        for chapter_num in range(len(story['chapters']) + 1, story["num_chapters"] + 1):
+            act = act_for_chapter(story, chapter_num)
+            if act is not None and act["beats"] is None:
+                act["beats"] = agents.generate_act_beats(story, act, context.build())
+                checkpoint(f"act_{act['number']}", story)
+            chapter_on_token = (lambda delta, n=chapter_num: on_token(n, delta)) if on_token else None
+            chapter = agents.generate_chapter(context.build(), chapter_outline(story), chapter_num,
+                                              on_token=chapter_on_token, plan=chapter_plan(story, chapter_num))
+            chapter["context_chapters"] = context.last_sources
+            story['chapters'].append(chapter)
+            context.add_chapter(chapter)
+            checkpoint(f"chapter_{chapter_num}", story)
+
+def generate_chapters_parallel(agents, story, checkpoint, max_workers=PARALLEL_CHAPTER_WORKERS):
+    """Draft every chapter concurrently from the outline, then reconcile continuity
+
+    Round one drafts and summarizes all chapters at once. The continuity
+    expert then reviews the summaries in a single call and only the chapters
+    it flags are revised, again concurrently. When resuming, chapters that
+    were already drafted or revised and a finished review are reused.
+    """
+    def draft(chapter_num):
+        chapter = agents.generate_chapter(PARALLEL_DRAFT_CONTEXT, story["plot_outline"], chapter_num)
+        chapter["summary"] = agents.summarize_chapter(chapter)
+        chapter["context_chapters"] = []
+        return chapter
+
+    def collect(futures, stage_prefix):
+        # Keep every chapter that succeeds so a resume only redoes the failed ones
+        errors = []
+        for future in as_completed(futures):
+            try:
+                chapter = future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            store_chapter(story, chapter)
+            checkpoint(f"{stage_prefix}{chapter['number']}", story)
+        if errors:
+            raise errors[0]
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chapter-draft")
+    try:
+        drafted = {chapter['number'] for chapter in story['chapters']}
+        futures = [executor.submit(draft, chapter_num) for chapter_num in range(1, story["num_chapters"] + 1)
+                   if chapter_num not in drafted]
+        collect(futures, "chapter_")
+
+        if story.get("continuity_notes") is None:
+            record_continuity_notes(story, agents.review_continuity(story["plot_outline"], story['chapters']))
+            checkpoint("continuity_review", story)
+        notes = story["continuity_notes"]
+        def revise(chapter):
+            return mark_revision_sources(story, agents.revise_chapter(chapter, notes[str(chapter['number'])]))
+
+        futures = [executor.submit(revise, chapter) for chapter in flagged_chapters(story)]
+        collect(futures, "revised_chapter_")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+async def agenerate_chapters_sequential(agents, story, checkpoint, on_token=None):
+    """Coroutine version of generate_chapters_sequential; checkpoint is a coroutine function"""
+    async with AsyncChapterContext(agents) as context:
+        for chapter in story['chapters']:
+            context.add_chapter(chapter)
+        for chapter_num in range(len(story['chapters']) + 1, story["num_chapters"] + 1):
+            act = act_for_chapter(story, chapter_num)
+            if act is not None and act["beats"] is None:
+                act["beats"] = await agents.agenerate_act_beats(story, act, await context.abuild())
+                await checkpoint(f"act_{act['number']}", story)
+            chapter_on_token = (lambda delta, n=chapter_num: on_token(n, delta)) if on_token else None
+            chapter = await agents.agenerate_chapter(await context.abuild(), chapter_outline(story), chapter_num,
+                                                     on_token=chapter_on_token, plan=chapter_plan(story, chapter_num))
+            chapter["context_chapters"] = context.last_sources
+            story['chapters'].append(chapter)
+            context.add_chapter(chapter)
+            await checkpoint(f"chapter_{chapter_num}", story)
+
+async def agenerate_chapters_parallel(agents, story, checkpoint, max_workers=PARALLEL_CHAPTER_WORKERS):
+    """Coroutine version of generate_chapters_parallel; max_workers bounds requests in flight per story
+
+    checkpoint is a coroutine function, as for agenerate_chapters_sequential.
+    """
+    slots = asyncio.Semaphore(max_workers)
+
+    async def draft(chapter_num):
+        async with slots:
+            chapter = await agents.agenerate_chapter(PARALLEL_DRAFT_CONTEXT, story["plot_outline"], chapter_num)
+            chapter["summary"] = await agents.asummarize_chapter(chapter)
+        chapter["context_chapters"] = []
+        return chapter
+
+    async def revise(chapter):
+        async with slots:
+            revised = await agents.arevise_chapter(chapter, story["continuity_notes"][str(chapter['number'])])
+        return mark_revision_sources(story, revised)
+
+    async def collect(coroutines, stage_prefix):
+        # Keep every chapter that succeeds so a resume only redoes the failed ones
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        errors = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    chapter = await next_done
+                except Exception as e:
+                    errors.append(e)
+                    continue
+                store_chapter(story, chapter)
+                await checkpoint(f"{stage_prefix}{chapter['number']}", story)
+        finally:
+            for task in tasks:
+                task.cancel()
+        if errors:
+            raise errors[0]
+
+    drafted = {chapter['number'] for chapter in story['chapters']}
+    await collect([draft(chapter_num) for chapter_num in range(1, story["num_chapters"] + 1)
+                   if chapter_num not in drafted], "chapter_")
+
+    if story.get("continuity_notes") is None:
+        record_continuity_notes(story, await agents.areview_continuity(story["plot_outline"], story['chapters']))
+        await checkpoint("continuity_review", story)
+    await collect([revise(chapter) for chapter in flagged_chapters(story)], "revised_chapter_")
+
+class GenerationCancelled(Exception):
+    """Raised when a story job is cancelled between generation stages"""
+    pass
+
+class StoryRun:
+    """Story state, checkpoints and cancellation for one generate_story or agenerate_story call"""
+
+    def __init__(self, title, description, num_chapters, on_progress=None, cancel_event=None,
+                 mode="sequential", use_cache=True, seed=None, story_id=None, resume=False,
+                 priority="interactive"):
+        self.agents = StoryAgents(use_cache=use_cache, seed=seed, priority=priority,
+                                  bible=book_bible(title, description))
+        self.params = {"title": title, "description": description, "num_chapters": num_chapters,
+                       "mode": mode, "use_cache": use_cache, "seed": seed, "priority": priority}
+        self.on_progress = on_progress
+        self.cancel_event = cancel_event
+        self.story_id = story_id
+        self.resume = resume
+        self.completed_stages = []
+        # Chapter records as last written to the checkpoint store, and whether they had a summary
+        self.saved_chapters = {}
+
+        # Initialize story structure
+        self.story = {
+            "title": title,
+            "description": description,
+            "plot_outline": None,
+            "num_chapters": num_chapters,
+            "mode": mode,
+            "chapters": []
+        }
+
+    def _restore(self, saved):
+        if not saved:
+            return
+        self.story = saved["story"]
+        self.completed_stages.extend(saved["stages"])
+        self.saved_chapters = {chapter["number"]: (chapter, bool(chapter.get("summary")))
+                               for chapter in self.story["chapters"]}
+        # Keep counting from what the earlier attempts already spent
+        self.agents.usage = merge_usage(self.agents.usage, self.story.get("usage", {}))
+        logging.info(f"Resuming story {self.story_id} after {len(self.completed_stages)} completed stages")
+        if self.on_progress:
+            self.on_progress("resumed", self.story)
+
+    def start(self):
+        """Load the checkpoint to resume from, or clear an earlier attempt when starting over"""
+        if self.story_id and self.resume:
+            self._restore(checkpoint_store.load(self.story_id))
+        elif self.story_id:
+            # Starting over, so chapter rows of an earlier attempt must not leak into this one
+            checkpoint_store.delete(self.story_id)
+        return self
+
+    async def astart(self):
+        """Coroutine version of start; the database runs in a worker thread, off the event loop"""
+        if self.story_id and self.resume:
+            self._restore(await asyncio.to_thread(checkpoint_store.load, self.story_id))
+        elif self.story_id:
+            await asyncio.to_thread(checkpoint_store.delete, self.story_id)
+        return self
+
+    def _snapshot(self, stage, story):
+        """Record the stage and return the serialized checkpoint, or None without a story_id"""
+        self.completed_stages.append(stage)
+        story["usage"] = dict(self.agents.usage)
+        if not self.story_id:
+            return None
+        return checkpoint_store.encode(self.story_id, self.params, self.completed_stages, story,
+                                       chapters=self._changed_chapters(story))
+
+    def _progress(self, stage, story):
+        if self.on_progress:
+            self.on_progress(stage, story)
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise GenerationCancelled(f"Generation cancelled after stage '{stage}'")
+
+    def checkpoint(self, stage, story):
+        record = self._snapshot(stage, story)
+        if record is not None:
+            checkpoint_store.write(record)
+        self._progress(stage, story)
+
+    async def acheckpoint(self, stage, story):
+        """Coroutine version of checkpoint
+
+        The story is serialized on the event loop, so the write in the worker
+        thread sees it exactly as it was at this stage.
+        """
+        record = self._snapshot(stage, story)
+        if record is not None:
+            await asyncio.to_thread(checkpoint_store.write, record)
+        self._progress(stage, story)
+
+    def _changed_chapters(self, story):
+        """Chapters that are new, replaced or got their summary since the last checkpoint"""
+        changed = []
+        for chapter in story["chapters"]:
+            state = (chapter, bool(chapter.get("summary")))
+            saved = self.saved_chapters.get(chapter["number"])
+            if saved is None or saved[0] is not chapter or saved[1] != state[1]:
+                changed.append(chapter)
+                self.saved_chapters[chapter["number"]] = state
+        return changed
+
+    def _apply(self, stage, result):
+        story = self.story
+        if stage == "outline":
+            if uses_act_outline(story["num_chapters"]):
+                story["acts"] = result
+                story["plot_outline"] = format_act_outline(result)
+            else:
+                story["plot_outline"] = result
+        elif stage == "title":
+            # Only use the improved title if it's valid and not too long
+            if result and len(result) <= 100:
+                story["original_title"] = self.params["title"]
+                story["title"] = result
+        elif stage == "blurb":
+            story["blurb"] = result
+
+    def apply_stage(self, stage, result):
+        self._apply(stage, result)
+        self.checkpoint(stage, self.story)
+
+    async def aapply_stage(self, stage, result):
+        self._apply(stage, result)
+        await self.acheckpoint(stage, self.story)
+
+    def pending(self, stages):
+        return {name: stage for name, stage in stages.items() if name not in self.completed_stages}
+
+    def finish(self):
+        self.story["usage"] = dict(self.agents.usage)
+        if self.story_id:
+            checkpoint_store.delete(self.story_id)
+        return self.story
+
+    async def afinish(self):
+        self.story["usage"] = dict(self.agents.usage)
+        if self.story_id:
+            await asyncio.to_thread(checkpoint_store.delete, self.story_id)
+        return self.story
+
+def generate_story(title, description, num_chapters, on_progress=None, cancel_event=None, on_token=None,
+                   mode="sequential", use_cache=True, seed=None, story_id=None, resume=False,
+                   priority="interactive"):
+    """Enhanced story generation with multi-agent approach
+
+    mode "sequential" writes chapters in order with a rolling context,
+    "parallel" drafts them all at once and runs a continuity pass afterwards.
+    Token streaming is only available in sequential mode. Books longer than
+    FLAT_OUTLINE_MAX_CHAPTERS are outlined as acts (story['acts']) whose
+    chapter beats are planned as the writing reaches them.
+
+    on_progress is called as on_progress(stage, story) after every completed
+    stage so callers can expose partial results. cancel_event is checked
+    between stages and aborts the run with GenerationCancelled when set.
+    on_token(chapter_number, delta) receives chapter text as it is streamed.
+    use_cache=False bypasses the completion cache; a seed keeps the cache but
+    asks for a different take on inputs that were generated before.
+
+    With a story_id every completed stage is written to the checkpoint store,
+    and resume=True continues from the last checkpoint saved under that ID
+    instead of starting over. The checkpoint is removed once the story is done.
+    priority ("interactive" or "batch") orders this story's API requests
+    against others waiting on the rate limiter.
+    """
+    run = StoryRun(title, description, num_chapters, on_progress, cancel_event, mode, use_cache, seed,
+                   story_id, resume, priority).start()
+    agents = run.agents
+
+    # Outline, title and blurb only depend on the user's input, so they run concurrently.
+    # The blurb uses the working title; the improved one rarely changes what it says.
+    outline = agents.generate_act_outline if uses_act_outline(num_chapters) else agents.generate_initial_plot_outline
+    setup_stages = run.pending({
+        "outline": (lambda: outline(title, description, num_chapters), ()),
+        "title": (lambda: agents.generate_title(description), ()),
+        "blurb": (lambda: agents.generate_blurb(title, description), ()),
+    })
+    if setup_stages:
+        run_stages(setup_stages, on_complete=run.apply_stage)
+    
+    if mode == "parallel":
+        generate_chapters_parallel(agents, run.story, run.checkpoint)
+    else:
+        generate_chapters_sequential(agents, run.story, run.checkpoint, on_token=on_token)
+    
+    return run.finish()
+
+async def agenerate_story(title, description, num_chapters, on_progress=None, cancel_event=None, on_token=None,
+                          mode="sequential", use_cache=True, seed=None, story_id=None, resume=False,
+                          priority="interactive"):
+    """Coroutine version of generate_story with the same arguments, checkpoints and result
+
+    Must run on an event loop; every request is awaited instead of holding a
+    thread, and the completion cache and checkpoint store are used from worker
+    threads so a slow SQLite write never stalls the other stories on the loop.
+    """
+    run = await StoryRun(title, description, num_chapters, on_progress, cancel_event, mode, use_cache, seed,
+                         story_id, resume, priority).astart()
+    agents = run.agents
+
+    outline = agents.agenerate_act_outline if uses_act_outline(num_chapters) else agents.agenerate_initial_plot_outline
+    setup_stages = run.pending({
+        "outline": lambda: outline(title, description, num_chapters),
+        "title": lambda: agents.agenerate_title(description),
+        "blurb": lambda: agents.agenerate_blurb(title, description),
+    })
+    started = time.perf_counter()
+    running = {asyncio.ensure_future(start()): name for name, start in setup_stages.items()}
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                await run.aapply_stage(running.pop(task), task.result())
+    finally:
+        for task in running:
+            task.cancel()
+    if setup_stages:
+        logging.info(f"Stages {', '.join(setup_stages)} finished in {time.perf_counter() - started:.2f}s")
+
+    if mode == "parallel":
+        await agenerate_chapters_parallel(agents, run.story, run.acheckpoint)
+    else:
+        await agenerate_chapters_sequential(agents, run.story, run.acheckpoint, on_token=on_token)
+
+    return await run.afinish()
+
+REGENERATE_CASCADES = ("flag", "regenerate")
+REGENERATE_FIELDS = ("title", "blurb")
+
+def dependent_chapters(story, changed_numbers):
+    """Later chapters whose prompt context drew on any of the changed chapters"""
+    changed = set(changed_numbers)
+    return [chapter['number'] for chapter in story['chapters']
+            if chapter['number'] not in changed and changed & set(chapter.get('context_chapters', []))]
+
+def regenerate_chapter(story, chapter_number, cascade="flag", seed=None, use_cache=True,
+                       on_progress=None, cancel_event=None, on_token=None):
+    """Rewrite one chapter of a finished story and deal with chapters that depended on it
+
+    The chapter is rewritten with the same bounded context the sequential
+    writer would have given it and its summary is refreshed. Summaries only
+    describe their own chapter, so other summaries stay valid. Later chapters
+    whose context included the rewritten one are marked stale with
+    cascade="flag", or rewritten in order with cascade="regenerate" (which
+    can in turn make their own dependents stale). A new seed is used unless
+    one is given, so the rewrite is not served from the completion cache.
+    """
+    agents = StoryAgents(use_cache=use_cache, seed=seed if seed is not None else random.randint(0, 2**31 - 1),
+                         bible=story_bible(story))
+    chapters = {chapter['number']: chapter for chapter in story['chapters']}
+    if chapter_number not in chapters:
+        raise ValueError(f"Story has no chapter {chapter_number}")
+
+    def rewrite(number):
+        with ChapterContext(agents) as context:
+            for earlier in story['chapters']:
+                if earlier['number'] < number:
+                    context.add_chapter(earlier)
+            chapter_on_token = (lambda delta: on_token(number, delta)) if on_token else None
+            chapter = agents.generate_chapter(context.build(), chapter_outline(story), number,
+                                              on_token=chapter_on_token, plan=chapter_plan(story, number))
+            chapter["context_chapters"] = context.last_sources
+        chapter["summary"] = agents.summarize_chapter(chapter)
+        story['chapters'] = [chapter if existing['number'] == number else existing
+                             for existing in story['chapters']]
+        if on_progress:
+            on_progress(f"chapter_{number}", story)
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled(f"Regeneration cancelled after chapter {number}")
+
+    rewrite(chapter_number)
+    changed = [chapter_number]
+    while True:
+        dependents = dependent_chapters(story, changed)
+        if not dependents:
+            break
+        if cascade != "regenerate":
+            for chapter in story['chapters']:
+                if chapter['number'] in dependents:
+                    chapter['stale'] = True
+                    chapter['stale_reason'] = (f"Written with context from chapter(s) "
+                                               f"{', '.join(str(number) for number in sorted(changed))}, "
+                                               f"which changed since")
+            break
+        # Rewrite the earliest dependent; it changes, so re-check what depends on it
+        number = min(dependents)
+        rewrite(number)
+        changed.append(number)
+
+    logging.info(f"Regenerated chapter(s) {changed} of '{story['title']}' "
+                 f"({'cascading' if cascade == 'regenerate' else 'flagging dependents'})")
+    story["usage"] = merge_usage(story.get("usage", {}), agents.usage)
+    return story
+
+def regenerate_field(story, field, seed=None, use_cache=True, on_progress=None, **kwargs):
+    """Re-roll the title or the blurb of a finished story; chapters are untouched"""
+    agents = StoryAgents(use_cache=use_cache, seed=seed if seed is not None else random.randint(0, 2**31 - 1),
+                         bible=story_bible(story))
+    original_title = story.get("original_title", story["title"])
+    if field == "title":
+        title = agents.generate_title(story["description"])
+        if title and len(title) <= 100:
+            story["original_title"] = original_title
+            story["title"] = title
+    elif field == "blurb":
+        story["blurb"] = agents.generate_blurb(original_title, story["description"])
+    else:
+        raise ValueError(f"Cannot regenerate '{field}'")
+    story["usage"] = merge_usage(story.get("usage", {}), agents.usage)
+    if on_progress:
+        on_progress(field, story)
+    return story
+
+# Structured chapter text
+BLOCK_TYPES = ("narrative", "dialogue", "scene_break")
+SCENE_BREAK = "* * *"
+DIALOGUE_OPENERS = ('"', '\u201C')
+
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n[ \t]*\n\s*')
+SCENE_BREAK_PATTERN = re.compile(r'^(?:[*#~=-]\s*){3,}$|^#$')
+MARKDOWN_PATTERN = re.compile(r'\*\*|\*|#')
+HEADING_PREFIX_PATTERN = re.compile(r'^(?:Title:\s*)?(?:Chapter\s*\d+\s*:?\s*)?')
+HEADING_QUOTED_PATTERN = re.compile(r'^["\u201C](.*)["\u201D]$')
+
+# Typographic characters the core PDF fonts cannot encode, replaced in one pass
+PDF_TRANSLATION = str.maketrans({
+    '\u2014': '-',    # em dash
+    '\u2013': '-',    # en dash
+    '\u2018': "'",    # left single quote
+    '\u2019': "'",    # right single quote
+    '\u201C': '"',    # left double quote
+    '\u201D': '"',    # right double quote
+    '\u2026': '...',  # ellipsis
+    '\u00A0': ' ',    # non-breaking space
+})
+
+def clean_heading(text):
+    """Strip markdown, surrounding quotes and 'Title:' / 'Chapter N:' prefixes from a title"""
+    text = HEADING_QUOTED_PATTERN.sub(r'\1', MARKDOWN_PATTERN.sub('', text).strip()).strip()
+    text = HEADING_PREFIX_PATTERN.sub('', text)
+    return HEADING_QUOTED_PATTERN.sub(r'\1', text).strip()
+
+def parse_chapter_text(text):
+    """Split chapter text into typed paragraph blocks with markdown removed
+
+    Each block is {"type": "narrative" | "dialogue" | "scene_break", "text": ...}.
+    Scene break markers such as '* * *', '***' or '---' become one scene_break
+    block; leading and repeated breaks are dropped.
+    """
+    blocks = []
+    for paragraph in PARAGRAPH_BREAK_PATTERN.split(text.replace('\u00A0', ' ').strip()):
+        paragraph = paragraph.strip()
+        if SCENE_BREAK_PATTERN.match(paragraph):
+            if blocks and blocks[-1]["type"] != "scene_break":
+                blocks.append({"type": "scene_break", "text": SCENE_BREAK})
+            continue
+        paragraph = MARKDOWN_PATTERN.sub('', paragraph).strip()
+        if not paragraph:
+            continue
+        block_type = "dialogue" if paragraph.startswith(DIALOGUE_OPENERS) else "narrative"
+        blocks.append({"type": block_type, "text": paragraph})
+    if blocks and blocks[-1]["type"] == "scene_break":
+        blocks.pop()
+    return blocks
+
+def blocks_to_text(blocks):
+    return '\n\n'.join(block["text"] for block in blocks)
+
+def chapter_blocks(chapter):
+    """The parsed blocks of a chapter; chapters stored before blocks existed are parsed on the fly"""
+    blocks = chapter.get("blocks")
+    return blocks if blocks is not None else parse_chapter_text(chapter["content"])
+
+def pdf_text(text):
+    return text.translate(PDF_TRANSLATION)
+
+# Exporters
+class SpooledPages(MutableMapping):
+    """fpdf page store that keeps only the page being drawn in memory
+
+    Finished pages are moved to a temporary file and read back one at a
+    time while fpdf assembles the document, so memory use does not grow
+    with the length of the book. This and PDFStreamBuffer replace fpdf
+    internals (pdf.pages, pdf.buffer), which is why requirements.txt pins
+    fpdf 1.7.2.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.index = {}
+        self.current_number = None
+        self.current = None
+
+    def __getitem__(self, number):
+        if number == self.current_number:
+            return self.current
+        offset, length = self.index[number]
+        self.file.seek(offset)
+        return self.file.read(length).decode('latin-1')
+
+    def __setitem__(self, number, text):
+        if self.current_number is not None and number != self.current_number:
+            self._spill()
+        self.current_number = number
+        self.current = text
+
+    def __delitem__(self, number):
+        if number == self.current_number:
+            self.current_number = self.current = None
+        self.index.pop(number, None)
+
+    def __iter__(self):
+        numbers = set(self.index)
+        if self.current_number is not None:
+            numbers.add(self.current_number)
+        return iter(sorted(numbers))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def _spill(self):
+        data = self.current.encode('latin-1', errors='replace')
+        self.file.seek(0, os.SEEK_END)
+        self.index[self.current_number] = (self.file.tell(), len(data))
+        self.file.write(data)
+        self.current_number = self.current = None
+
+    def close(self):
+        self.file.close()
+
+class PDFStreamBuffer:
+    """Takes the place of fpdf's output string and writes the document straight to a file"""
+
+    def __init__(self, output):
+        self.output = output
+        self.size = 0
+
+    def __iadd__(self, text):
+        data = text.encode('latin-1', errors='replace')
+        self.output.write(data)
+        self.size += len(data)
+        return self
+
+    def __len__(self):
+        # fpdf records object offsets as the length of its output so far
+        return self.size
+
+def create_pdf(story, output=None):
+    """Write the story as a PDF to a binary file object (a new BytesIO by default) and return it"""
+    output = output if output is not None else io.BytesIO()
+    pdf = None
+    try:
+        class StoryPDF(FPDF):
+            def __init__(self):
+                super().__init__()
+                self.pages = SpooledPages()
+                self.set_auto_page_break(auto=True, margin=20)
+                self.set_margins(25, 25, 25)
+                self.set_title(story["title"])
+                self.chapter_start = False
+                self.page_num_offset = 3  # Cover, blurb, TOC pages
+                self.set_font('Times', '')  # For regular text
+                self.set_font('Times', 'B')  # For bold text
+                self.set_font('Times', 'I')  # For italic text
+                
+            def header(self):
+                if self.page_no() > self.page_num_offset:
+                    if not self.chapter_start:
+                        self.set_font('Times', 'I', 10)
+                        self.set_y(10)
+                        # Alternate header placement
+                        if self.page_no() % 2 == 0:  # Even page
+                            self.cell(0, 10, story["title"], 0, 0, 'L')
+                        else:  # Odd page
+                            self.cell(0, 10, "AI Story Generator", 0, 0, 'R')
+                    self.chapter_start = False
+            
+            def footer(self):
+                if self.page_no() > self.page_num_offset:
+                    self.set_y(-15)
+                    self.set_font('Times', 'I', 10)
+                    # Centered page numbers
+                    self.cell(0, 10, str(self.page_no() - self.page_num_offset), 0, 0, 'C')
+        
+        # Initialize PDF
+        pdf = StoryPDF()
         
-        clean_story_title = sanitize_for_pdf(clean_title(story["title"]))
+        # Cover Page
+        pdf.add_page()
+        pdf.set_fill_color(240, 240, 245)
+        pdf.rect(0, 60, 210, 100, 'F')
+        pdf.ln(80)
+        pdf.set_font('Times', 'B', 26)
+        
+        clean_story_title = pdf_text(clean_heading(story["title"]))
         
         # Title formatting
         title_words = clean_story_title.split()
@@ -283,7 +2143,7 @@ def create_pdf(story):
         
         if "subtitle" in story:
             pdf.set_font('Times', 'I', 18)
-            clean_subtitle = sanitize_for_pdf(clean_title(story["subtitle"]))
+            clean_subtitle = pdf_text(clean_heading(story["subtitle"]))
             pdf.cell(0, 15, clean_subtitle, 0, 1, 'C')
             
         pdf.ln(50)
@@ -298,7 +2158,7 @@ def create_pdf(story):
         pdf.set_font('Times', '', 12)
         
         if "blurb" in story:
-            sanitized_blurb = sanitize_for_pdf(story["blurb"])
+            sanitized_blurb = pdf_text(story["blurb"])
             blurb_paragraphs = sanitized_blurb.split('\n\n')
             for para in blurb_paragraphs:
                 if para.strip():
@@ -312,10 +2172,8 @@ def create_pdf(story):
         pdf.ln(10)
         pdf.set_font('Times', '', 12)
         
-        for chapter in story["chapters"]:
-            clean_chapter_title = sanitize_for_pdf(clean_title(chapter['title']))
-            chapter['title'] = clean_chapter_title
-            
+        chapter_titles = [pdf_text(clean_heading(chapter['title'])) for chapter in story["chapters"]]
+        for chapter, clean_chapter_title in zip(story["chapters"], chapter_titles):
             chapter_text = f"Chapter {chapter['number']}: {clean_chapter_title}"
             text_width = pdf.get_string_width(chapter_text)
             page_text = str(chapter['number'] + 3)
@@ -335,7 +2193,7 @@ def create_pdf(story):
             pdf.cell(page_width, 8, page_text, 0, 1, 'R')
         
         # Chapters
-        for chapter in story["chapters"]:
+        for chapter, clean_chapter_title in zip(story["chapters"], chapter_titles):
             pdf.chapter_start = True
             pdf.add_page()
             
@@ -343,32 +2201,25 @@ def create_pdf(story):
             pdf.cell(0, 15, f"Chapter {chapter['number']}", 0, 1, 'C')
             
             pdf.set_font('Times', 'B', 16)
-            pdf.cell(0, 10, chapter['title'], 0, 1, 'C')
+            pdf.cell(0, 10, clean_chapter_title, 0, 1, 'C')
             
             pdf.line(pdf.w/4, pdf.y + 5, 3*pdf.w/4, pdf.y + 5)
             pdf.ln(15)
             
-            sanitized_content = sanitize_for_pdf(chapter['content'])
-            paragraphs = re.split(r'\n\n+', sanitized_content)
-            
             pdf.set_font('Times', '', 12)
             
-            for paragraph in paragraphs:
-                paragraph = paragraph.strip()
-                if not paragraph:
-                    continue
-                
-                if paragraph.startswith('"') or paragraph.startswith('"'):
-                    pdf.multi_cell(0, 6, paragraph)
-                elif paragraph.strip() == "* * *" or paragraph.strip() == "***":
+            for block in chapter_blocks(chapter):
+                if block["type"] == "dialogue":
+                    pdf.multi_cell(0, 6, pdf_text(block["text"]))
+                elif block["type"] == "scene_break":
                     pdf.ln(4)
                     pdf.set_font('Times', 'B', 12)
-                    pdf.cell(0, 6, "* * *", 0, 1, 'C')
+                    pdf.cell(0, 6, SCENE_BREAK, 0, 1, 'C')
                     pdf.ln(4)
                     pdf.set_font('Times', '', 12)
                 else:
                     pdf.set_left_margin(pdf.l_margin + 10)
-                    pdf.multi_cell(0, 6, paragraph, align='J')
+                    pdf.multi_cell(0, 6, pdf_text(block["text"]), align='J')
                     pdf.set_left_margin(pdf.l_margin - 10)
                 
                 pdf.ln(4)
@@ -382,156 +2233,1586 @@ def create_pdf(story):
         pdf.set_font('Times', 'I', 16)
         pdf.cell(0, 10, "* * *", 0, 1, 'C')
         
-        # Save to buffer
-        buffer = io.BytesIO()
-        pdf_output = pdf.output(dest='S').encode('latin-1', errors='replace')
-        buffer.write(pdf_output)
-        buffer.seek(0)
-        return buffer
+        # Write the document to the output as it is assembled
+        pdf.buffer = PDFStreamBuffer(output)
+        pdf.close()
+        output.seek(0)
+        return output
         
     except Exception as e:
         import traceback
         logging.error(f"PDF generation failed: {str(e)}")
         logging.error(traceback.format_exc())
         raise
+    finally:
+        if pdf is not None:
+            pdf.pages.close()
 
-def create_docx(story):
-    doc = Document()
-    
-    # Set document margins and page setup
-    sections = doc.sections
-    for section in sections:
-        section.top_margin = Inches(1)
-        section.bottom_margin = Inches(1)
-        section.left_margin = Inches(1)
-        section.right_margin = Inches(1)
-        
-        section.different_first_page_header_footer = True
-        section.header.is_linked_to_previous = False
-        section.footer.is_linked_to_previous = False
-    
-    # Custom header for pages after first page
-    for section in sections:
-        first_page_header = section.first_page_header
-        first_page_header.is_linked_to_previous = False
-        
-        default_header = section.header
-        default_header.is_linked_to_previous = False
-        
-        if default_header:
-            for i, paragraph in enumerate(default_header.paragraphs):
-                paragraph.text = story["title"] if i % 2 == 0 else "AI Story Generator"
-                paragraph.alignment = (WD_ALIGN_PARAGRAPH.LEFT 
-                                       if i % 2 == 0 
-                                       else WD_ALIGN_PARAGRAPH.RIGHT)
-    
-    # Cover page
-    title_para = doc.add_paragraph()
-    title_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    title_run = title_para.add_run(story["title"])
-    title_run.font.size = Pt(24)
-    title_run.font.bold = True
-    
-    # Subtitle with improved styling
-    if "subtitle" in story and story["subtitle"]:
-        subtitle_para = doc.add_paragraph()
-        subtitle_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        subtitle_run = subtitle_para.add_run(story["subtitle"])
-        subtitle_run.italic = True
-        subtitle_run.font.size = Pt(16)
-    
-    # Add page break after cover
-    doc.add_page_break()
+# Styles of the DOCX template, defined once instead of formatting every run
+DOCX_PARAGRAPH_STYLES = {
+    # name: (base style, point size, bold, italic, alignment, first line indent, space before, space after)
+    "Cover Title": ("Normal", 24, True, False, WD_ALIGN_PARAGRAPH.CENTER, None, None, None),
+    "Cover Subtitle": ("Normal", 16, False, True, WD_ALIGN_PARAGRAPH.CENTER, None, None, None),
+    "Book Heading": ("Heading 1", None, False, False, WD_ALIGN_PARAGRAPH.CENTER, None, None, None),
+    "Blurb": ("Normal", None, False, False, WD_ALIGN_PARAGRAPH.JUSTIFY, None, None, None),
+    "Chapter Title": ("Normal", 14, True, False, WD_ALIGN_PARAGRAPH.CENTER, None, None, None),
+    "Chapter Rule": ("Normal", None, False, False, WD_ALIGN_PARAGRAPH.CENTER, None, None, None),
+    "Story Narrative": ("Normal", 12, False, False, WD_ALIGN_PARAGRAPH.JUSTIFY, Inches(0.3), None, Pt(6)),
+    "Story Dialogue": ("Story Narrative", None, False, False, WD_ALIGN_PARAGRAPH.LEFT, Inches(0), None, None),
+    "Scene Break": ("Story Narrative", None, False, False, WD_ALIGN_PARAGRAPH.CENTER, Inches(0), Pt(12), None),
+    "The End": ("Normal", 16, True, False, WD_ALIGN_PARAGRAPH.CENTER, None, None, None),
+    "toc 1": ("Normal", None, False, False, None, None, None, None),
+}
+DOCX_BLOCK_STYLES = {"narrative": "StoryNarrative", "dialogue": "StoryDialogue", "scene_break": "SceneBreak"}
+DOCX_TOC_BOOKMARK = "_TocChapter{}"
+XML_INVALID_PATTERN = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+_docx_template = None
+_docx_template_lock = threading.Lock()
+
+def docx_template():
+    """Bytes of an empty book with page setup, headers and named styles, built once per process"""
+    global _docx_template
+    with _docx_template_lock:
+        if _docx_template is not None:
+            return _docx_template
+        doc = Document()
+        for section in doc.sections:
+            section.top_margin = Inches(1)
+            section.bottom_margin = Inches(1)
+            section.left_margin = Inches(1)
+            section.right_margin = Inches(1)
+            
+            # Blank first page header, the book title in the header of every other page
+            section.different_first_page_header_footer = True
+            section.first_page_header.is_linked_to_previous = False
+            section.header.is_linked_to_previous = False
+            section.footer.is_linked_to_previous = False
+            section.header.paragraphs[0].alignment = WD_ALIGN_PARAGRAPH.LEFT
+
+        for name, (base, size, bold, italic, alignment, indent, before, after) in DOCX_PARAGRAPH_STYLES.items():
+            style = doc.styles.add_style(name, WD_STYLE_TYPE.PARAGRAPH)
+            style.base_style = doc.styles[base]
+            if size:
+                style.font.size = Pt(size)
+            if bold:
+                style.font.bold = True
+            if italic:
+                style.font.italic = True
+            paragraph_format = style.paragraph_format
+            if alignment is not None:
+                paragraph_format.alignment = alignment
+            if indent is not None:
+                paragraph_format.first_line_indent = indent
+            if before is not None:
+                paragraph_format.space_before = before
+            if after is not None:
+                paragraph_format.space_after = after
+        # Front matter headings share the chapter heading look but stay out of the outline
+        doc.styles["Book Heading"].element.get_or_add_pPr().append(parse_xml(f'<w:outlineLvl {nsdecls("w")} w:val="9"/>'))
+        doc.styles["toc 1"].paragraph_format.tab_stops.add_tab_stop(Inches(6), alignment=WD_PARAGRAPH_ALIGNMENT.RIGHT)
+
+        # Ask Word to refresh the table of contents and page references when the file is opened
+        doc.settings.element.insert_element_before(
+            parse_xml(f'<w:updateFields {nsdecls("w")} w:val="true"/>'),
+            'w:hdrShapeDefaults', 'w:footnotePr', 'w:endnotePr', 'w:compat', 'w:docVars', 'w:rsids'
+        )
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        _docx_template = buffer.getvalue()
+        return _docx_template
+
+def docx_text(text):
+    """Escaped w:t content; newlines and tabs become w:br and w:tab as python-docx add_run() does"""
+    text = escape(XML_INVALID_PATTERN.sub('', text))
+    text = text.replace('\t', '</w:t><w:tab/><w:t xml:space="preserve">')
+    return text.replace('\r\n', '\n').replace('\n', '</w:t><w:br/><w:t xml:space="preserve">')
+
+def docx_paragraph(style, text, extra=''):
+    return (f'<w:p><w:pPr><w:pStyle w:val="{style}"/></w:pPr>{extra}'
+            f'<w:r><w:t xml:space="preserve">{docx_text(text)}</w:t></w:r></w:p>')
+
+def docx_field(instruction, result=''):
+    return (f'<w:r><w:fldChar w:fldCharType="begin"/></w:r>'
+            f'<w:r><w:instrText xml:space="preserve"> {escape(instruction)} </w:instrText></w:r>'
+            f'<w:r><w:fldChar w:fldCharType="separate"/></w:r>'
+            f'<w:r><w:t xml:space="preserve">{escape(result)}</w:t></w:r>'
+            f'<w:r><w:fldChar w:fldCharType="end"/></w:r>')
+
+DOCX_PAGE_BREAK = '<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+def docx_toc(entries):
+    """A TOC field built from the chapters' TC entries
+
+    The cached result lists every chapter with a PAGEREF to its heading, so
+    the page numbers are real once fields are updated (Word does this on
+    open, LibreOffice resolves PAGEREF itself).
+    """
+    begin = (f'<w:r><w:fldChar w:fldCharType="begin"/></w:r>'
+             f'<w:r><w:instrText xml:space="preserve"> TOC \\f \\l "1-1" \\h \\z </w:instrText></w:r>'
+             f'<w:r><w:fldChar w:fldCharType="separate"/></w:r>')
+    end = '<w:r><w:fldChar w:fldCharType="end"/></w:r>'
+    if not entries:
+        return f'<w:p><w:pPr><w:pStyle w:val="toc1"/></w:pPr>{begin}{end}</w:p>'
+    paragraphs = []
+    for index, (bookmark, text) in enumerate(entries):
+        page_reference = docx_field(f"PAGEREF {bookmark} \\h")
+        paragraphs.append(
+            f'<w:p><w:pPr><w:pStyle w:val="toc1"/></w:pPr>{begin if index == 0 else ""}'
+            f'<w:hyperlink w:anchor="{bookmark}" w:history="1">'
+            f'<w:r><w:t xml:space="preserve">{docx_text(text)}</w:t></w:r><w:r><w:tab/></w:r>'
+            f'{page_reference}</w:hyperlink>'
+            f'{end if index == len(entries) - 1 else ""}</w:p>'
+        )
+    return ''.join(paragraphs)
+
+def docx_chapter(chapter, index, title):
+    """Markup of one chapter: heading with bookmark and TC entry, title, rule and body blocks"""
+    bookmark = DOCX_TOC_BOOKMARK.format(index)
+    entry = f"Chapter {chapter['number']}: {title}".replace('"', '\\"')
+    parts = [
+        f'<w:p><w:pPr><w:pStyle w:val="BookHeading"/><w:outlineLvl w:val="0"/></w:pPr>'
+        f'<w:bookmarkStart w:id="{index}" w:name="{bookmark}"/>'
+        f'<w:r><w:t xml:space="preserve">Chapter {chapter["number"]}</w:t></w:r>'
+        f'<w:bookmarkEnd w:id="{index}"/>'
+        f'<w:r><w:fldChar w:fldCharType="begin"/></w:r>'
+        f'<w:r><w:instrText xml:space="preserve"> TC "{docx_text(entry)}" \\l 1 </w:instrText></w:r>'
+        f'<w:r><w:fldChar w:fldCharType="end"/></w:r></w:p>',
+        docx_paragraph("ChapterTitle", title),
+        docx_paragraph("ChapterRule", "__________________"),
+    ]
+    for block in chapter_blocks(chapter):
+        parts.append(docx_paragraph(DOCX_BLOCK_STYLES[block["type"]], block["text"]))
+    return ''.join(parts)
+
+def create_docx(story, output=None):
+    """Write the story as a DOCX to a binary file object (a new BytesIO by default) and return it
+
+    The document starts from the cached template, and its body is emitted as
+    WordprocessingML in bulk, one chapter at a time, instead of building
+    every paragraph and run through python-docx.
+    """
+    doc = Document(io.BytesIO(docx_template()))
+    doc.sections[0].header.paragraphs[0].text = story["title"]
+    body = doc.element.body
+
+    def append(markup):
+        for element in list(parse_xml(f'<w:body {nsdecls("w")}>{markup}</w:body>')):
+            body.sectPr.addprevious(element)
+
+    chapter_titles = [clean_heading(chapter['title']) for chapter in story["chapters"]]
     
-    # Blurb page with improved formatting
+    # Cover page, blurb and table of contents
+    front = [docx_paragraph("CoverTitle", story["title"])]
+    if story.get("subtitle"):
+        front.append(docx_paragraph("CoverSubtitle", story["subtitle"]))
+    front.append(DOCX_PAGE_BREAK)
     if "blurb" in story:
-        blurb_heading = doc.add_heading("About This Book", 1)
-        blurb_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        
-        blurb_para = doc.add_paragraph()
-        blurb_para.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-        blurb_para.add_run(story["blurb"])
-        doc.add_page_break()
+        front.append(docx_paragraph("BookHeading", "About This Book"))
+        front.append(docx_paragraph("Blurb", story["blurb"]))
+        front.append(DOCX_PAGE_BREAK)
+    front.append(docx_paragraph("BookHeading", "Contents"))
+    front.append(docx_toc([
+        (DOCX_TOC_BOOKMARK.format(index), f"Chapter {chapter['number']}: {title}")
+        for index, (chapter, title) in enumerate(zip(story["chapters"], chapter_titles))
+    ]))
+    front.append(DOCX_PAGE_BREAK)
+    append(''.join(front))
     
-    # Table of Contents with improved formatting
-    toc_heading = doc.add_heading("Contents", 1)
-    toc_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    # Chapters, with a page break between them
+    for index, (chapter, title) in enumerate(zip(story["chapters"], chapter_titles)):
+        markup = docx_chapter(chapter, index, title)
+        if index < len(story["chapters"]) - 1:
+            markup += DOCX_PAGE_BREAK
+        append(markup)
     
-    for idx, chapter in enumerate(story["chapters"]):
-        toc_entry = doc.add_paragraph()
-        toc_entry.add_run(f"Chapter {chapter['number']}: {chapter['title']}")
-        
-        toc_entry.add_run("\t")
-        toc_entry.add_run(str(idx + 4))
-        
-        paragraph_format = toc_entry.paragraph_format
-        paragraph_format.tab_stops.add_tab_stop(Inches(6), alignment=WD_PARAGRAPH_ALIGNMENT.RIGHT)
+    # End page
+    append(DOCX_PAGE_BREAK + docx_paragraph("TheEnd", "The End"))
     
-    # Add page break after TOC
-    doc.add_page_break()
+    # Save to the output
+    output = output if output is not None else io.BytesIO()
+    doc.save(output)
+    output.seek(0)
     
-    # Chapter generation
-    for chapter in story["chapters"]:
-        chapter_heading = doc.add_heading(f"Chapter {chapter['number']}", 1)
-        chapter_heading.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        
-        title_para = doc.add_paragraph()
-        title_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        title_run = title_para.add_run(chapter['title'])
-        title_run.bold = True
-        title_run.font.size = Pt(14)
-        
-        line_para = doc.add_paragraph()
-        line_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        line_para.add_run("__________________")
-        
-        paragraphs = chapter["content"].split('\n\n')
-        for paragraph in paragraphs:
-            paragraph = paragraph.strip()
-            if not paragraph:
+    return output
+
+# Streaming exporters
+EXPORT_CSS = """body { font-family: Georgia, serif; line-height: 1.5; margin: 0 auto; max-width: 40em; padding: 0 1em; }
+h1, h2, h3, .cover, .scene-break, .the-end { text-align: center; }
+.chapter, .contents, .about { break-before: page; page-break-before: always; }
+.chapter > p { text-align: justify; text-indent: 1.5em; margin: 0 0 0.4em; }
+.chapter > p.dialogue { text-align: left; text-indent: 0; }
+.chapter > p.scene-break { text-indent: 0; margin: 1em 0; }
+.contents ol { list-style: none; padding: 0; }
+.pager { display: flex; justify-content: space-between; margin: 2em 0; }
+@media print { .pager { display: none; } }
+"""
+HTML_BLOCK_CLASSES = {"narrative": "", "dialogue": ' class="dialogue"', "scene_break": ' class="scene-break"'}
+
+def html_text(text):
+    return escape(XML_INVALID_PATTERN.sub('', text), {'"': '&quot;'})
+
+def html_blocks(chapter):
+    return ''.join(f'<p{HTML_BLOCK_CLASSES[block["type"]]}>{html_text(block["text"])}</p>\n'
+                   for block in chapter_blocks(chapter))
+
+def html_front_matter(story):
+    """Cover and blurb markup shared by the HTML and EPUB exports"""
+    parts = [f'<section class="cover"><h1>{html_text(story["title"])}</h1>']
+    if story.get("subtitle"):
+        parts.append(f'<h2>{html_text(story["subtitle"])}</h2>')
+    parts.append('</section>\n')
+    if story.get("blurb"):
+        parts.append(f'<section class="about"><h2>About This Book</h2><p>{html_text(story["blurb"])}</p></section>\n')
+    return ''.join(parts)
+
+def stream_html(story):
+    """Yield the story as one HTML document, chapter by chapter
+
+    Each chapter is its own page: a print page break before it and
+    previous/next links for the web preview.
+    """
+    chapters = story["chapters"]
+    titles = [clean_heading(chapter["title"]) for chapter in chapters]
+    contents = ''.join(f'<li><a href="#chapter-{chapter["number"]}">Chapter {chapter["number"]}: {html_text(title)}</a></li>'
+                       for chapter, title in zip(chapters, titles))
+    yield (f'<!DOCTYPE html>\n<html lang="en"><head><meta charset="utf-8">'
+           f'<meta name="viewport" content="width=device-width, initial-scale=1">'
+           f'<title>{html_text(story["title"])}</title><style>{EXPORT_CSS}</style></head><body>\n'
+           f'{html_front_matter(story)}'
+           f'<nav class="contents" id="contents"><h2>Contents</h2><ol>{contents}</ol></nav>\n').encode('utf-8')
+    for index, (chapter, title) in enumerate(zip(chapters, titles)):
+        previous = f'#chapter-{chapters[index - 1]["number"]}' if index > 0 else '#contents'
+        following = f'#chapter-{chapters[index + 1]["number"]}' if index < len(chapters) - 1 else '#the-end'
+        yield (f'<section class="chapter" id="chapter-{chapter["number"]}">'
+               f'<h2>Chapter {chapter["number"]}</h2><h3>{html_text(title)}</h3>\n'
+               f'{html_blocks(chapter)}'
+               f'<nav class="pager"><a href="{previous}">Previous</a><a href="#contents">Contents</a>'
+               f'<a href="{following}">Next</a></nav></section>\n').encode('utf-8')
+    yield '<section class="chapter the-end" id="the-end"><h2>The End</h2></section>\n</body></html>\n'.encode('utf-8')
+
+class ZipChunkStream:
+    """Write-only file for zipfile that hands the archive out in chunks as it grows
+
+    zipfile seeks back to fill in an entry's sizes and checksum once the
+    entry is written, so written bytes are kept until take() is called
+    between entries. Only the entry being written is ever held in memory.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.sent = 0
+        self.position = 0
+
+    def write(self, data):
+        start = self.position - self.sent
+        self.buffer[start:start + len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.sent + len(self.buffer)
+        if offset < self.sent:
+            raise io.UnsupportedOperation("Cannot seek back into data that has been sent")
+        self.position = offset
+        return offset
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """Return the bytes written since the last call"""
+        data = bytes(self.buffer)
+        self.sent += len(data)
+        self.buffer.clear()
+        return data
+
+def epub_document(title, body):
+    return (f'<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            f'<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en">'
+            f'<head><meta charset="utf-8"/><title>{html_text(title)}</title>'
+            f'<link rel="stylesheet" type="text/css" href="styles.css"/></head><body>\n{body}</body></html>\n')
+
+def epub_package(story, titles, identifier):
+    """The OPF package document, NCX table of contents and EPUB 3 navigation document"""
+    chapters = story["chapters"]
+    names = [f'chapter-{chapter["number"]}.xhtml' for chapter in chapters]
+    entries = [f'Chapter {chapter["number"]}: {title}' for chapter, title in zip(chapters, titles)]
+    modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    opf = (f'<?xml version="1.0" encoding="utf-8"?>\n'
+           f'<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id">'
+           f'<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+           f'<dc:identifier id="book-id">{identifier}</dc:identifier>'
+           f'<dc:title>{html_text(story["title"])}</dc:title><dc:language>en</dc:language>'
+           f'<meta property="dcterms:modified">{modified}</meta></metadata><manifest>'
+           f'<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+           f'<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+           f'<item id="css" href="styles.css" media-type="text/css"/>'
+           f'<item id="cover" href="cover.xhtml" media-type="application/xhtml+xml"/>'
+           + ''.join(f'<item id="c{index}" href="{name}" media-type="application/xhtml+xml"/>'
+                     for index, name in enumerate(names))
+           + '<item id="end" href="end.xhtml" media-type="application/xhtml+xml"/>'
+           f'</manifest><spine toc="ncx"><itemref idref="cover"/><itemref idref="nav"/>'
+           + ''.join(f'<itemref idref="c{index}"/>' for index in range(len(names)))
+           + '<itemref idref="end"/></spine></package>\n')
+    ncx = (f'<?xml version="1.0" encoding="utf-8"?>\n'
+           f'<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+           f'<head><meta name="dtb:uid" content="{identifier}"/></head>'
+           f'<docTitle><text>{html_text(story["title"])}</text></docTitle><navMap>'
+           + ''.join(f'<navPoint id="n{index}" playOrder="{index + 1}"><navLabel><text>{html_text(entry)}</text>'
+                     f'</navLabel><content src="{name}"/></navPoint>'
+                     for index, (name, entry) in enumerate(zip(names, entries)))
+           + '</navMap></ncx>\n')
+    nav = epub_document("Contents", '<nav epub:type="toc" id="toc"><h2>Contents</h2><ol>'
+                        + ''.join(f'<li><a href="{name}">{html_text(entry)}</a></li>'
+                                  for name, entry in zip(names, entries))
+                        + '</ol></nav>\n')
+    return opf, ncx, nav
+
+EPUB_CONTAINER = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                  '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                  '</rootfiles></container>\n')
+
+def stream_epub(story):
+    """Yield the story as an EPUB 3 archive, one zip entry at a time
+
+    Each chapter is serialized, compressed and sent before the next one is
+    read, so memory use stays flat however long the book is.
+    """
+    stream = ZipChunkStream()
+    titles = [clean_heading(chapter["title"]) for chapter in story["chapters"]]
+    # Stable across regenerated chapters, so e-readers keep the reading position of the book
+    identifier = f'urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, story["title"] + chr(10) + (story.get("description") or ""))}'
+    opf, ncx, nav = epub_package(story, titles, identifier)
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # The mimetype entry must come first and be stored uncompressed
+        archive.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        archive.writestr('META-INF/container.xml', EPUB_CONTAINER)
+        archive.writestr('OEBPS/content.opf', opf)
+        archive.writestr('OEBPS/toc.ncx', ncx)
+        archive.writestr('OEBPS/nav.xhtml', nav)
+        archive.writestr('OEBPS/styles.css', EXPORT_CSS)
+        archive.writestr('OEBPS/cover.xhtml', epub_document(story["title"], html_front_matter(story)))
+        yield stream.take()
+        for chapter, title in zip(story["chapters"], titles):
+            archive.writestr(f'OEBPS/chapter-{chapter["number"]}.xhtml', epub_document(
+                title,
+                f'<section class="chapter"><h2>Chapter {chapter["number"]}</h2><h3>{html_text(title)}</h3>\n'
+                f'{html_blocks(chapter)}</section>\n'
+            ))
+            yield stream.take()
+        archive.writestr('OEBPS/end.xhtml', epub_document("The End", '<section class="the-end"><h2>The End</h2></section>\n'))
+    yield stream.take()
+
+# Rendered export cache
+ARTIFACT_CACHE_DIR = os.getenv("ARTIFACT_CACHE_DIR", os.path.join(CACHE_DIR, "artifacts"))
+ARTIFACT_DISK_CACHE_BYTES = int(os.getenv("ARTIFACT_DISK_CACHE_BYTES", str(1024 * 1024 * 1024)))
+
+EXPORT_MIMETYPES = {
+    'pdf': 'application/pdf',
+    'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'epub': 'application/epub+zip',
+    'html': 'text/html',
+}
+
+EXPORTERS = {
+    'pdf': create_pdf,
+    'docx': create_docx,
+}
+
+# Written while they are sent, so these formats are neither cached nor rendered in the process pool
+STREAMING_EXPORTERS = {
+    'epub': stream_epub,
+    'html': stream_html,
+}
+
+def story_fingerprint(story, format_type):
+    """Content hash of everything an exporter reads from a story"""
+    normalized = {
+        "format": format_type,
+        "title": story.get("title"),
+        "subtitle": story.get("subtitle"),
+        "blurb": story.get("blurb"),
+        "chapters": [
+            {"number": chapter["number"], "title": chapter["title"], "content": chapter["content"],
+             "blocks": chapter.get("blocks")}
+            for chapter in story.get("chapters", [])
+        ],
+    }
+    payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ArtifactCache:
+    """LRU cache of rendered export files under ARTIFACT_CACHE_DIR
+
+    Exports are rendered straight into the cache directory and served from
+    there, so no web worker ever holds a whole book in memory; hot files
+    stay in the OS page cache. The directory is bounded in bytes and the
+    file modification time serves as the last-access time.
+    """
+
+    def __init__(self, directory=ARTIFACT_CACHE_DIR, disk_bytes=ARTIFACT_DISK_CACHE_BYTES):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def open(self, key):
+        """Return the cached export as an open binary file, or None"""
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return f
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.disk_bytes:
+            return
+        for _, size, path in sorted(entries):
+            if total <= self.disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+artifact_cache = ArtifactCache()
+
+# Export rendering process pool
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(4, os.cpu_count() or 1))))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "16"))
+RENDER_QUEUE_TIMEOUT = float(os.getenv("RENDER_QUEUE_TIMEOUT", "30"))
+PRERENDER_EXPORTS = os.getenv("PRERENDER_EXPORTS", "1") == "1"
+
+class RenderQueueFull(Exception):
+    """Raised when no render slot frees up within RENDER_QUEUE_TIMEOUT"""
+    pass
+
+def _render_export(story, format_type, path):
+    """Process pool entry point: render one export to path and return the render time
+
+    The file is written under a temporary name and renamed when complete,
+    so readers never see a partial export.
+    """
+    started = time.perf_counter()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            EXPORTERS[format_type](story, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return time.perf_counter() - started
+
+class ExportRenderer:
+    """Renders exports in worker processes, outside the GIL of the web workers
+
+    At most workers + queue_size renders are in flight or waiting; further
+    requests wait for a slot up to RENDER_QUEUE_TIMEOUT. Concurrent requests
+    for the same export share one render, which the worker writes straight
+    into the artifact cache directory.
+    """
+
+    def __init__(self, workers=RENDER_WORKERS, queue_size=RENDER_QUEUE_SIZE):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.executor = None
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created lazily and via forkserver/spawn, since forking a threaded web worker is unsafe
+        if self.executor is None:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+        return self.executor
+
+    def submit(self, story, format_type, key, block=True, timeout=RENDER_QUEUE_TIMEOUT):
+        """Queue a render and return its future, or None if non-blocking and the queue is full
+
+        timeout=None waits for a render slot indefinitely.
+        """
+        with self.lock:
+            if key in self.inflight:
+                return self.inflight[key]
+
+        acquired = self.slots.acquire(timeout=timeout) if block else self.slots.acquire(blocking=False)
+        if not acquired:
+            if block:
+                raise RenderQueueFull("The export queue is full, please try again shortly")
+            return None
+
+        with self.lock:
+            if key in self.inflight:
+                self.slots.release()
+                return self.inflight[key]
+            try:
+                future = self._get_executor().submit(_render_export, story, format_type, artifact_cache.path(key))
+            except BaseException:
+                self.slots.release()
+                raise
+            self.inflight[key] = future
+        submitted = time.perf_counter()
+        future.add_done_callback(lambda done: self._finished(key, format_type, done, submitted))
+        return future
+
+    def _finished(self, key, format_type, future, submitted):
+        self.slots.release()
+        with self.lock:
+            self.inflight.pop(key, None)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            seconds = future.result()
+            metrics.observe("export_render_seconds", seconds, format=format_type)
+            metrics.observe("export_queue_seconds", max(0.0, time.perf_counter() - submitted - seconds),
+                            format=format_type)
+            artifact_cache.evict()
+        else:
+            logging.error(f"{format_type.upper()} render {key[:12]} failed: {error}")
+            if isinstance(error, BrokenProcessPool):
+                with self.lock:
+                    self.executor = None
+
+    def prerender(self, story):
+        """Start rendering every format in the background so downloads are ready when requested"""
+        for format_type in EXPORTERS:
+            key = story_fingerprint(story, format_type)
+            if artifact_cache.contains(key):
                 continue
-            
-            p = doc.add_paragraph()
-            
-            if paragraph.startswith('"') or paragraph.startswith('"'):
-                p.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                p.add_run(paragraph)
-            
-            elif paragraph.strip() == "* * *" or paragraph.strip() == "***":
-                p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-                p.add_run("* * *")
-                p.paragraph_format.space_before = Pt(12)
-                p.paragraph_format.space_after = Pt(12)
-            
-            else:
-                p.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
-                p.paragraph_format.first_line_indent = Inches(0.3)
-                p.add_run(paragraph)
-            
-            for run in p.runs:
-                run.font.size = Pt(12)
-            
-            p.paragraph_format.space_after = Pt(6)
-        
-        # Page break between chapters
-        if chapter != story["chapters"][-1]:
-            doc.add_page_break()
-    
-    # End page
-    doc.add_page_break()
-    end_para = doc.add_paragraph()
-    end_para.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    end_para.space_before = Pt(200)
-    end_run = end_para.add_run("The End")
-    end_run.bold = True
-    end_run.font.size = Pt(16)
-    
-    # Save to buffer
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
+            if self.submit(story, format_type, key, block=False) is None:
+                logging.info(f"Render queue full, skipping pre-render of {format_type.upper()} {key[:12]}")
+
+export_renderer = ExportRenderer()
+
+def invalidate_exports(story):
+    """Drop cached renders of a story version that has been replaced"""
+    for format_type in EXPORTERS:
+        artifact_cache.discard(story_fingerprint(story, format_type))
+
+def render_story(story, format_type, key=None, queue_timeout=RENDER_QUEUE_TIMEOUT):
+    """Return the rendered export as an open binary file, rendering it first if it is not cached"""
+    key = key or story_fingerprint(story, format_type)
+    f = artifact_cache.open(key)
+    if f is not None:
+        logging.info(f"Serving cached {format_type.upper()} export {key[:12]}")
+        metrics.inc("export_cache_hits_total", format=format_type)
+        return f
+    export_renderer.submit(story, format_type, key, timeout=queue_timeout).result()
+    f = artifact_cache.open(key)
+    if f is None:
+        raise RuntimeError(f"{format_type.upper()} export {key[:12]} was evicted before it could be sent")
+    return f
+
+def send_story_file(story, format_type):
+    """Render a story in the requested format and send it as an attachment
+
+    The ETag is the story's content hash, so a client that already holds the
+    file gets a 304 without anything being rendered or read from the cache.
+    """
+    if format_type not in EXPORTERS and format_type not in STREAMING_EXPORTERS:
+        return jsonify({"status": "error", "message": "Invalid format specified"}), 400
+
+    etag = story_fingerprint(story, format_type)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    if format_type in STREAMING_EXPORTERS:
+        return stream_story_file(story, format_type, etag)
+
+    try:
+        f = render_story(story, format_type, key=etag)
+    except RenderQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        logging.error(f"{format_type.upper()} generation failed: {error_details}")
+        return jsonify({"status": "error", "message": f"{format_type.upper()} generation failed: {str(e)}"}), 500
+
+    # Streamed from disk in blocks; the response closes the file when it is done
+    response = send_file(
+        f,
+        mimetype=EXPORT_MIMETYPES[format_type],
+        as_attachment=True,
+        download_name=f"{story['title'].replace(' ', '_')}.{format_type}",
+        etag=etag
+    )
+    response.content_length = os.fstat(f.fileno()).st_size
+    return response
+
+def stream_story_file(story, format_type, etag):
+    """Send a streaming export as a chunked response while it is being written"""
+    def generate():
+        started = time.perf_counter()
+        try:
+            yield from STREAMING_EXPORTERS[format_type](story)
+        except Exception:
+            # Headers are already sent, so the client sees a truncated download
+            logging.exception(f"{format_type.upper()} export failed while streaming")
+            raise
+        metrics.observe("export_render_seconds", time.perf_counter() - started, format=format_type)
+
+    filename = f"{story['title'].replace(' ', '_')}.{format_type}"
+    response = Response(generate(), mimetype=EXPORT_MIMETYPES[format_type])
+    fallback = filename.encode('ascii', 'ignore').decode().replace('"', '').replace('\\', '')
+    response.headers['Content-Disposition'] = (f'attachment; filename="{fallback}"; '
+                                               f"filename*=UTF-8''{urllib.parse.quote(filename)}")
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.set_etag(etag)
+    return response
+
+# Input validation
+MAX_CHAPTERS = int(os.getenv("MAX_CHAPTERS", "150"))
+
+def validate_story_request(data):
+    """Check title, description and num_chapters; returns (params, error message)"""
+    title = str(data.get('title') or '').strip()
+    description = str(data.get('description') or '').strip()
+    try:
+        num_chapters = int(data.get('num_chapters', 3))
+    except (TypeError, ValueError):
+        return None, "Number of chapters must be a whole number"
+    mode = data.get('mode') or 'sequential'
     
-    return buffer
+    if not title:
+        return None, "Title is required"
+    if not description:
+        return None, "Description is required"
+    if num_chapters < 1 or num_chapters > MAX_CHAPTERS:
+        return None, f"Number of chapters must be between 1 and {MAX_CHAPTERS}"
+    if mode not in GENERATION_MODES:
+        return None, f"Mode must be one of: {', '.join(GENERATION_MODES)}"
+    # The continuity review reads every chapter summary in one prompt
+    if mode == "parallel" and uses_act_outline(num_chapters):
+        return None, f"Parallel mode supports at most {FLAT_OUTLINE_MAX_CHAPTERS} chapters"
+    return {"title": title, "description": description, "num_chapters": num_chapters, "mode": mode}, None
+
+def parse_seed(value):
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("Seed must be an integer")
+
+# Stored stories
+STORY_STORE_PATH = os.getenv("STORY_STORE_PATH", os.path.join(CACHE_DIR, "stories.sqlite3"))
+STORY_TTL_SECONDS = int(os.getenv("STORY_TTL_SECONDS", str(7 * 24 * 3600)))
+
+class StoryStore:
+    """SQLite store for generated stories, so downloads can refer to them by ID
+
+    Stories expire STORY_TTL_SECONDS after they were last saved; expired rows
+    are purged lazily whenever a new story is stored.
+    """
+
+    def __init__(self, path=STORY_STORE_PATH, ttl_seconds=STORY_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS stories (
+                story_id TEXT PRIMARY KEY,
+                story TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS stories_expires_at ON stories (expires_at)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, story, story_id=None):
+        story_id = story_id or uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO stories VALUES (?, ?, ?)",
+                         (story_id, json.dumps(story), now + self.ttl_seconds))
+            conn.execute("DELETE FROM stories WHERE expires_at < ?", (now,))
+        return story_id
+
+    def get(self, story_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT story FROM stories WHERE story_id = ? AND expires_at >= ?",
+                               (story_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, story_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM stories WHERE story_id = ?", (story_id,))
+
+story_store = StoryStore()
+
+# Generation checkpoints
+CHECKPOINT_STORE_PATH = os.getenv("CHECKPOINT_STORE_PATH", os.path.join(CACHE_DIR, "checkpoints.sqlite3"))
+CHECKPOINT_TTL_SECONDS = int(os.getenv("CHECKPOINT_TTL_SECONDS", str(7 * 24 * 3600)))
+
+class CheckpointStore:
+    """Durable record of partially generated stories
+
+    generate_story saves the story after every completed stage together with
+    the generation parameters and the list of finished stages, so a failed or
+    interrupted run (even across a server restart) can resume where it
+    stopped instead of paying for the same calls again. Chapters are stored
+    as rows of their own and only the ones that changed are written, so a
+    checkpoint costs the same at chapter 150 as at chapter 1.
+    """
+
+    def __init__(self, path=CHECKPOINT_STORE_PATH, ttl_seconds=CHECKPOINT_TTL_SECONDS):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS checkpoints (
+                story_id TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                stages TEXT NOT NULL,
+                story TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS checkpoint_chapters (
+                story_id TEXT NOT NULL,
+                number INTEGER NOT NULL,
+                chapter TEXT NOT NULL,
+                PRIMARY KEY (story_id, number)
+            )""")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def save(self, story_id, params, stages, story, chapters=None):
+        """Save the story; chapters limits the chapter rows written to those given (default all)"""
+        self.write(self.encode(story_id, params, stages, story, chapters))
+
+    @staticmethod
+    def encode(story_id, params, stages, story, chapters=None):
+        """Serialize a checkpoint for write(), freezing the story as it is now"""
+        if chapters is None:
+            chapters = story["chapters"]
+        row = (story_id, json.dumps(params), json.dumps(stages),
+               json.dumps({key: value for key, value in story.items() if key != "chapters"}))
+        return row, [(story_id, chapter["number"], json.dumps(chapter)) for chapter in chapters]
+
+    def write(self, record):
+        row, chapter_rows = record
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?)", row + (now,))
+            conn.executemany("INSERT OR REPLACE INTO checkpoint_chapters VALUES (?, ?, ?)", chapter_rows)
+            expired = conn.execute("DELETE FROM checkpoints WHERE updated_at < ?", (now - self.ttl_seconds,))
+            if expired.rowcount:
+                conn.execute("DELETE FROM checkpoint_chapters "
+                             "WHERE story_id NOT IN (SELECT story_id FROM checkpoints)")
+
+    def load(self, story_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT params, stages, story, updated_at FROM checkpoints WHERE story_id = ?",
+                               (story_id,)).fetchone()
+            if row is None:
+                return None
+            story = json.loads(row[2])
+            # Checkpoints written before chapters had rows of their own keep them inline
+            if "chapters" not in story:
+                story["chapters"] = [json.loads(chapter) for (chapter,) in conn.execute(
+                    "SELECT chapter FROM checkpoint_chapters WHERE story_id = ? ORDER BY number", (story_id,))]
+        return {"params": json.loads(row[0]), "stages": json.loads(row[1]),
+                "story": story, "updated_at": row[3]}
+
+    def delete(self, story_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM checkpoints WHERE story_id = ?", (story_id,))
+            conn.execute("DELETE FROM checkpoint_chapters WHERE story_id = ?", (story_id,))
+
+checkpoint_store = CheckpointStore()
+
+# Background story jobs
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+MAX_QUEUED_JOBS = int(os.getenv("MAX_QUEUED_JOBS", "32"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+# Run new stories as coroutines on one event loop instead of one worker thread each
+ASYNC_GENERATION = os.getenv("ASYNC_GENERATION", "0") == "1"
+MAX_ASYNC_JOBS = int(os.getenv("MAX_ASYNC_JOBS", "500"))
+
+class JobQueueFull(Exception):
+    """Raised when the job queue has no room for another story"""
+    pass
+
+class JobAlreadyRunning(Exception):
+    """Raised when resuming a job that is still queued or running"""
+    pass
+
+JOB_FINAL_STATUSES = ("completed", "failed", "cancelled")
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", os.path.join(CACHE_DIR, "jobs.sqlite3"))
+# How often each server process writes the state of its jobs to the job store and picks up cancel requests
+JOB_SYNC_SECONDS = float(os.getenv("JOB_SYNC_SECONDS", "2"))
+# An unfinished job that has not been synced for this long belongs to a process that is gone
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "30"))
+
+class JobStore:
+    """SQLite record of job status shared by every server process
+
+    A job runs in the process that accepted it, which keeps it in memory and
+    syncs its status here every JOB_SYNC_SECONDS. Requests that land on
+    another process (gunicorn -w N) read the job from this table instead, and
+    cancel it by setting a flag the owning process picks up on its next sync.
+    Rows are purged JOB_RETENTION_SECONDS after their last update.
+    """
+
+    def __init__(self, path=JOB_STORE_PATH, retention_seconds=JOB_RETENTION_SECONDS,
+                 stale_seconds=JOB_STALE_SECONDS):
+        self.path = path
+        self.retention_seconds = retention_seconds
+        self.stale_seconds = stale_seconds
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                job TEXT NOT NULL,
+                story_id TEXT,
+                finished INTEGER NOT NULL,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_story_id ON jobs (story_id)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _row(job, now):
+        return (job["job_id"], json.dumps(job), job.get("story_id"), int(job["status"] in JOB_FINAL_STATUSES), now)
+
+    def insert(self, job, exclusive=False):
+        """Record a newly queued job, replacing an earlier attempt with the same ID
+
+        With exclusive, raises JobAlreadyRunning instead if a live process
+        already has an unfinished job for the same stored story.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            if exclusive:
+                # Take the write lock first so no other process can claim the story between check and insert
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("SELECT 1 FROM jobs WHERE story_id = ? AND job_id != ? AND finished = 0 "
+                                "AND updated_at >= ?",
+                                (job.get("story_id"), job["job_id"], now - self.stale_seconds)).fetchone():
+                    raise JobAlreadyRunning("This story is already being changed")
+            conn.execute("INSERT OR REPLACE INTO jobs (job_id, job, story_id, finished, updated_at) "
+                         "VALUES (?, ?, ?, ?, ?)", self._row(job, now))
+            conn.execute("DELETE FROM jobs WHERE updated_at < ?", (now - self.retention_seconds,))
+
+    def sync(self, jobs):
+        """Save the current state of a process's jobs; returns the IDs of those asked to cancel"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany("INSERT INTO jobs (job_id, job, story_id, finished, updated_at) VALUES (?, ?, ?, ?, ?) "
+                             "ON CONFLICT (job_id) DO UPDATE SET job = excluded.job, story_id = excluded.story_id, "
+                             "finished = excluded.finished, updated_at = excluded.updated_at",
+                             [self._row(job, now) for job in jobs])
+            running = [job["job_id"] for job in jobs if job["status"] not in JOB_FINAL_STATUSES]
+            cancelled = []
+            for start in range(0, len(running), 500):
+                chunk = running[start:start + 500]
+                cancelled.extend(job_id for (job_id,) in conn.execute(
+                    f"SELECT job_id FROM jobs WHERE cancel_requested = 1 AND job_id IN ({','.join('?' * len(chunk))})",
+                    chunk))
+        return cancelled
+
+    def get(self, job_id):
+        """Return the job as its process last synced it, or None if it is unknown or expired"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT job, finished, cancel_requested, updated_at FROM jobs "
+                               "WHERE job_id = ? AND updated_at >= ?",
+                               (job_id, now - self.retention_seconds)).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        if not row[1] and row[3] < now - self.stale_seconds:
+            job.update(status="failed", finished_at=row[3],
+                       error="The server running this job stopped before it finished")
+        elif not row[1] and row[2]:
+            job["cancel_requested"] = True
+        return job
+
+    def request_cancel(self, job_id):
+        """Flag an unfinished job for cancellation by the process running it"""
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND finished = 0", (job_id,))
+
+job_store = JobStore()
+
+class StoryJob:
+    def __init__(self, title, description, num_chapters, mode="sequential", use_cache=True, seed=None,
+                 job_id=None, resume=False, priority="interactive"):
+        self.id = job_id or uuid.uuid4().hex
+        self.resume = resume
+        self.title = title
+        self.description = description
+        self.num_chapters = num_chapters
+        self.mode = mode
+        self.use_cache = use_cache
+        self.seed = seed
+        self.priority = priority
+        self.status = "queued"
+        self.stage = None
+        self.story = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.story_id = None
+        # Set for jobs that rework a stored story instead of generating a new one
+        self.task = None
+        self.previous_story = None
+        self.future = None
+        # Set once the finished story is being saved; from then on the job can no longer be cancelled
+        self.storing = False
+        self.lock = threading.Lock()
+        self.events = []
+        self.subscribers = set()
+        # Set once the final status has been written to the job store
+        self.synced = False
+
+    def update_progress(self, stage, story):
+        """Snapshot the partial story so readers never see it mid-update"""
+        with self.lock:
+            self.stage = stage
+            self.story = dict(story, chapters=list(story["chapters"]))
+        if stage == "outline":
+            self.publish("outline", {"plot_outline": story["plot_outline"]})
+        elif stage == "title":
+            self.publish("title", {"title": story["title"]})
+        elif stage == "blurb":
+            self.publish("blurb", {"blurb": story["blurb"]})
+        elif stage.startswith("act_"):
+            number = int(stage.rpartition("_")[2])
+            self.publish("act", {"act": story["acts"][number - 1]})
+        elif stage.startswith(("chapter_", "revised_chapter_")):
+            number = int(stage.rpartition("_")[2])
+            chapter = next(chapter for chapter in story["chapters"] if chapter["number"] == number)
+            self.publish("chapter", {"chapter": chapter, "revised": stage.startswith("revised_")})
+
+    def stream_token(self, chapter_number, delta):
+        # Token deltas go to live listeners only, the finished chapter event replaces them
+        self.publish("token", {"chapter": chapter_number, "delta": delta}, replay=False)
+
+    def publish(self, event, data, replay=True):
+        with self.lock:
+            message = {"id": len(self.events) if replay else None, "event": event, "data": data}
+            if replay:
+                self.events.append(message)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(message)
+
+    def subscribe(self):
+        """Return the events published so far and a queue for the ones to come"""
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.add(subscriber)
+            return list(self.events), subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    @property
+    def finished(self):
+        return self.status in JOB_FINAL_STATUSES
+
+    def to_dict(self, include_story=True):
+        with self.lock:
+            data = {
+                "job_id": self.id,
+                "status": self.status,
+                "stage": self.stage,
+                "num_chapters": self.num_chapters,
+                "mode": self.mode,
+                "chapters_completed": len(self.story["chapters"]) if self.story else 0,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+            }
+            if self.story_id:
+                data["story_id"] = self.story_id
+            if self.error:
+                data["error"] = self.error
+            if self.story is not None and self.story.get("usage"):
+                finished_at = self.finished_at or time.time()
+                data["metrics"] = dict(self.story["usage"],
+                                       elapsed_seconds=round(finished_at - self.started_at, 2) if self.started_at else 0)
+            if include_story and self.story is not None:
+                data["story"] = self.story
+            return data
+
+class AsyncStoryRunner:
+    """Event loop on a background thread that runs many story generations at once
+
+    An in-flight story is a coroutine waiting on the network instead of a
+    worker thread with its own stack, so one loop can drive hundreds of
+    them; max_jobs bounds how many run at the same time. The loop starts
+    with the first submission.
+    """
+
+    def __init__(self, max_jobs=MAX_ASYNC_JOBS):
+        self.max_jobs = max_jobs
+        self.loop = None
+        self.slots = None
+        self.lock = threading.Lock()
+
+    def _get_loop(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.slots = asyncio.Semaphore(self.max_jobs)
+                threading.Thread(target=self.loop.run_forever, name="story-async", daemon=True).start()
+            return self.loop
+
+    def submit(self, coroutine_fn, *args):
+        """Schedule coroutine_fn(*args) on the loop and return a concurrent.futures.Future"""
+        loop = self._get_loop()
+
+        async def limited():
+            async with self.slots:
+                return await coroutine_fn(*args)
+
+        return asyncio.run_coroutine_threadsafe(limited(), loop)
+
+class JobManager:
+    """Runs story generation on a bounded worker pool and tracks job state
+
+    With ASYNC_GENERATION new stories run on an AsyncStoryRunner instead;
+    chapter and field regeneration stay on the worker pool. A sync thread
+    mirrors the jobs into the job store, so other server processes can
+    report on and cancel them.
+    """
+
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS, max_queued=MAX_QUEUED_JOBS,
+                 retention_seconds=JOB_RETENTION_SECONDS, asynchronous=ASYNC_GENERATION,
+                 sync_seconds=JOB_SYNC_SECONDS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="story-job")
+        self.async_runner = AsyncStoryRunner() if asynchronous else None
+        self.max_pending = (self.async_runner.max_jobs if self.async_runner else max_workers) + max_queued
+        self.retention_seconds = retention_seconds
+        self.sync_seconds = sync_seconds
+        self.sync_event = threading.Event()
+        self.sync_thread = None
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, title, description, num_chapters, mode="sequential", use_cache=True, seed=None,
+               priority="interactive"):
+        job = StoryJob(title, description, num_chapters, mode, use_cache, seed, priority=priority)
+        self._enqueue(job)
+        logging.info(f"Queued story job {job.id} ({num_chapters} chapters)")
+        return job
+
+    def resume(self, job_id):
+        """Requeue a failed, cancelled or lost job from its last checkpoint
+
+        Returns None when there is no checkpoint to resume from.
+        """
+        existing = self.status(job_id, include_story=False)
+        if existing is not None and existing["status"] not in JOB_FINAL_STATUSES:
+            raise JobAlreadyRunning("This story is still being generated")
+        saved = checkpoint_store.load(job_id)
+        if saved is None:
+            return None
+        params = saved["params"]
+        job = StoryJob(params["title"], params["description"], params["num_chapters"], params["mode"],
+                       params["use_cache"], params["seed"], job_id=job_id, resume=True,
+                       priority=params.get("priority", "interactive"))
+        job.update_progress("resumed", saved["story"])
+        self._enqueue(job)
+        logging.info(f"Resuming story job {job.id} after stage '{saved['stages'][-1]}'")
+        return job
+
+    def submit_task(self, story_id, story, task, description):
+        """Queue work on a stored story; task(story, on_progress, cancel_event, on_token) returns the new version
+
+        Raises JobAlreadyRunning if another job is already changing the story.
+        """
+        job = StoryJob(story["title"], description, len(story["chapters"]), story.get("mode", "sequential"))
+        job.story_id = story_id
+        job.previous_story = json.loads(json.dumps(story))
+        job.task = task
+        job.update_progress("queued", story)
+        self._enqueue(job)
+        logging.info(f"Queued job {job.id} for stored story {story_id}: {description}")
+        return job
+
+    def _enqueue(self, job):
+        # Check and insert under one lock, so two requests cannot both claim the same stored story
+        with self.lock:
+            self._prune()
+            if job.task is not None and any(existing.story_id == job.story_id and not existing.finished
+                                            for existing in self.jobs.values()):
+                raise JobAlreadyRunning("This story is already being changed")
+            pending = sum(1 for existing in self.jobs.values() if not existing.finished)
+            if pending >= self.max_pending:
+                raise JobQueueFull("Too many stories are being generated, please try again shortly")
+            self.jobs[job.id] = job
+            if self.sync_thread is None:
+                self.sync_thread = threading.Thread(target=self._sync_loop, name="job-sync", daemon=True)
+                self.sync_thread.start()
+        try:
+            job_store.insert(job.to_dict(include_story=False), exclusive=job.task is not None)
+        except Exception:
+            with self.lock:
+                del self.jobs[job.id]
+            raise
+        if self.async_runner is not None and job.task is None:
+            job.future = self.async_runner.submit(self._run_async, job)
+        else:
+            job.future = self.executor.submit(self._run, job)
+
+    def get(self, job_id):
+        """Return a job this process runs, or None"""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status(self, job_id, include_story=True):
+        """Describe a job run by this or any other server process; None if it is unknown"""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict(include_story=include_story)
+        data = job_store.get(job_id)
+        if data is None or not include_story:
+            return data
+        if data["status"] == "completed" and data.get("story_id"):
+            story = story_store.get(data["story_id"])
+        else:
+            saved = checkpoint_store.load(job_id)
+            story = saved["story"] if saved else None
+        if story is not None:
+            data["story"] = story
+        return data
+
+    def request_cancel(self, job_id):
+        """Cancel a job wherever it runs; returns its description, or None if it is unknown"""
+        job = self.cancel(job_id)
+        if job is not None:
+            return job.to_dict(include_story=False)
+        data = job_store.get(job_id)
+        if data is not None and data["status"] not in JOB_FINAL_STATUSES:
+            job_store.request_cancel(job_id)
+            data["cancel_requested"] = True
+        return data
+
+    def cancel(self, job_id):
+        """Cancel a job this process runs"""
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with job.lock:
+            if job.storing or job.finished:
+                return job
+            job.cancel_event.set()
+        # Jobs that have not started yet can be dropped from the pool directly, async ones at any await
+        if job.future is not None and job.future.cancel():
+            self._finish(job, "cancelled")
+        return job
+
+    def _start(self, job):
+        """Mark a job as running; returns False if it was cancelled while queued"""
+        if job.cancel_event.is_set():
+            self._finish(job, "cancelled")
+            return False
+        with job.lock:
+            job.status = "running"
+            job.started_at = time.time()
+        return True
+
+    def _generation_kwargs(self, job):
+        return dict(title=job.title, description=job.description, num_chapters=job.num_chapters,
+                    on_progress=job.update_progress,
+                    cancel_event=job.cancel_event,
+                    on_token=job.stream_token,
+                    mode=job.mode,
+                    use_cache=job.use_cache,
+                    seed=job.seed,
+                    story_id=job.id,
+                    resume=job.resume,
+                    priority=job.priority)
+
+    def _begin_store(self, job):
+        """Claim a generated story for saving; returns False if the job was cancelled first"""
+        with job.lock:
+            if job.cancel_event.is_set():
+                return False
+            job.storing = True
+            return True
+
+    def _store(self, job, story):
+        """Save a finished story, queue its exports and complete the job"""
+        job.update_progress("done", story)
+        job.story_id = story_store.save(story, story_id=job.story_id or job.id)
+        if job.previous_story is not None:
+            invalidate_exports(job.previous_story)
+        if PRERENDER_EXPORTS:
+            try:
+                export_renderer.prerender(story)
+            except Exception as e:
+                logging.warning(f"Could not pre-render exports for job {job.id}: {str(e)}")
+        self._finish(job, "completed")
+        logging.info(f"Story job {job.id} completed in {job.finished_at - job.started_at:.1f}s")
+
+    def _run(self, job):
+        if not self._start(job):
+            return
+        try:
+            if job.task is not None:
+                story = job.task(json.loads(json.dumps(job.previous_story)), on_progress=job.update_progress,
+                                 cancel_event=job.cancel_event, on_token=job.stream_token)
+            else:
+                story = generate_story(**self._generation_kwargs(job))
+            if not self._begin_store(job):
+                raise GenerationCancelled("Generation cancelled before the story was saved")
+            self._store(job, story)
+        except GenerationCancelled:
+            self._finish(job, "cancelled")
+            logging.info(f"Story job {job.id} cancelled")
+        except Exception as e:
+            logging.error(f"Story job {job.id} failed: {str(e)}")
+            self._finish(job, "failed", error=str(e))
+
+    async def _run_async(self, job):
+        # Cancelling the future interrupts the coroutine at once; cancel() then finishes the job
+        if not self._start(job):
+            return
+        try:
+            story = await agenerate_story(**self._generation_kwargs(job))
+            if not self._begin_store(job):
+                raise GenerationCancelled("Generation cancelled before the story was saved")
+            # Saving and queueing exports touch SQLite and the disk, keep them off the loop.
+            # cancel() leaves a storing job alone, so the thread is never abandoned halfway.
+            await asyncio.to_thread(self._store, job, story)
+        except GenerationCancelled:
+            self._finish(job, "cancelled")
+            logging.info(f"Story job {job.id} cancelled")
+        except Exception as e:
+            logging.error(f"Story job {job.id} failed: {str(e)}")
+            self._finish(job, "failed", error=str(e))
+
+    def _finish(self, job, status, error=None):
+        """Move the job to its final status once; later calls are ignored"""
+        with job.lock:
+            if job.finished:
+                return False
+            job.status = status
+            job.error = error
+            job.finished_at = time.time()
+        if job.started_at:
+            metrics.observe("story_generation_seconds", job.finished_at - job.started_at,
+                            mode=job.mode, status=status)
+        job.publish(status, job.to_dict(include_story=False))
+        # Let other processes see the final status without waiting for the next sync
+        self.sync_event.set()
+        return True
+
+    def sync(self):
+        """Write this process's unsynced jobs to the job store and act on cancel requests"""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if not job.synced]
+        if not jobs:
+            return
+        records = [job.to_dict(include_story=False) for job in jobs]
+        for job_id in job_store.sync(records):
+            logging.info(f"Cancelling story job {job_id} at the request of another server process")
+            self.cancel(job_id)
+        for job, record in zip(jobs, records):
+            if record["status"] in JOB_FINAL_STATUSES:
+                job.synced = True
+
+    def _sync_loop(self):
+        while True:
+            self.sync_event.wait(self.sync_seconds)
+            self.sync_event.clear()
+            try:
+                self.sync()
+            except Exception as e:
+                logging.warning(f"Could not sync jobs to the job store: {str(e)}")
+
+    def _prune(self):
+        """Drop finished jobs older than the retention window (caller holds the lock)"""
+        cutoff = time.time() - self.retention_seconds
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and job.synced and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+job_manager = JobManager()
+
+# Bulk generation
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# Highest concurrency a bulk run started through the API may ask for
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+BATCH_OUTPUT_DIR = os.getenv("BATCH_OUTPUT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "batches"))
+
+class MalformedBatchRow:
+    """Stands in for a line of a batch file that is not valid JSON, so only that row fails"""
+
+    def __init__(self, error):
+        self.error = error
+
+def parse_jsonl_rows(lines):
+    rows = []
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError as e:
+            rows.append(MalformedBatchRow(f"Line {number} is not valid JSON: {str(e)}"))
+    return rows
+
+def load_batch_rows(path):
+    """Read story requests from a CSV file (with a header row) or a JSON Lines file"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.csv'):
+            return list(csv.DictReader(f))
+        return parse_jsonl_rows(f)
+
+def parse_batch_upload(file_storage):
+    text = file_storage.read().decode('utf-8')
+    if file_storage.filename.lower().endswith('.csv'):
+        return list(csv.DictReader(io.StringIO(text)))
+    return parse_jsonl_rows(text.splitlines())
+
+def safe_filename(text, max_length=60):
+    return re.sub(r'[^A-Za-z0-9]+', '_', text).strip('_')[:max_length] or "story"
+
+class BatchRun:
+    """Generates many books with bounded concurrency and writes them to an output directory
+
+    Each finished book is written as JSON plus the requested export formats
+    and appended to results.jsonl straight away, so results are usable while
+    the batch is still running. Every row checkpoints under an ID derived
+    from its position and content, so re-running the same input resumes
+    unfinished books. Rows that fail, including ones that are not objects
+    or not valid JSON, are recorded as failed without stopping the others. A throughput report is written to
+    report.json at the end, also when the run itself fails.
+    """
+
+    def __init__(self, rows, output_dir, concurrency=BATCH_CONCURRENCY, formats=tuple(EXPORT_MIMETYPES),
+                 batch_id=None, use_cache=True):
+        self.id = batch_id or uuid.uuid4().hex
+        self.rows = rows
+        self.output_dir = output_dir
+        self.concurrency = max(1, concurrency)
+        self.formats = [format_type for format_type in formats
+                        if format_type in EXPORTERS or format_type in STREAMING_EXPORTERS]
+        self.use_cache = use_cache
+        self.status = "queued"
+        self.results = []
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def _row_story_id(self, index, row):
+        # Identical rows are separate books, the row number keeps their checkpoints apart
+        payload = json.dumps([index, row], sort_keys=True, ensure_ascii=False)
+        return "batch-" + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def _generate(self, index, row):
+        if isinstance(row, MalformedBatchRow):
+            return {"row": index, "title": None, "status": "failed", "error": row.error}
+        if not isinstance(row, dict):
+            return {"row": index, "title": None, "status": "failed",
+                    "error": "Row must be an object with title, description and num_chapters"}
+        params, error = validate_story_request(row)
+        result = {"row": index, "title": row.get('title')}
+        if error:
+            return dict(result, status="failed", error=error)
+
+        started = time.time()
+        story_id = self._row_story_id(index, row)
+        try:
+            story = generate_story(params["title"], params["description"], params["num_chapters"],
+                                   mode=params["mode"], use_cache=self.use_cache,
+                                   story_id=story_id, resume=True, priority="batch")
+        except Exception as e:
+            logging.error(f"Batch {self.id} row {index} failed: {str(e)}")
+            return dict(result, status="failed", error=str(e), story_id=story_id,
+                        seconds=round(time.time() - started, 2))
+
+        base_name = f"{index:05d}_{safe_filename(story['title'])}"
+        files = [f"{base_name}.json"]
+        with open(os.path.join(self.output_dir, files[0]), 'w', encoding='utf-8') as f:
+            json.dump(story, f, ensure_ascii=False, indent=2)
+        export_errors = {}
+        for format_type in self.formats:
+            path = os.path.join(self.output_dir, f"{base_name}.{format_type}")
+            try:
+                if format_type in STREAMING_EXPORTERS:
+                    with open(path, 'wb') as f:
+                        f.writelines(STREAMING_EXPORTERS[format_type](story))
+                else:
+                    with render_story(story, format_type, queue_timeout=None) as export, open(path, 'wb') as f:
+                        shutil.copyfileobj(export, f)
+            except Exception as e:
+                export_errors[format_type] = str(e)
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            files.append(os.path.basename(path))
+
+        result.update(status="completed", story_id=story_id, title=story['title'], files=files,
+                      chapters=len(story['chapters']), usage=story.get("usage"),
+                      seconds=round(time.time() - started, 2))
+        if export_errors:
+            result["export_errors"] = export_errors
+        return result
+
+    def _record(self, result, results_file):
+        with self.lock:
+            self.results.append(result)
+            results_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            results_file.flush()
+        logging.info(f"Batch {self.id}: {len(self.results)}/{len(self.rows)} done "
+                     f"(row {result['row']} {result['status']})")
+
+    def run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(os.path.join(self.output_dir, "results.jsonl"), 'a', encoding='utf-8') as results_file, \
+                    ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch") as executor:
+                futures = {executor.submit(self._generate, index, row): index for index, row in enumerate(self.rows)}
+                for future in as_completed(futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logging.error(f"Batch {self.id} row {futures[future]} failed: {str(e)}")
+                        result = {"row": futures[future], "title": None, "status": "failed", "error": str(e)}
+                    self._record(result, results_file)
+            self.status = "completed"
+        except BaseException as e:
+            self.status = "failed"
+            self.error = str(e) or type(e).__name__
+            logging.error(f"Batch {self.id} failed: {self.error}")
+            raise
+        finally:
+            self.finished_at = time.time()
+            report = self.report()
+            try:
+                with open(os.path.join(self.output_dir, "report.json"), 'w', encoding='utf-8') as f:
+                    json.dump(report, f, indent=2)
+            except OSError as e:
+                logging.error(f"Could not write the report of batch {self.id}: {str(e)}")
+        return report
+
+    def report(self):
+        with self.lock:
+            results = list(self.results)
+        completed = [result for result in results if result["status"] == "completed"]
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0
+        prompt_tokens = sum((result.get("usage") or {}).get("prompt_tokens", 0) for result in completed)
+        cached_tokens = sum((result.get("usage") or {}).get("cached_tokens", 0) for result in completed)
+        completion_tokens = sum((result.get("usage") or {}).get("completion_tokens", 0) for result in completed)
+        cost = sum((result.get("usage") or {}).get("cost_usd", 0) for result in completed)
+        return {
+            "batch_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "output_dir": self.output_dir,
+            "rows": len(self.rows),
+            "completed": len(completed),
+            "failed": len(results) - len(completed),
+            "chapters": sum(result["chapters"] for result in completed),
+            "elapsed_seconds": round(elapsed, 1),
+            "books_per_hour": round(len(completed) * 3600 / elapsed, 1) if elapsed else 0,
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": cached_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cost_usd": round(cost, 4),
+            "failures": [{"row": result["row"], "error": result["error"]}
+                         for result in results if result["status"] == "failed"],
+        }
+
+def format_batch_report(report):
+    lines = [
+        f"Batch {report['batch_id']} finished in {report['elapsed_seconds']}s",
+        f"  Books:      {report['completed']}/{report['rows']} completed, {report['failed']} failed",
+        f"  Chapters:   {report['chapters']}",
+        f"  Throughput: {report['books_per_hour']} books/hour",
+        f"  Tokens:     {report['total_tokens']} ({report['prompt_tokens']} prompt of which "
+        f"{report['cached_tokens']} cached, {report['completion_tokens']} completion)",
+        f"  Cost:       ${report['cost_usd']:.4f}",
+        f"  Output:     {report['output_dir']}",
+    ]
+    if report.get('error'):
+        lines.append(f"  Error:      {report['error']}")
+    for failure in report['failures']:
+        lines.append(f"  Row {failure['row']} failed: {failure['error']}")
+    return "\n".join(lines)
+
+# Batches run one at a time; each has its own concurrency level
+batch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-runner")
+batch_runs = {}
+batch_runs_lock = threading.Lock()
+
+def prune_batch_runs():
+    """Forget batches that finished longer than JOB_RETENTION_SECONDS ago; their report stays on disk"""
+    cutoff = time.time() - JOB_RETENTION_SECONDS
+    with batch_runs_lock:
+        expired = [batch_id for batch_id, run in batch_runs.items()
+                   if run.finished_at is not None and run.finished_at < cutoff]
+        for batch_id in expired:
+            del batch_runs[batch_id]
 
 # Routes
 @app.route('/')
@@ -541,25 +3822,138 @@ def index():
 @app.route('/generate', methods=['POST'])
 def generate():
     data = request.json
-    title = data.get('title', '').strip()
-    description = data.get('description', '').strip()
-    num_chapters = int(data.get('num_chapters', 3))
+    params, error = validate_story_request(data)
+    if error:
+        return jsonify({"status": "error", "message": error})
+    use_cache = bool(data.get('use_cache', True))
+    seed = data.get('seed')
+    priority = data.get('priority', 'interactive')
     
-    # Validate inputs
-    if not title:
-        return jsonify({"status": "error", "message": "Title is required"})
-    if not description:
-        return jsonify({"status": "error", "message": "Description is required"})
-    if num_chapters < 1 or num_chapters > 10:
-        return jsonify({"status": "error", "message": "Number of chapters must be between 1 and 10"})
+    if priority not in PRIORITIES:
+        return jsonify({"status": "error", "message": f"Priority must be one of: {', '.join(PRIORITIES)}"})
+    try:
+        seed = parse_seed(seed)
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)})
     
     try:
-        story = generate_story(title, description, num_chapters)
-        return jsonify({"status": "success", "story": story})
+        job = job_manager.submit(params["title"], params["description"], params["num_chapters"],
+                                 params["mode"], use_cache, seed, priority)
+        return jsonify({"status": "success", "job_id": job.id, "job": job.to_dict(include_story=False)}), 202
+    except JobQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 429
     except Exception as e:
         logging.error(f"Story generation error: {str(e)}")
         return jsonify({"status": "error", "message": str(e)})
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_manager.status(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": job})
+
+SSE_KEEPALIVE_SECONDS = 15
+# Each event stream holds a server thread, so it is closed after this long and the client opens a new one
+SSE_STREAM_SECONDS = float(os.getenv("SSE_STREAM_SECONDS", "300"))
+
+JOB_TERMINAL_EVENTS = JOB_FINAL_STATUSES
+
+def format_sse(message):
+    event_id = f"id: {message['id']}\n" if message['id'] is not None else ""
+    return f"{event_id}event: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+# Tells the client to reconnect (with the last event ID it saw) once a stream has reached SSE_STREAM_SECONDS
+SSE_RECONNECT = format_sse({"id": None, "event": "reconnect", "data": {}})
+
+def stream_remote_job(job_id):
+    """Event stream for a job another server process runs
+
+    Its progress events stay in that process, so this only reports the final
+    status, polling the job store at the rate the owner syncs it.
+    """
+    deadline = time.monotonic() + SSE_STREAM_SECONDS
+    waited = 0
+    while True:
+        job = job_manager.status(job_id, include_story=False)
+        if job is None:
+            return
+        if job["status"] in JOB_TERMINAL_EVENTS:
+            yield format_sse({"id": None, "event": job["status"], "data": job})
+            return
+        if time.monotonic() >= deadline:
+            yield SSE_RECONNECT
+            return
+        if waited >= SSE_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            waited = 0
+        time.sleep(JOB_SYNC_SECONDS)
+        waited += JOB_SYNC_SECONDS
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream job progress as Server-Sent Events"""
+    job = job_manager.get(job_id)
+    if job is None:
+        if job_manager.status(job_id, include_story=False) is None:
+            return jsonify({"status": "error", "message": "Job not found"}), 404
+        return Response(stream_remote_job(job_id), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    # EventSource sends Last-Event-ID when it reconnects by itself, the page passes it along after a reconnect event
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('last_event_id', type=int)
+
+    def stream():
+        deadline = time.monotonic() + SSE_STREAM_SECONDS
+        history, subscriber = job.subscribe()
+        try:
+            for message in history:
+                if last_event_id is None or message['id'] > last_event_id:
+                    yield format_sse(message)
+                if message['event'] in JOB_TERMINAL_EVENTS:
+                    return
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    yield SSE_RECONNECT
+                    return
+                try:
+                    message = subscriber.get(timeout=min(SSE_KEEPALIVE_SECONDS, remaining))
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield format_sse(message)
+                if message['event'] in JOB_TERMINAL_EVENTS:
+                    return
+        finally:
+            job.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """Continue a failed or cancelled job from its last completed stage"""
+    try:
+        job = job_manager.resume(job_id)
+    except JobAlreadyRunning as e:
+        return jsonify({"status": "error", "message": str(e)}), 409
+    except JobQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 429
+    if job is None:
+        return jsonify({"status": "error", "message": "No checkpoint found for this job"}), 404
+    return jsonify({"status": "success", "job_id": job.id, "job": job.to_dict(include_story=False)}), 202
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_manager.request_cancel(job_id)
+    if job is None:
+        return jsonify({"status": "error", "message": "Job not found"}), 404
+    return jsonify({"status": "success", "job": job})
+
 @app.route('/download', methods=['POST'])
 def download():
     try:
@@ -573,46 +3967,181 @@ def download():
         if not story:
             return jsonify({"status": "error", "message": "No story data provided"}), 400
         
-        if format_type == 'pdf':
-            try:
-                buffer = create_pdf(story)
-                
-                return send_file(
-                    buffer,
-                    mimetype='application/pdf',
-                    as_attachment=True,
-                    download_name=f"{story['title'].replace(' ', '_')}.pdf"
-                )
-            except Exception as e:
-                import traceback
-                error_details = traceback.format_exc()
-                logging.error(f"PDF generation failed: {error_details}")
-                return jsonify({"status": "error", "message": f"PDF generation failed: {str(e)}"}), 500
-                
-        elif format_type == 'docx':
-            try:
-                buffer = create_docx(story)
-                
-                return send_file(
-                    buffer,
-                    mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                    as_attachment=True,
-                    download_name=f"{story['title'].replace(' ', '_')}.docx"
-                )
-            except Exception as e:
-                import traceback
-                error_details = traceback.format_exc()
-                logging.error(f"DOCX generation failed: {error_details}")
-                return jsonify({"status": "error", "message": f"DOCX generation failed: {str(e)}"}), 500
-                
-        else:
-            return jsonify({"status": "error", "message": "Invalid format specified"}), 400
+        return send_story_file(story, format_type)
             
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
         logging.error(f"Download route error: {error_details}")
         return jsonify({"status": "error", "message": str(e), "details": error_details}), 500
+
+@app.route('/download/<story_id>', methods=['GET'])
+def download_story(story_id):
+    """Download a stored story without sending it back to the server"""
+    try:
+        story = story_store.get(story_id)
+        if story is None:
+            return jsonify({"status": "error", "message": "Story not found or expired"}), 404
+        
+        response = send_story_file(story, request.args.get('format', 'pdf'))
+        if isinstance(response, tuple):
+            return response
+        # Regeneration replaces the story under the same ID, so clients must revalidate with the ETag
+        response.headers['Cache-Control'] = "private, no-cache"
+        return response
+            
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        logging.error(f"Download route error: {error_details}")
+        return jsonify({"status": "error", "message": str(e), "details": error_details}), 500
+
+@app.route('/stories/<story_id>', methods=['GET'])
+def get_story(story_id):
+    story = story_store.get(story_id)
+    if story is None:
+        return jsonify({"status": "error", "message": "Story not found or expired"}), 404
+    return jsonify({"status": "success", "story_id": story_id, "story": story})
     
-if __name__ == '__main__':
+@app.route('/stories/<story_id>/chapters/<int:chapter_number>/regenerate', methods=['POST'])
+def regenerate_story_chapter(story_id, chapter_number):
+    """Rewrite one chapter of a stored story as a background job"""
+    story = story_store.get(story_id)
+    if story is None:
+        return jsonify({"status": "error", "message": "Story not found or expired"}), 404
+    if not any(chapter['number'] == chapter_number for chapter in story['chapters']):
+        return jsonify({"status": "error", "message": f"Story has no chapter {chapter_number}"}), 404
+
+    data = request.get_json(silent=True) or {}
+    cascade = data.get('cascade', 'flag')
+    if cascade not in REGENERATE_CASCADES:
+        return jsonify({"status": "error", "message": f"Cascade must be one of: {', '.join(REGENERATE_CASCADES)}"}), 400
+    try:
+        seed = parse_seed(data.get('seed'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    def task(story, **callbacks):
+        return regenerate_chapter(story, chapter_number, cascade=cascade, seed=seed, **callbacks)
+
+    try:
+        job = job_manager.submit_task(story_id, story, task, f"regenerate chapter {chapter_number}")
+    except JobAlreadyRunning as e:
+        return jsonify({"status": "error", "message": str(e)}), 409
+    except JobQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 429
+    return jsonify({"status": "success", "job_id": job.id, "story_id": story_id,
+                    "job": job.to_dict(include_story=False)}), 202
+
+@app.route('/stories/<story_id>/<field>/regenerate', methods=['POST'])
+def regenerate_story_field(story_id, field):
+    """Re-roll the title or blurb of a stored story as a background job"""
+    if field not in REGENERATE_FIELDS:
+        return jsonify({"status": "error", "message": f"Only {', '.join(REGENERATE_FIELDS)} can be regenerated"}), 400
+    story = story_store.get(story_id)
+    if story is None:
+        return jsonify({"status": "error", "message": "Story not found or expired"}), 404
+
+    data = request.get_json(silent=True) or {}
+    try:
+        seed = parse_seed(data.get('seed'))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    def task(story, **callbacks):
+        return regenerate_field(story, field, seed=seed, **callbacks)
+
+    try:
+        job = job_manager.submit_task(story_id, story, task, f"regenerate {field}")
+    except JobAlreadyRunning as e:
+        return jsonify({"status": "error", "message": str(e)}), 409
+    except JobQueueFull as e:
+        return jsonify({"status": "error", "message": str(e)}), 429
+    return jsonify({"status": "success", "job_id": job.id, "story_id": story_id,
+                    "job": job.to_dict(include_story=False)}), 202
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/batch', methods=['POST'])
+def start_batch():
+    """Queue a bulk run from JSON rows or an uploaded CSV/JSONL file"""
+    if 'file' in request.files:
+        try:
+            rows = parse_batch_upload(request.files['file'])
+        except (ValueError, UnicodeDecodeError) as e:
+            return jsonify({"status": "error", "message": f"Could not read batch file: {str(e)}"}), 400
+        options = request.form
+    else:
+        options = request.get_json() or {}
+        rows = options.get('rows')
+        # A malformed line of an uploaded file only fails its own row, a malformed request body is refused
+        if isinstance(rows, list):
+            invalid = [index for index, row in enumerate(rows) if not isinstance(row, dict)]
+            if invalid:
+                return jsonify({"status": "error", "message": f"Row {invalid[0]} is not an object "
+                                                              "with title, description and num_chapters"}), 400
+    if not rows or not isinstance(rows, list):
+        return jsonify({"status": "error", "message": "No story rows provided"}), 400
+
+    try:
+        concurrency = int(options.get('concurrency', BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Concurrency must be a whole number"}), 400
+    if concurrency < 1:
+        return jsonify({"status": "error", "message": "Concurrency must be at least 1"}), 400
+    concurrency = min(concurrency, BATCH_MAX_CONCURRENCY)
+
+    formats = options.get('formats') or list(EXPORT_MIMETYPES)
+    if isinstance(formats, str):
+        formats = [format_type.strip() for format_type in formats.split(',')]
+    batch_id = uuid.uuid4().hex
+    run = BatchRun(rows, os.path.join(BATCH_OUTPUT_DIR, batch_id), concurrency=concurrency,
+                   formats=formats, batch_id=batch_id)
+    prune_batch_runs()
+    with batch_runs_lock:
+        batch_runs[batch_id] = run
+    batch_executor.submit(run.run)
+    return jsonify({"status": "success", "batch_id": batch_id, "rows": len(rows)}), 202
+
+@app.route('/batch/<batch_id>', methods=['GET'])
+def batch_status(batch_id):
+    with batch_runs_lock:
+        run = batch_runs.get(batch_id)
+    if run is None:
+        return jsonify({"status": "error", "message": "Batch not found"}), 404
+    with run.lock:
+        results = list(run.results)
+    return jsonify({"status": "success", "report": run.report(), "results": results})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AI Book Generator")
+    subcommands = parser.add_subparsers(dest="command")
+    batch_parser = subcommands.add_parser("batch", help="generate many books from a CSV or JSONL file")
+    batch_parser.add_argument("input", help="CSV (with a header row) or JSONL file of title/description/num_chapters rows")
+    batch_parser.add_argument("-o", "--output-dir", help="where to write stories and exports "
+                              "(default: a new directory under BATCH_OUTPUT_DIR)")
+    batch_parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY,
+                              help="books generated at the same time")
+    batch_parser.add_argument("-f", "--formats", default=",".join(EXPORT_MIMETYPES),
+                              help="comma separated export formats, empty for none")
+    batch_parser.add_argument("--no-cache", action="store_true", help="bypass the completion cache")
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        batch_id = uuid.uuid4().hex
+        run = BatchRun(load_batch_rows(args.input),
+                       args.output_dir or os.path.join(BATCH_OUTPUT_DIR, batch_id),
+                       concurrency=args.concurrency,
+                       formats=[format_type for format_type in args.formats.split(',') if format_type],
+                       batch_id=batch_id, use_cache=not args.no_cache)
+        report = run.run()
+        print(format_batch_report(report))
+        return 1 if report["failed"] else 0
+
     app.run(debug=True)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
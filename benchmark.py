@@ -0,0 +1,404 @@
+"""Benchmarks for the book generator that run without the real OpenAI API
+
+A local OpenAI-compatible stub server with configurable latency, token rate
+and error injection stands in for the API. The suite measures end-to-end
+/generate throughput at several concurrency levels, and the time and peak
+memory of each exporter on synthetic books of different lengths. Results
+are written as JSON so runs can be compared over time.
+
+    python benchmark.py --concurrency 1,4,8 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import queue
+import tempfile
+import threading
+import statistics
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Mock OpenAI server
+WORDS = ("the", "night", "river", "she", "said", "quietly", "a", "door", "opened", "and",
+         "light", "spilled", "across", "old", "stones", "he", "waited", "for", "an", "answer")
+
+class MockOpenAIServer:
+    """Serves /v1/chat/completions with canned text at a controlled pace
+
+    latency is the delay before the first token, tokens_per_second the pace
+    of the completion (0 for instant), and error_rate the share of requests
+    answered with a 429 or 500 instead.
+    """
+
+    def __init__(self, latency=0.2, tokens_per_second=200.0, completion_tokens=400,
+                 error_rate=0.0, retry_after=0.1, seed=0):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "completion_tokens": 0}
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler(), bind_and_activate=False)
+        self.httpd.daemon_threads = True
+        # The async backend opens hundreds of connections at once, more than the default backlog of 5
+        self.httpd.request_queue_size = 1024
+        self.httpd.server_bind()
+        self.httpd.server_activate()
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def _should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def completion_text(self, messages, max_tokens):
+        """Plausible output for the prompt; continuity reviews get valid JSON"""
+        prompt = messages[-1]["content"]
+        if "Respond with only a JSON object" in prompt:
+            return "{}"
+        count = max(1, min(max_tokens or self.completion_tokens, self.completion_tokens))
+        words = [WORDS[i % len(WORDS)] for i in range(count)]
+        paragraphs = [" ".join(words[i:i + 60]).capitalize() + "." for i in range(0, count, 60)]
+        if "Generate Chapter" in prompt:
+            paragraphs.insert(0, "Chapter: The Benchmark")
+        return "\n\n".join(paragraphs)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _write_chunk(self, payload):
+                data = f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+                server._count("requests")
+                time.sleep(server.latency)
+                if server._should_fail():
+                    server._count("errors")
+                    status = server.random.choice((429, 500))
+                    self._send_json(status, {"error": {"message": "injected failure", "type": "server_error"}},
+                                    {"Retry-After": str(server.retry_after)} if status == 429 else None)
+                    return
+
+                text = server.completion_text(body.get("messages", []), body.get("max_tokens"))
+                tokens = text.split(" ")
+                prompt_tokens = sum(len(m.get("content", "")) // 4 + 1 for m in body.get("messages", []))
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                         "total_tokens": prompt_tokens + len(tokens)}
+                server._count("completion_tokens", len(tokens))
+                delay = 1 / server.tokens_per_second if server.tokens_per_second else 0
+                common = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get("model", "mock")}
+
+                if not body.get("stream"):
+                    time.sleep(delay * len(tokens))
+                    self._send_json(200, dict(common, object="chat.completion", usage=usage, choices=[
+                        {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                    ]))
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for index, token in enumerate(tokens):
+                    time.sleep(delay)
+                    content = token if index == 0 else " " + token
+                    self._write_chunk(dict(common, object="chat.completion.chunk", choices=[
+                        {"index": 0, "delta": {"content": content}, "finish_reason": None}
+                    ]))
+                self._write_chunk(dict(common, object="chat.completion.chunk", choices=[
+                    {"index": 0, "delta": {}, "finish_reason": "stop"}
+                ]))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self._write_chunk(dict(common, object="chat.completion.chunk", choices=[], usage=usage))
+                data = b"data: [DONE]\n\n"
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+# Synthetic books
+def synthetic_story(num_chapters, paragraphs_per_chapter=40, words_per_paragraph=90):
+    """A story dict shaped like generate_story() output, with dialogue and scene breaks"""
+    rng = random.Random(num_chapters)
+    chapters = []
+    for number in range(1, num_chapters + 1):
+        paragraphs = []
+        for index in range(paragraphs_per_chapter):
+            words = " ".join(rng.choice(WORDS) for _ in range(words_per_paragraph))
+            if index % 5 == 1:
+                paragraphs.append(f"“{words.capitalize()},” she said — quietly.")
+            elif index and index % 15 == 0:
+                paragraphs.append("* * *")
+            else:
+                paragraphs.append(words.capitalize() + ".")
+        chapters.append({"number": number, "title": f"Chapter {number}: Part {number}",
+                         "content": "\n\n".join(paragraphs)})
+    return {"title": f"Benchmark Book of {num_chapters} Chapters", "blurb": "A synthetic book for benchmarks.",
+            "plot_outline": "Outline", "chapters": chapters}
+
+# Exports the benchmark knows how to run: file exporters and the chunked streaming ones
+EXPORT_FORMATS = ("pdf", "docx", "epub", "html")
+EXPORT_TIMEOUT_SECONDS = 600
+
+def _export(app, format_type, story, output):
+    if format_type in app.STREAMING_EXPORTERS:
+        output.writelines(app.STREAMING_EXPORTERS[format_type](story))
+    else:
+        app.EXPORTERS[format_type](story, output)
+
+def _export_worker(format_type, num_chapters, results):
+    """Runs in a fresh process so peak RSS belongs to this export alone"""
+    import resource
+    import tracemalloc
+    import app
+
+    story = synthetic_story(num_chapters)
+    # Chapters are parsed into blocks once when they are generated
+    for chapter in story["chapters"]:
+        chapter["blocks"] = app.parse_chapter_text(chapter["content"])
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Exports are written to a file, as the render workers do
+    with tempfile.TemporaryFile() as output:
+        started = time.perf_counter()
+        _export(app, format_type, story, output)
+        seconds = time.perf_counter() - started
+        size = output.seek(0, os.SEEK_END)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Tracing slows allocation down, so Python-level peak memory is measured in a second pass
+    with tempfile.TemporaryFile() as output:
+        tracemalloc.start()
+        _export(app, format_type, story, output)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    # ru_maxrss is reported in KiB on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    results.put({
+        "format": format_type,
+        "chapters": num_chapters,
+        "seconds": round(seconds, 4),
+        "bytes": size,
+        "python_peak_bytes": peak,
+        "peak_rss_bytes": peak_rss * scale,
+        "rss_growth_bytes": (peak_rss - baseline_rss) * scale,
+    })
+
+def _wait_for_export(process, results, timeout):
+    """Return the worker's result, or an error entry if it died or ran past the timeout"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if not process.is_alive():
+            # The result may have arrived just before the process exited
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                return {"error": f"export process exited with code {process.exitcode}"}
+        if time.monotonic() > deadline:
+            process.terminate()
+            return {"error": f"export did not finish within {timeout}s"}
+
+def benchmark_exports(chapter_counts, formats, timeout=EXPORT_TIMEOUT_SECONDS):
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for num_chapters in chapter_counts:
+        for format_type in formats:
+            results_queue = context.Queue()
+            process = context.Process(target=_export_worker, args=(format_type, num_chapters, results_queue))
+            process.start()
+            result = _wait_for_export(process, results_queue, timeout)
+            process.join()
+            if "error" in result:
+                result = dict(result, format=format_type, chapters=num_chapters)
+                print(f"export {format_type} {num_chapters} chapters failed: {result['error']}", file=sys.stderr)
+            else:
+                print(f"export {format_type} {num_chapters} chapters: {result['seconds']}s, "
+                      f"peak RSS {result['peak_rss_bytes'] / 2**20:.1f} MiB", file=sys.stderr)
+            results.append(result)
+    return results
+
+# Generation throughput
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def benchmark_generation(app_module, concurrency_levels, stories_per_level, num_chapters, mode):
+    """Closed loop: each client posts /generate and waits for the job to finish, then posts again"""
+    results = []
+    for concurrency in concurrency_levels:
+        latencies = []
+        failures = []
+        lock = threading.Lock()
+        remaining = iter(range(stories_per_level))
+
+        def client():
+            test_client = app_module.app.test_client()
+            while True:
+                with lock:
+                    index = next(remaining, None)
+                if index is None:
+                    return
+                started = time.perf_counter()
+                response = test_client.post('/generate', json={
+                    "title": f"Benchmark {concurrency}-{index}", "description": "A benchmark story",
+                    "num_chapters": num_chapters, "mode": mode, "use_cache": False,
+                })
+                if response.status_code != 202:
+                    with lock:
+                        failures.append(response.json.get("message"))
+                    continue
+                job_id = response.json["job_id"]
+                while True:
+                    job = test_client.get(f'/jobs/{job_id}').json["job"]
+                    if job["status"] in ("completed", "failed", "cancelled"):
+                        break
+                    # Polling the full job JSON is not free, back off with many clients
+                    time.sleep(min(0.5, 0.02 * concurrency))
+                with lock:
+                    if job["status"] == "completed":
+                        latencies.append(time.perf_counter() - started)
+                    else:
+                        failures.append(job.get("error"))
+
+        started = time.perf_counter()
+        clients = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        result = {
+            "concurrency": concurrency,
+            "stories": stories_per_level,
+            "completed": len(latencies),
+            "failed": len(failures),
+            "elapsed_seconds": round(elapsed, 3),
+            "stories_per_minute": round(len(latencies) * 60 / elapsed, 2) if elapsed else 0,
+            "latency_mean_seconds": round(statistics.mean(latencies), 3) if latencies else None,
+            "latency_p50_seconds": round(_percentile(latencies, 0.5), 3) if latencies else None,
+            "latency_p95_seconds": round(_percentile(latencies, 0.95), 3) if latencies else None,
+            "errors": failures[:5],
+        }
+        print(f"generate concurrency {concurrency}: {result['stories_per_minute']} stories/min, "
+              f"p95 {result['latency_p95_seconds']}s", file=sys.stderr)
+        results.append(result)
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark story generation and exports against a mock OpenAI server")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 8], help="comma separated client counts")
+    parser.add_argument("--stories", type=int, default=8, help="stories generated per concurrency level")
+    parser.add_argument("--chapters", type=int, default=3, help="chapters per generated story")
+    parser.add_argument("--mode", default="sequential", help="generation mode passed to /generate")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock time to first token in seconds")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="mock streaming rate, 0 for instant")
+    parser.add_argument("--completion-tokens", type=int, default=400, help="mock completion length")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 429/500")
+    parser.add_argument("--export-chapters", type=int_list, default=[10, 50, 200],
+                        help="comma separated book lengths for the export benchmark")
+    parser.add_argument("--formats", nargs="+", choices=EXPORT_FORMATS, default=["pdf", "docx"],
+                        help="export formats to benchmark")
+    parser.add_argument("--export-timeout", type=float, default=EXPORT_TIMEOUT_SECONDS,
+                        help="seconds one export may take before it is stopped")
+    parser.add_argument("--skip-generate", action="store_true")
+    parser.add_argument("--skip-export", action="store_true")
+    parser.add_argument("-o", "--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+    }
+
+    # Keep benchmark runs away from the real caches and stored stories
+    os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="bench-cache-")
+    os.environ.setdefault("COMPLETION_CACHE_ENABLED", "0")
+    os.environ.setdefault("PRERENDER_EXPORTS", "0")
+
+    with MockOpenAIServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                          completion_tokens=args.completion_tokens, error_rate=args.error_rate) as server:
+        if not args.skip_generate:
+            os.environ["OPENAI_BASE_URL"] = server.base_url
+            os.environ["OPENAI_API_KEY"] = "benchmark"
+            os.environ.setdefault("OPENAI_RPM_LIMIT", "100000")
+            os.environ.setdefault("OPENAI_TPM_LIMIT", "100000000")
+            os.environ.setdefault("SCHEDULER_BACKOFF_BASE", "0.1")
+            os.environ["MAX_CONCURRENT_JOBS"] = str(max(args.concurrency))
+            os.environ["MAX_QUEUED_JOBS"] = str(max(args.concurrency) * 2)
+            import app
+            report["generate"] = benchmark_generation(app, args.concurrency, args.stories, args.chapters, args.mode)
+            report["mock_server"] = dict(server.stats)
+
+    if not args.skip_export:
+        report["export"] = benchmark_exports(args.export_chapters, args.formats, args.export_timeout)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# app reads its configuration at import time, so point every on-disk store at a scratch directory first
+os.environ["CACHE_DIR"] = tempfile.mkdtemp(prefix="ai-book-generator-tests-")
+os.environ["PRERENDER_EXPORTS"] = "0"
+os.environ.setdefault("OPENAI_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fake_story():
+    """Stand-in for app.generate_story that returns a finished story straight away"""
+    def generate(title, description, num_chapters, **kwargs):
+        return {"title": title, "description": description, "chapters": [
+            {"number": number, "title": f"Chapter {number}", "content": "Text."}
+            for number in range(1, num_chapters + 1)
+        ], "usage": {"prompt_tokens": 10, "completion_tokens": 5}}
+    return generate
+
+
+@pytest.fixture
+def afake_story(fake_story):
+    """Coroutine version of fake_story, for app.agenerate_story"""
+    async def generate(title, description, num_chapters, **kwargs):
+        return fake_story(title, description, num_chapters)
+    return generate
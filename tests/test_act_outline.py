@@ -0,0 +1,100 @@
+import json
+import re
+from collections import Counter
+
+import pytest
+
+import app
+from app import CheckpointStore
+
+
+@pytest.mark.parametrize("num_chapters, expected", [
+    (12, [(1, 12)]),
+    (13, [(1, 7), (8, 13)]),
+    (25, [(1, 9), (10, 17), (18, 25)]),
+    (37, [(1, 10), (11, 19), (20, 28), (29, 37)]),
+])
+def test_plan_act_ranges_spreads_uneven_chapter_counts(num_chapters, expected):
+    assert app.plan_act_ranges(num_chapters, act_chapters=12) == expected
+
+
+@pytest.mark.parametrize("num_chapters", [11, 23, 24, 101, 150])
+def test_plan_act_ranges_covers_every_chapter_once(num_chapters):
+    ranges = app.plan_act_ranges(num_chapters, act_chapters=12)
+    sizes = [last - first + 1 for first, last in ranges]
+    assert [number for first, last in ranges for number in range(first, last + 1)] == list(range(1, num_chapters + 1))
+    assert max(sizes) <= 12
+    assert max(sizes) - min(sizes) <= 1
+
+
+ACT = {"number": 2, "title": "Storm", "first_chapter": 5, "last_chapter": 8}
+FALLBACK = "Continue Act 2 (Storm) as its summary describes."
+
+
+@pytest.mark.parametrize("content, expected", [
+    ("Here are the beats: the storm breaks.", [FALLBACK] * 4),
+    ('{"beats": ["A", "B", "C", "D"]}', [FALLBACK] * 4),
+    ('["A", "B"]', ["A", "B", FALLBACK, FALLBACK]),
+    ('["A", " ", "B", "C", "D", "E"]', ["A", "B", "C", "D"]),
+    ('```json\n["A", "B", "C", 4]\n```', ["A", "B", "C", "4"]),
+])
+def test_malformed_beats_fall_back_to_the_act_summary(content, expected):
+    assert app.StoryAgents._parse_beats(content, ACT) == expected
+
+
+def test_malformed_act_outline_keeps_the_planned_ranges():
+    acts = app.StoryAgents._parse_acts('[{"title": "Only one"}, "not an act"]', [(1, 7), (8, 14)])
+    assert [(act["title"], act["first_chapter"], act["last_chapter"]) for act in acts] == \
+        [("Only one", 1, 7), ("Act 2", 8, 14)]
+    assert all(act["beats"] is None for act in acts)
+
+
+class ActCompletions:
+    """Stands in for StoryAgents._complete for a book planned in acts, failing the chapter call given by fail_on"""
+
+    def __init__(self, fail_on=None):
+        self.calls = Counter()
+        self.fail_on = fail_on
+        self.chapter_prompts = []
+
+    def __call__(self, stage, messages, temperature, max_tokens, on_token=None):
+        self.calls[stage] += 1
+        if stage == "act_outline":
+            return json.dumps([{"title": f"Part {number}", "summary": f"Act {number} events."} for number in (1, 2)])
+        if stage == "act_beats":
+            act = int(re.search(r"Write the beats for Act (\d+)", messages[-1]["content"]).group(1))
+            return json.dumps([f"Beat {act}.{index}" for index in range(1, 8)])
+        if stage == "chapter":
+            if self.calls[stage] == self.fail_on:
+                raise RuntimeError("API outage")
+            self.chapter_prompts.append(messages[-1]["content"])
+            return f"Chapter {self.calls[stage]}: Part\n\nThe tide rose."
+        return f"Generated {stage}."
+
+
+def test_resume_in_the_middle_of_an_act_keeps_its_beats(tmp_path, monkeypatch):
+    store = CheckpointStore(str(tmp_path / "checkpoints.db"))
+    monkeypatch.setattr(app, "checkpoint_store", store)
+
+    first = ActCompletions(fail_on=4)
+    monkeypatch.setattr(app.StoryAgents, "_complete", lambda agents, **request: first(**request))
+    with pytest.raises(RuntimeError):
+        app.generate_story("Title", "A premise", 14, use_cache=False, story_id="acts")
+    saved = store.load("acts")
+    assert [chapter["number"] for chapter in saved["story"]["chapters"]] == [1, 2, 3]
+    assert saved["story"]["acts"][0]["beats"][3] == "Beat 1.4"
+    assert saved["story"]["acts"][1]["beats"] is None
+
+    second = ActCompletions()
+    monkeypatch.setattr(app.StoryAgents, "_complete", lambda agents, **request: second(**request))
+    story = app.generate_story("Title", "A premise", 14, use_cache=False, story_id="acts", resume=True)
+
+    assert [chapter["number"] for chapter in story["chapters"]] == list(range(1, 15))
+    # Act 1 keeps the beats planned before the failure, only act 2 is planned now
+    assert second.calls["act_outline"] == 0
+    assert second.calls["act_beats"] == 1
+    assert second.calls["chapter"] == 11
+    assert "Beat 1.4" in second.chapter_prompts[0]
+    assert "Next chapter, do not cover it yet: Beat 1.5" in second.chapter_prompts[0]
+    assert "Beat 2.1" in second.chapter_prompts[4]
+    assert [act["beats"][0] for act in story["acts"]] == ["Beat 1.1", "Beat 2.1"]
@@ -0,0 +1,48 @@
+import asyncio
+import threading
+import types
+
+import app
+
+
+class FakeCompletions:
+    def __init__(self, loop_threads):
+        self.loop_threads = loop_threads
+
+    async def create(self, **params):
+        self.loop_threads.add(threading.get_ident())
+        prompt = params["messages"][-1]["content"]
+        if "Generate Chapter" in prompt:
+            text = "Chapter 1: **The Harbour**\n\nThe tide rose.\n\n\"Hello,\" she said."
+        else:
+            text = "A short reply."
+        usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=20, prompt_tokens_details=None)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=text), finish_reason="stop")],
+            usage=usage
+        )
+
+
+def test_async_generation_keeps_sqlite_off_the_event_loop(monkeypatch):
+    loop_threads = set()
+    io_threads = []
+    client = types.SimpleNamespace(chat=types.SimpleNamespace(completions=FakeCompletions(loop_threads)))
+    monkeypatch.setattr(app.ModelBackend, "async_client", lambda self: client)
+
+    def recorded(function):
+        def call(*args, **kwargs):
+            io_threads.append((function.__name__, threading.get_ident()))
+            return function(*args, **kwargs)
+        return call
+
+    for name in ("load", "write", "delete"):
+        monkeypatch.setattr(app.checkpoint_store, name, recorded(getattr(app.checkpoint_store, name)))
+    for name in ("get", "put"):
+        monkeypatch.setattr(app.completion_cache, name, recorded(getattr(app.completion_cache, name)))
+
+    story = asyncio.run(app.agenerate_story("Off the loop", "A test of async storage", 2,
+                                            story_id="async-storage-test", resume=True))
+
+    assert len(story["chapters"]) == 2
+    assert {name for name, _ in io_threads} == {"load", "write", "delete", "get", "put"}
+    assert loop_threads and not loop_threads & {thread for _, thread in io_threads}
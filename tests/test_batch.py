@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def generated(monkeypatch, fake_story):
+    monkeypatch.setattr(app, "generate_story", fake_story)
+
+
+def test_rows_that_are_not_objects_fail_alone(generated, tmp_path):
+    rows = [{"title": "Good", "description": "A book", "num_chapters": 2}, "oops", ["also", "bad"]]
+    run = app.BatchRun(rows, str(tmp_path), formats=[])
+    report = run.run()
+
+    assert run.status == "completed"
+    assert (report["completed"], report["failed"]) == (1, 2)
+    assert sorted(failure["row"] for failure in report["failures"]) == [1, 2]
+    with open(os.path.join(tmp_path, "report.json"), encoding="utf-8") as f:
+        assert json.load(f)["failed"] == 2
+
+
+def test_failed_run_still_writes_report(generated, tmp_path, monkeypatch):
+    def broken_record(self, result, results_file):
+        raise OSError("disk full")
+    monkeypatch.setattr(app.BatchRun, "_record", broken_record)
+    run = app.BatchRun([{"title": "Good", "description": "A book", "num_chapters": 1}], str(tmp_path), formats=[])
+
+    with pytest.raises(OSError):
+        run.run()
+    assert run.status == "failed"
+    with open(os.path.join(tmp_path, "report.json"), encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["status"] == "failed" and report["error"] == "disk full"
+
+
+@pytest.mark.parametrize("body, message", [
+    ({"rows": ["oops"]}, "Row 0 is not an object"),
+    ({"rows": [{"title": "T", "description": "D"}], "concurrency": "x"}, "Concurrency must be a whole number"),
+    ({"rows": [{"title": "T", "description": "D"}], "concurrency": None}, "Concurrency must be a whole number"),
+    ({"rows": [{"title": "T", "description": "D"}], "concurrency": 0}, "Concurrency must be at least 1"),
+])
+def test_start_batch_rejects_bad_input(body, message):
+    response = app.app.test_client().post("/batch", json=body)
+    assert response.status_code == 400
+    assert response.get_json()["message"].startswith(message)
+
+
+def test_identical_rows_get_their_own_checkpoints(tmp_path):
+    row = {"title": "Twin", "description": "A book", "num_chapters": 1}
+    run = app.BatchRun([row, dict(row)], str(tmp_path), formats=[])
+    assert run._row_story_id(0, row) != run._row_story_id(1, row)
+    assert run._row_story_id(0, row) == run._row_story_id(0, dict(row))
+
+
+def test_malformed_jsonl_lines_fail_alone(generated, tmp_path):
+    path = tmp_path / "rows.jsonl"
+    path.write_text('{"title": "Good", "description": "A book", "num_chapters": 1}\n'
+                    '{"title": "Broken", \n'
+                    '\n'
+                    '{"title": "Also good", "description": "A book", "num_chapters": 1}\n', encoding="utf-8")
+    rows = app.load_batch_rows(str(path))
+    assert len(rows) == 3
+
+    report = app.BatchRun(rows, str(tmp_path / "out"), formats=[]).run()
+    assert (report["completed"], report["failed"]) == (2, 1)
+    assert report["failures"][0]["row"] == 1
+    assert report["failures"][0]["error"].startswith("Line 2 is not valid JSON")
+
+
+def test_uploaded_batch_with_a_malformed_line_is_accepted(generated, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "BATCH_OUTPUT_DIR", str(tmp_path))
+    upload = io.BytesIO(b'{"title": "Good", "description": "A book", "num_chapters": 1}\nnot json\n')
+    response = app.app.test_client().post("/batch", data={"file": (upload, "rows.jsonl"), "formats": "html"},
+                                          content_type="multipart/form-data")
+    assert response.status_code == 202
+    run = app.batch_runs[response.get_json()["batch_id"]]
+    app.batch_executor.submit(lambda: None).result(timeout=5)
+    assert (run.report()["completed"], run.report()["failed"]) == (1, 1)
+
+
+def test_batch_concurrency_is_capped(generated, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, "BATCH_OUTPUT_DIR", str(tmp_path))
+    monkeypatch.setattr(app, "BATCH_MAX_CONCURRENCY", 3)
+    response = app.app.test_client().post("/batch", json={
+        "rows": [{"title": "T", "description": "D", "num_chapters": 1}], "concurrency": 1000, "formats": ["html"]})
+    assert response.status_code == 202
+    assert app.batch_runs[response.get_json()["batch_id"]].concurrency == 3
+    app.batch_executor.submit(lambda: None).result(timeout=5)
+
+
+def test_finished_batches_are_pruned(monkeypatch):
+    old, running = app.BatchRun([], "unused"), app.BatchRun([], "unused")
+    old.finished_at = time.time() - app.JOB_RETENTION_SECONDS - 1
+    monkeypatch.setitem(app.batch_runs, old.id, old)
+    monkeypatch.setitem(app.batch_runs, running.id, running)
+    app.prune_batch_runs()
+    assert old.id not in app.batch_runs
+    assert running.id in app.batch_runs
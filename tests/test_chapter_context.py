@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from app import AsyncChapterContext, ChapterContext, chapter_tail, estimate_tokens
+
+
+class FakeAgents:
+    def summarize_chapter(self, chapter):
+        return f"Events of chapter {chapter['number']}. " * 12
+
+    async def asummarize_chapter(self, chapter):
+        return self.summarize_chapter(chapter)
+
+
+def make_chapter(number, tokens=10000):
+    paragraph = "The tide rose over the rocks as she climbed toward the lighthouse. " * 8
+    content = "\n\n".join([paragraph] * (tokens * 4 // len(paragraph) + 1))
+    return {"number": number, "title": f"Chapter Title {number}", "content": content}
+
+
+def test_chapter_tail_with_no_budget_is_empty():
+    assert chapter_tail(make_chapter(1)["content"], 0) == ""
+    assert chapter_tail(make_chapter(1)["content"], -5) == ""
+
+
+def test_chapter_tail_keeps_short_chapters_whole():
+    assert chapter_tail("Short chapter.", 100) == "Short chapter."
+
+
+@pytest.mark.parametrize("token_budget", [0, 50, 200, 1000, 1500, 4000])
+@pytest.mark.parametrize("tail_chapters", [0, 1, 3])
+@pytest.mark.parametrize("tail_tokens", [100, 600, 5000])
+def test_context_stays_within_budget(token_budget, tail_chapters, tail_tokens):
+    context = ChapterContext(FakeAgents(), token_budget=token_budget,
+                             tail_chapters=tail_chapters, tail_tokens=tail_tokens)
+    with context:
+        for number in range(1, 7):
+            context.add_chapter(make_chapter(number))
+            assert estimate_tokens(context.build()) <= max(token_budget, 1)
+
+
+def test_context_prefers_recent_tails_and_newest_summaries():
+    context = ChapterContext(FakeAgents(), token_budget=1500, tail_chapters=1, tail_tokens=600)
+    with context:
+        for number in range(1, 5):
+            context.add_chapter(make_chapter(number))
+        text = context.build()
+    assert "End of Chapter 4" in text
+    assert "End of Chapter 3" not in text
+    assert "Chapter 3 (Chapter Title 3): Events of chapter 3." in text
+    assert context.last_sources == sorted(context.last_sources)
+    assert 4 in context.last_sources and 3 in context.last_sources
+
+
+def test_async_context_summarizes_without_a_thread_pool():
+    async def build():
+        async with AsyncChapterContext(FakeAgents(), token_budget=1500, tail_chapters=1) as context:
+            assert context.executor is None
+            for number in range(1, 4):
+                context.add_chapter(make_chapter(number))
+            text = await context.abuild()
+        return text, context
+
+    text, context = asyncio.run(build())
+    assert "Chapter 2 (Chapter Title 2): Events of chapter 2." in text
+    assert all(chapter["summary"] for chapter in context.chapters)
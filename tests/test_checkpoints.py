@@ -0,0 +1,122 @@
+import json
+import sqlite3
+from collections import Counter
+
+import pytest
+
+import app
+from app import CheckpointStore
+
+
+def chapter(number, text="Text."):
+    return {"number": number, "title": f"Chapter {number}", "content": text}
+
+
+def test_save_and_load_round_trip(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.db"))
+    story = {"title": "T", "plot_outline": "Outline", "chapters": [chapter(1), chapter(2)]}
+    store.save("story", {"mode": "sequential"}, ["outline", "chapter_1", "chapter_2"], story)
+
+    saved = store.load("story")
+    assert saved["params"] == {"mode": "sequential"}
+    assert saved["stages"] == ["outline", "chapter_1", "chapter_2"]
+    assert saved["story"] == story
+
+
+def test_save_writes_only_the_given_chapters(tmp_path):
+    store = CheckpointStore(str(tmp_path / "checkpoints.db"))
+    story = {"title": "T", "chapters": [chapter(1), chapter(2)]}
+    store.save("story", {}, ["chapter_2"], story)
+    story["chapters"][0]["content"] = "Changed but not saved."
+    story["chapters"].append(chapter(3))
+    store.save("story", {}, ["chapter_3"], story, chapters=[story["chapters"][2]])
+
+    chapters = store.load("story")["story"]["chapters"]
+    assert [item["number"] for item in chapters] == [1, 2, 3]
+    assert chapters[0]["content"] == "Text."
+
+
+def test_legacy_checkpoints_with_inline_chapters_still_load(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    store = CheckpointStore(path)
+    story = {"title": "Old", "chapters": [chapter(1)]}
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO checkpoints VALUES (?, ?, ?, ?, ?)",
+                     ("old", "{}", '["chapter_1"]', json.dumps(story), 0))
+    assert store.load("old")["story"] == story
+
+
+def test_expired_checkpoints_are_removed_with_their_chapters(tmp_path):
+    path = str(tmp_path / "checkpoints.db")
+    store = CheckpointStore(path, ttl_seconds=60)
+    store.save("old", {}, ["chapter_1"], {"title": "Old", "chapters": [chapter(1)]})
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE checkpoints SET updated_at = 0 WHERE story_id = 'old'")
+    store.save("new", {}, ["chapter_1"], {"title": "New", "chapters": [chapter(1)]})
+
+    assert store.load("old") is None
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM checkpoint_chapters WHERE story_id = 'old'").fetchone()[0] == 0
+    store.delete("new")
+    assert store.load("new") is None
+
+
+class FlakyCompletions:
+    """Stands in for StoryAgents._complete and fails the chapter call given by fail_on"""
+
+    def __init__(self, fail_on=None):
+        self.calls = Counter()
+        self.fail_on = fail_on
+
+    def __call__(self, stage, messages, temperature, max_tokens, on_token=None):
+        self.calls[stage] += 1
+        if stage == "chapter" and self.calls[stage] == self.fail_on:
+            raise RuntimeError("API outage")
+        if stage == "chapter":
+            return f"Chapter {self.calls[stage]}: **Part {self.calls[stage]}**\n\nThe tide rose."
+        if stage == "title":
+            return "Title: Better Title"
+        return f"Generated {stage}."
+
+
+def use_completions(monkeypatch, completions):
+    monkeypatch.setattr(app.StoryAgents, "_complete", lambda agents, **request: completions(**request))
+    return completions
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    checkpoints = CheckpointStore(str(tmp_path / "checkpoints.db"))
+    monkeypatch.setattr(app, "checkpoint_store", checkpoints)
+    return checkpoints
+
+
+def test_resume_continues_after_the_last_completed_stage(store, monkeypatch):
+    use_completions(monkeypatch, FlakyCompletions(fail_on=3))
+    with pytest.raises(RuntimeError):
+        app.generate_story("Title", "A premise", 3, use_cache=False, story_id="resumable")
+
+    saved = store.load("resumable")
+    assert [item["number"] for item in saved["story"]["chapters"]] == [1, 2]
+    assert {"outline", "title", "blurb", "chapter_1", "chapter_2"} <= set(saved["stages"])
+
+    second = use_completions(monkeypatch, FlakyCompletions())
+    story = app.generate_story("Title", "A premise", 3, use_cache=False, story_id="resumable", resume=True)
+
+    assert [item["number"] for item in story["chapters"]] == [1, 2, 3]
+    assert story["title"] == "Better Title"
+    # Only the missing chapter is written again
+    assert second.calls["chapter"] == 1
+    assert second.calls["outline"] == second.calls["title"] == second.calls["blurb"] == 0
+    assert store.load("resumable") is None
+
+
+def test_starting_over_discards_an_earlier_attempt(store, monkeypatch):
+    use_completions(monkeypatch, FlakyCompletions(fail_on=2))
+    with pytest.raises(RuntimeError):
+        app.generate_story("Title", "A premise", 2, use_cache=False, story_id="fresh")
+
+    again = use_completions(monkeypatch, FlakyCompletions())
+    story = app.generate_story("Title", "A premise", 2, use_cache=False, story_id="fresh")
+    assert again.calls["outline"] == 1 and again.calls["chapter"] == 2
+    assert [item["number"] for item in story["chapters"]] == [1, 2]
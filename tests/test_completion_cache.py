@@ -0,0 +1,39 @@
+import sqlite3
+
+from app import CompletionCache
+
+
+def table_size(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+
+def test_running_total_follows_inserts_replacements_and_evictions(tmp_path):
+    path = str(tmp_path / "completions.db")
+    cache = CompletionCache(path, max_bytes=10_000)
+    for index in range(30):
+        cache.put(f"key-{index}", "x" * 1000)
+        cache.put(f"key-{index}", "y" * 900)
+        assert cache.total_size() == table_size(path)
+    assert cache.total_size() <= 10_000
+    assert cache.get("key-29") == "y" * 900
+    assert cache.get("key-0") is None
+
+
+def test_evicts_least_recently_used_first(tmp_path):
+    cache = CompletionCache(str(tmp_path / "completions.db"), max_bytes=2500)
+    cache.put("old", "a" * 1000)
+    cache.put("used", "b" * 1000)
+    assert cache.get("used") is not None
+    cache.put("newest", "d" * 1000)
+    assert cache.get("old") is None
+    assert cache.get("used") is not None
+
+
+def test_existing_cache_gets_its_total_on_open(tmp_path):
+    path = str(tmp_path / "completions.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE completions (key TEXT PRIMARY KEY, content TEXT NOT NULL, "
+                     "size INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)")
+        conn.execute("INSERT INTO completions VALUES ('a', 'abc', 3, 0, 0)")
+    assert CompletionCache(path).total_size() == 3
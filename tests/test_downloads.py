@@ -0,0 +1,86 @@
+from concurrent.futures import Future
+
+import pytest
+
+import app
+
+
+def test_stored_story_downloads_revalidate_after_regeneration():
+    story = {"title": "Cached", "chapters": [{"number": 1, "title": "One", "content": "First version."}]}
+    story_id = app.story_store.save(story)
+    client = app.app.test_client()
+
+    first = client.get(f"/download/{story_id}?format=html")
+    assert first.status_code == 200
+    assert "no-cache" in first.headers["Cache-Control"]
+    assert "max-age" not in first.headers["Cache-Control"]
+    assert client.get(f"/download/{story_id}?format=html",
+                      headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    story["chapters"][0]["content"] = "Regenerated."
+    app.story_store.save(story, story_id=story_id)
+    second = client.get(f"/download/{story_id}?format=html", headers={"If-None-Match": first.headers["ETag"]})
+    assert second.status_code == 200
+    assert b"Regenerated." in second.get_data()
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Render exports in the test process instead of the render pool; returns the formats rendered"""
+    rendered = []
+
+    def submit(story, format_type, key, block=True, timeout=None):
+        rendered.append(format_type)
+        future = Future()
+        future.set_result(app._render_export(story, format_type, app.artifact_cache.path(key)))
+        return future
+    monkeypatch.setattr(app.export_renderer, "submit", submit)
+    return rendered
+
+
+@pytest.mark.parametrize("format_type", ["pdf", "docx"])
+def test_cached_exports_answer_if_none_match_with_304(renders, format_type):
+    story = {"title": f"Cached {format_type}", "chapters": [{"number": 1, "title": "One", "content": "Text."}]}
+    story_id = app.story_store.save(story)
+    client = app.app.test_client()
+
+    first = client.get(f"/download/{story_id}?format={format_type}")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.strip('"') == app.story_fingerprint(story, format_type)
+
+    again = client.get(f"/download/{story_id}?format={format_type}", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+    assert again.get_data() == b""
+
+    # Without the ETag the file comes from the artifact cache, not a second render
+    cached = client.get(f"/download/{story_id}?format={format_type}")
+    assert cached.status_code == 200 and cached.get_data() == first.get_data()
+    assert renders == [format_type]
+
+    body = client.post("/download", json={"story": story, "format": format_type}, headers={"If-None-Match": etag})
+    assert body.status_code == 304
+
+
+def test_changing_a_story_invalidates_its_cached_exports(renders):
+    story = {"title": "Changing", "chapters": [{"number": 1, "title": "One", "content": "First version."}]}
+    story_id = app.story_store.save(story)
+    client = app.app.test_client()
+    old = client.get(f"/download/{story_id}?format=pdf")
+    old_key = old.headers["ETag"].strip('"')
+    assert app.artifact_cache.contains(old_key)
+
+    def rewrite(story, on_progress=None, cancel_event=None, on_token=None):
+        story["chapters"][0]["content"] = "Second version."
+        return story
+    job = app.JobManager(max_workers=1, asynchronous=False).submit_task(story_id, story, rewrite, "rewrite")
+    job.future.result(timeout=10)
+    assert job.status == "completed"
+    assert not app.artifact_cache.contains(old_key)
+
+    new = client.get(f"/download/{story_id}?format=pdf", headers={"If-None-Match": old.headers["ETag"]})
+    assert new.status_code == 200
+    assert new.headers["ETag"] != old.headers["ETag"]
+    assert new.get_data() != old.get_data()
+    assert renders == ["pdf", "pdf"]
@@ -0,0 +1,52 @@
+import re
+import zlib
+
+import app
+
+
+def long_story(chapters=3):
+    return {"title": "Exported", "blurb": "A book about exports.",
+            "chapters": [{"number": number, "title": f"Chapter Title {number}",
+                          "content": "\n\n".join(f"Paragraph {index} of chapter {number}. " * 30 for index in range(12))}
+                         for number in range(1, chapters + 1)]}
+
+
+def parse_pdf(data):
+    """Check the cross-reference table and return the page count and the decompressed page streams"""
+    assert data.startswith(b"%PDF-1.")
+    assert data.rstrip().endswith(b"%%EOF")
+    startxref = int(data[data.rindex(b"startxref") + len(b"startxref"):].split()[0])
+    assert data[startxref:startxref + 4] == b"xref"
+    lines = data[startxref:].split(b"\n")
+    first, count = map(int, lines[1].split())
+    for number, entry in enumerate(lines[2:2 + count], start=first):
+        offset, _, kind = entry.split()
+        if kind == b"n":
+            assert data[int(offset):].startswith(b"%d 0 obj" % number)
+    assert b"trailer" in data[startxref:]
+    pages = int(re.search(rb"/Type /Pages\s*/Kids \[.*?\]\s*/Count (\d+)", data, re.S).group(1))
+    streams = [zlib.decompress(stream) for stream in
+               re.findall(rb"/Filter /FlateDecode /Length \d+>>\nstream\n(.*?)\nendstream", data, re.S)]
+    return pages, streams
+
+
+def test_multi_chapter_pdf_parses():
+    story = long_story()
+    pages, streams = parse_pdf(app.create_pdf(story).getvalue())
+
+    # Cover, blurb and contents, then at least one page per chapter
+    assert pages >= 3 + len(story["chapters"])
+    assert len(streams) == pages
+    text = b"".join(streams)
+    for chapter in story["chapters"]:
+        assert chapter["title"].encode() in text
+
+
+def test_pdf_written_to_a_file_matches_the_in_memory_one(tmp_path):
+    story = long_story(chapters=2)
+    path = tmp_path / "story.pdf"
+    with open(path, "wb") as output:
+        app.create_pdf(story, output)
+    # Both carry a creation timestamp that may fall in different seconds
+    stamp = re.compile(rb"/CreationDate \(D:\d+\)")
+    assert stamp.sub(b"", path.read_bytes()) == stamp.sub(b"", app.create_pdf(story).getvalue())
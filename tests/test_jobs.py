@@ -0,0 +1,147 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_cancel_while_storing_does_not_flip_the_final_status(monkeypatch, asynchronous, fake_story, afake_story):
+    monkeypatch.setattr(app, "generate_story", fake_story)
+    monkeypatch.setattr(app, "agenerate_story", afake_story)
+    monkeypatch.setattr(app, "PRERENDER_EXPORTS", False)
+    saving = threading.Event()
+    release = threading.Event()
+    save = app.story_store.save
+
+    def slow_save(story, story_id=None):
+        saving.set()
+        release.wait(5)
+        return save(story, story_id=story_id)
+    monkeypatch.setattr(app.story_store, "save", slow_save)
+
+    manager = app.JobManager(max_workers=1, asynchronous=asynchronous)
+    job = manager.submit("Title", "Description", 1)
+    assert saving.wait(5)
+    manager.cancel(job.id)
+    release.set()
+    wait_until(lambda: job.finished)
+    time.sleep(0.05)
+
+    terminal = [event["event"] for event in job.events if event["event"] in ("completed", "failed", "cancelled")]
+    assert job.status == "completed"
+    assert terminal == ["completed"]
+
+
+def test_finish_only_applies_once():
+    manager = app.JobManager(max_workers=1)
+    job = app.StoryJob("Title", "Description", 1)
+    assert manager._finish(job, "cancelled")
+    assert not manager._finish(job, "completed")
+    assert job.status == "cancelled"
+    assert [event["event"] for event in job.events].count("cancelled") == 1
+
+
+def blocking_story(title, description, num_chapters, cancel_event=None, **kwargs):
+    while not cancel_event.wait(0.01):
+        pass
+    raise app.GenerationCancelled("cancelled")
+
+
+def test_other_processes_see_and_cancel_a_running_job(monkeypatch):
+    monkeypatch.setattr(app, "generate_story", blocking_story)
+    owner = app.JobManager(max_workers=1, asynchronous=False, sync_seconds=0.02)
+    other = app.JobManager(max_workers=1, asynchronous=False, sync_seconds=0.02)
+    job = owner.submit("Title", "Description", 1)
+    wait_until(lambda: other.status(job.id)["status"] == "running")
+    assert other.get(job.id) is None
+
+    assert other.request_cancel(job.id)["cancel_requested"]
+    wait_until(lambda: job.status == "cancelled")
+    wait_until(lambda: other.status(job.id)["status"] == "cancelled")
+
+    monkeypatch.setattr(app, "job_manager", other)
+    response = app.app.test_client().get(f"/jobs/{job.id}/events")
+    assert b"event: cancelled" in response.data
+
+
+def test_other_processes_load_the_finished_story(monkeypatch, fake_story):
+    monkeypatch.setattr(app, "generate_story", fake_story)
+    owner = app.JobManager(max_workers=1, asynchronous=False, sync_seconds=0.02)
+    job = owner.submit("Title", "Description", 1)
+    wait_until(lambda: job.finished and job.synced)
+
+    monkeypatch.setattr(app, "job_manager", app.JobManager(max_workers=1, asynchronous=False))
+    response = app.app.test_client().get(f"/jobs/{job.id}")
+    assert response.status_code == 200
+    assert response.json["job"]["status"] == "completed"
+    assert response.json["job"]["story"]["title"] == "Title"
+
+
+def test_a_job_whose_process_stopped_is_reported_as_failed(monkeypatch):
+    record = app.StoryJob("Title", "Description", 1).to_dict(include_story=False)
+    app.job_store.insert(record)
+    monkeypatch.setattr(app.job_store, "stale_seconds", 0)
+    time.sleep(0.01)
+    job = app.JobManager(max_workers=1).status(record["job_id"])
+    assert job["status"] == "failed"
+    assert "stopped" in job["error"]
+
+
+def test_event_streams_end_with_a_reconnect_and_resume_after_the_last_event(monkeypatch):
+    monkeypatch.setattr(app, "generate_story", blocking_story)
+    monkeypatch.setattr(app, "SSE_STREAM_SECONDS", 0.05)
+    manager = app.JobManager(max_workers=1, asynchronous=False)
+    monkeypatch.setattr(app, "job_manager", manager)
+    job = manager.submit("Title", "Description", 1)
+    job.publish("outline", {"plot_outline": "Outline"})
+    job.publish("title", {"title": "Title"})
+    client = app.app.test_client()
+
+    first = client.get(f"/jobs/{job.id}/events").get_data(as_text=True)
+    assert "event: outline" in first and "event: title" in first
+    assert first.endswith(app.SSE_RECONNECT)
+
+    second = client.get(f"/jobs/{job.id}/events?last_event_id=0").get_data(as_text=True)
+    assert "event: outline" not in second and "event: title" in second
+    manager.cancel(job.id)
+
+
+def test_only_one_of_many_concurrent_changes_to_a_story_is_queued():
+    release = threading.Event()
+
+    def task(story, on_progress=None, cancel_event=None, on_token=None):
+        release.wait(5)
+        return story
+
+    story = {"title": "Title", "chapters": [{"number": 1, "title": "One", "content": "Text."}]}
+    managers = [app.JobManager(max_workers=2, asynchronous=False) for _ in range(2)]
+    barrier = threading.Barrier(8)
+    outcomes = []
+
+    def submit(manager):
+        barrier.wait()
+        try:
+            outcomes.append(manager.submit_task("shared-story", story, task, "change"))
+        except app.JobAlreadyRunning:
+            outcomes.append(None)
+
+    threads = [threading.Thread(target=submit, args=(managers[index % 2],)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    release.set()
+
+    jobs = [job for job in outcomes if job is not None]
+    assert len(outcomes) == 8
+    assert len(jobs) == 1
+    wait_until(lambda: jobs[0].finished)
@@ -0,0 +1,90 @@
+import types
+
+import pytest
+
+import app
+
+
+class FakeClient:
+    """Sync OpenAI client stand-in that answers every request with 100 prompt and 20 completion tokens"""
+
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **params):
+        prompt = params["messages"][-1]["content"]
+        text = "Chapter 1: The Harbour\n\nThe tide rose." if "Generate Chapter" in prompt else "A short reply."
+        usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=20, prompt_tokens_details=None)
+        if not params.get("stream"):
+            return types.SimpleNamespace(usage=usage, choices=[types.SimpleNamespace(
+                message=types.SimpleNamespace(content=text), finish_reason="stop")])
+        return iter([
+            types.SimpleNamespace(usage=None, choices=[types.SimpleNamespace(
+                delta=types.SimpleNamespace(content=text), finish_reason="stop")]),
+            types.SimpleNamespace(usage=usage, choices=[]),
+        ])
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """A fresh registry with the app's metric definitions, so counts start at zero"""
+    fresh = app.Metrics()
+    fresh.definitions = dict(app.metrics.definitions)
+    fresh.values = {name: {} for name in fresh.definitions}
+    monkeypatch.setattr(app, "metrics", fresh)
+    client = FakeClient()
+    monkeypatch.setattr(app.ModelBackend, "client", lambda self: client)
+    return fresh
+
+
+def samples(text):
+    """Map each sample line of the exposition to its value"""
+    values = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            values[series] = float(value)
+    return values
+
+
+def test_metrics_endpoint_reports_a_generated_story(registry):
+    manager = app.JobManager(max_workers=1, asynchronous=False)
+    job = manager.submit("Metrics Title", "A book to count", 2, use_cache=True)
+    job.future.result(timeout=10)
+    assert job.status == "completed"
+    # The same book again comes entirely from the completion cache
+    again = manager.submit("Metrics Title", "A book to count", 2, use_cache=True)
+    again.future.result(timeout=10)
+
+    response = app.app.test_client().get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    values = samples(text)
+    model = app.OPENAI_MODEL
+
+    assert "# TYPE llm_requests_total counter" in text
+    assert "# TYPE llm_request_duration_seconds histogram" in text
+    assert values[f'llm_requests_total{{finish_reason="stop",model="{model}",stage="chapter"}}'] == 2
+    assert values[f'llm_tokens_total{{kind="prompt",model="{model}",stage="chapter"}}'] == 200
+    assert values[f'llm_tokens_total{{kind="completion",model="{model}",stage="chapter"}}'] == 40
+    assert values['llm_cache_hits_total{stage="chapter"}'] == 2
+    assert values[f'llm_cost_usd_total{{model="{model}"}}'] > 0
+
+    # Histogram buckets are cumulative and end in +Inf, which equals the count
+    chapter = f'model="{model}",stage="chapter"'
+    buckets = [(line, value) for line, value in values.items()
+               if line.startswith(f"llm_request_duration_seconds_bucket{{{chapter},")]
+    assert [line.rsplit('le="', 1)[1] for line, _ in buckets][-1] == '+Inf"}'
+    counts = [value for _, value in buckets]
+    assert counts == sorted(counts) and counts[-1] == 2
+    assert values[f"llm_request_duration_seconds_count{{{chapter}}}"] == 2
+    assert values[f"llm_request_duration_seconds_sum{{{chapter}}}"] >= 0
+
+    assert values['story_generation_seconds_count{mode="sequential",status="completed"}'] == 2
+    assert values['story_generation_seconds_bucket{mode="sequential",status="completed",le="+Inf"}'] == 2
+
+
+def test_label_values_are_escaped(registry):
+    registry.inc("llm_cache_hits_total", stage='odd "stage"\nname\\')
+    assert 'llm_cache_hits_total{stage="odd \\"stage\\"\\nname\\\\"} 1' in registry.render()
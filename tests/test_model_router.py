@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+import app
+
+
+def test_backend_settings_given_as_strings_are_converted():
+    router = app.ModelRouter({"fast": {"model": "small", "max_concurrency": "2", "timeout": "30"}},
+                             {"title": "fast"})
+    backend = router.for_stage("title")
+    assert backend.max_concurrency == 2 and backend.timeout == 30.0
+    with backend.slot(), backend.slot():
+        assert not backend.slots.acquire(blocking=False)
+
+    async def hold_slots():
+        async with backend.async_slot():
+            async with backend.async_slot():
+                return backend.async_slot().locked()
+    assert asyncio.run(hold_slots())
+
+
+def test_unset_max_concurrency_means_no_limit():
+    backend = app.ModelRouter({"fast": {"max_concurrency": None}}).backends["fast"]
+    assert backend.max_concurrency is None and backend.slots is None
+
+
+def test_unknown_backend_settings_are_rejected():
+    with pytest.raises(ValueError, match="Unknown settings"):
+        app.ModelRouter({"fast": {"max_concurent": 2}})
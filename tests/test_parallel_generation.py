@@ -0,0 +1,117 @@
+import asyncio
+import re
+import threading
+import time
+
+import pytest
+
+import app
+
+NUM_CHAPTERS = 4
+NOTES = {"2": ["Call the captain Mara, not Maria."], "4": ["The storm already ended in chapter 3."]}
+
+
+class ParallelModel:
+    """Fake model for parallel mode; later chapters answer sooner, so drafts finish out of order"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.requests = []
+
+    def reply(self, stage, messages):
+        prompt = messages[-1]["content"]
+        with self.lock:
+            self.requests.append((stage, prompt))
+        if stage == "chapter":
+            number = int(re.search(r"Generate Chapter (\d+)", prompt).group(1))
+            return f"Chapter {number}: Draft {number}\n\nDraft text of chapter {number}."
+        if stage == "summary":
+            number = re.search(r"Summarize Chapter (\d+)", prompt).group(1)
+            return f"Summary of chapter {number}."
+        if stage == "continuity_review":
+            return '{"2": ["Call the captain Mara, not Maria."], "4": ["The storm already ended in chapter 3."]}'
+        if stage == "revision":
+            number = re.search(r"Revise Chapter (\d+)", prompt).group(1)
+            return f"Revised text of chapter {number}."
+        return f"Generated {stage}."
+
+    def delay(self, stage, messages):
+        match = re.search(r"Generate Chapter (\d+)", messages[-1]["content"]) if stage == "chapter" else None
+        return (NUM_CHAPTERS + 1 - int(match.group(1))) * 0.03 if match else 0
+
+    def enter(self, stage):
+        with self.lock:
+            if stage == "chapter":
+                self.in_flight += 1
+                self.most_in_flight = max(self.most_in_flight, self.in_flight)
+
+    def leave(self, stage):
+        with self.lock:
+            if stage == "chapter":
+                self.in_flight -= 1
+
+    def complete(self, stage, messages, temperature, max_tokens, on_token=None):
+        self.enter(stage)
+        try:
+            time.sleep(self.delay(stage, messages))
+            return self.reply(stage, messages)
+        finally:
+            self.leave(stage)
+
+    async def acomplete(self, stage, messages, temperature, max_tokens, on_token=None):
+        self.enter(stage)
+        try:
+            await asyncio.sleep(self.delay(stage, messages))
+            return self.reply(stage, messages)
+        finally:
+            self.leave(stage)
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+def test_parallel_mode_drafts_together_reviews_once_and_keeps_chapter_order(monkeypatch, asynchronous):
+    model = ParallelModel()
+    monkeypatch.setattr(app.StoryAgents, "_complete", lambda agents, **request: model.complete(**request))
+    monkeypatch.setattr(app.StoryAgents, "_acomplete", lambda agents, **request: model.acomplete(**request))
+    stages = []
+
+    def on_progress(stage, story):
+        stages.append(stage)
+
+    if asynchronous:
+        story = asyncio.run(app.agenerate_story("Title", "A premise", NUM_CHAPTERS, on_progress=on_progress,
+                                                mode="parallel", use_cache=False))
+    else:
+        story = app.generate_story("Title", "A premise", NUM_CHAPTERS, on_progress=on_progress,
+                                   mode="parallel", use_cache=False)
+
+    # Every chapter was drafted at the same time, and the last one finished first
+    assert model.most_in_flight == NUM_CHAPTERS
+    drafted = [stage for stage in stages if stage.startswith("chapter_")]
+    assert sorted(drafted) == [f"chapter_{number}" for number in range(1, NUM_CHAPTERS + 1)]
+    assert drafted[0] == f"chapter_{NUM_CHAPTERS}"
+
+    # One review over all the summaries, after every draft and before any revision
+    reviews = [prompt for stage, prompt in model.requests if stage == "continuity_review"]
+    assert len(reviews) == 1
+    for number in range(1, NUM_CHAPTERS + 1):
+        assert f"Summary of chapter {number}." in reviews[0]
+    assert stages.index("continuity_review") > max(stages.index(stage) for stage in drafted)
+    assert sorted(stage for stage in stages if stage.startswith("revised_")) == ["revised_chapter_2",
+                                                                                "revised_chapter_4"]
+    assert stages.index("continuity_review") < stages.index("revised_chapter_2")
+
+    # Only the flagged chapters were revised, and the book is in chapter order
+    assert [chapter["number"] for chapter in story["chapters"]] == list(range(1, NUM_CHAPTERS + 1))
+    assert story["continuity_notes"] == NOTES
+    for chapter in story["chapters"]:
+        if str(chapter["number"]) in NOTES:
+            assert chapter["content"] == f"Revised text of chapter {chapter['number']}."
+            assert chapter["continuity_fixes"] == NOTES[str(chapter["number"])]
+            assert chapter["context_chapters"] == [number for number in range(1, NUM_CHAPTERS + 1)
+                                                   if number != chapter["number"]]
+        else:
+            assert chapter["content"] == f"Draft text of chapter {chapter['number']}."
+            assert "continuity_fixes" not in chapter
+    assert sum(1 for stage, _ in model.requests if stage == "revision") == len(NOTES)
@@ -0,0 +1,177 @@
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from app import RequestScheduler, TokenBucket
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_scheduler(clock, **kwargs):
+    kwargs.setdefault("rpm", 60)
+    kwargs.setdefault("tpm", 6000)
+    return RequestScheduler(clock=clock, sleep=clock.sleep, jitter=lambda low, high: high, **kwargs)
+
+
+def api_response(status, headers=None):
+    return httpx.Response(status, headers=headers or {},
+                          request=httpx.Request("POST", "https://api.example/v1/chat/completions"))
+
+
+def rate_limit_error(retry_after=None):
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+    return openai.RateLimitError("rate limited", response=api_response(429, headers), body=None)
+
+
+def test_token_bucket_refills_continuously_up_to_capacity():
+    bucket = TokenBucket(60, 1, now=0)
+    bucket.take(60)
+    assert bucket.wait_time(10) == 10
+    bucket.refill(4)
+    assert bucket.tokens == 4
+    assert bucket.wait_time(10) == 6
+    bucket.refill(1000)
+    assert bucket.tokens == 60
+    # Requests larger than the bucket only wait for a full one
+    assert bucket.wait_time(500) == 0
+
+
+def test_admission_waits_for_the_request_bucket():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, rpm=2)
+    scheduler.acquire(10)
+    scheduler.acquire(10)
+    ticket = (0, 99)
+    scheduler.waiters.append(ticket)
+    assert scheduler._admit(ticket, 10) == pytest.approx(30)
+    clock.now += 30
+    assert scheduler._admit(ticket, 10) == 0
+
+
+def test_admission_waits_for_the_token_bucket_and_settle_corrects_the_estimate():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, tpm=600)
+    scheduler.acquire(500)
+    ticket = (0, 99)
+    scheduler.waiters.append(ticket)
+    assert scheduler._admit(ticket, 300) == pytest.approx(20)
+    # The request used far fewer tokens than estimated, so the rest comes back at once
+    scheduler.settle(500, 200)
+    assert scheduler._admit(ticket, 300) == 0
+
+    scheduler.waiters.append(ticket)
+    scheduler.settle(100, 400)
+    assert scheduler.tokens.tokens < 0
+
+
+def test_interactive_requests_go_before_waiting_batch_requests():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, rpm=1)
+    scheduler.acquire(1)
+    admitted = []
+
+    def request(priority):
+        scheduler.acquire(1, priority)
+        admitted.append(priority)
+
+    batch = threading.Thread(target=request, args=("batch",))
+    batch.start()
+    while len(scheduler.waiters) < 1:
+        time.sleep(0.001)
+    interactive = threading.Thread(target=request, args=("interactive",))
+    interactive.start()
+    while len(scheduler.waiters) < 2:
+        time.sleep(0.001)
+
+    for expected in (1, 2):
+        # A minute later there is room for one more request; settle() wakes the waiters
+        clock.now += 60
+        scheduler.settle(0, 0)
+        deadline = time.monotonic() + 5
+        while len(admitted) < expected and time.monotonic() < deadline:
+            time.sleep(0.001)
+    batch.join(5)
+    interactive.join(5)
+    assert admitted == ["interactive", "batch"]
+
+
+def test_requests_of_equal_priority_are_served_in_arrival_order():
+    scheduler = make_scheduler(FakeClock())
+    first, second = (1, 1), (1, 2)
+    scheduler.waiters.extend([first, second])
+    assert scheduler._admit(second, 1) is None
+    assert scheduler._admit(first, 1) == 0
+
+
+def test_rate_limit_retry_after_is_honoured_and_pauses_everyone():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock)
+    replies = [rate_limit_error(retry_after=7), "done"]
+    retries = []
+
+    def request():
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    started = clock.now
+    assert scheduler.execute(request, 100, on_retry=lambda: retries.append(1)) == "done"
+    assert clock.sleeps == [7]
+    assert scheduler.paused_until == started + 7
+    assert retries == [1]
+
+
+def test_pause_holds_back_new_requests():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock)
+    scheduler.pause(5)
+    ticket = (0, 99)
+    scheduler.waiters.append(ticket)
+    assert scheduler._admit(ticket, 1) == pytest.approx(5)
+    clock.now += 5
+    assert scheduler._admit(ticket, 1) == 0
+
+
+def test_connection_errors_back_off_exponentially_up_to_the_limit():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock, max_retries=5, backoff_base=1, backoff_max=6)
+    error = openai.APIConnectionError(request=httpx.Request("POST", "https://api.example"))
+
+    def request():
+        raise error
+
+    with pytest.raises(openai.APIConnectionError):
+        scheduler.execute(request, 100)
+    assert clock.sleeps == [1, 2, 4, 6, 6]
+    # Failed attempts hand their estimated tokens back
+    assert scheduler.tokens.tokens == pytest.approx(6000 - 100)
+
+
+def test_client_errors_are_not_retried():
+    clock = FakeClock()
+    scheduler = make_scheduler(clock)
+    calls = []
+
+    def request():
+        calls.append(1)
+        raise openai.BadRequestError("bad request", response=api_response(400), body=None)
+
+    with pytest.raises(openai.BadRequestError):
+        scheduler.execute(request, 100)
+    assert calls == [1]
+    assert clock.sleeps == []